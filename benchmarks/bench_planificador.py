@@ -0,0 +1,473 @@
+# ============================================================
+# Benchmark a escala sintética del motor de planificación V2
+#
+# Mide cada etapa (forecast, pedidos, restricciones, mínimos, modos de planificación y
+# pipeline completo sobre snapshot local) a varias escalas de CM, con throughput y pico
+# de memoria, y compara contra un baseline guardado: sale con código 1 si alguna etapa
+# empeora más de la tolerancia.
+#
+#   python -m benchmarks.bench_planificador [--escalas 1k,10k,100k] [--centros 5] [--dias 60]
+#       [--consumo gamma] [--stock-dias -2 20] [--repeticiones 3] [--tolerancia 0.3]
+#       [--guardar-baseline] [--sin-pipeline] [--procesos N]
+#
+# Con --procesos N > 1 se miden además los modos repartidos entre N procesos
+# (iterativo_paralelo, una_pasada_paralelo; el pico de memoria no incluye los procesos).
+# Todos los modos de planificación medidos deben dar los mismos pedidos y forecast: si no,
+# el benchmark falla antes de comparar tiempos.
+# ============================================================
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+from parametros_cm import ParametrosCM, construir_parametros_cm
+from funciones_stg import (
+    forecast_stock_centros_dias,
+    generar_pedidos_centros_desde_forecastV2,
+    ajustar_pedidos_por_restricciones_logisticas_v2,
+    ajustar_pedidos_a_minimos_logisticos_v2,
+)
+import pipeline_v2
+
+
+# Centros del universo por defecto de generar_filtro_cm: los únicos que ve la etapa
+# `pipeline` cuando no se filtra centro. A partir del sexto se inventan códigos.
+CENTROS_BASE = ("0801", "2801", "2901", "4601", "1009")
+DISTRIBUCIONES_CONSUMO = ("gamma", "lognormal", "poisson", "constante")
+ENCADENADAS = ("forecast", "pedidos", "restricciones", "minimos")
+# Etapas de planificación que deben dar el mismo resultado (pedidos, forecast) que otra:
+# {etapa: (referencia, mismo orden de filas)}. Repartidos entre procesos, los CM salen
+# agrupados por partición, así que ahí se compara sin orden.
+MODOS_EQUIVALENTES = {
+    "una_pasada": ("iterativo", True),
+    "iterativo_paralelo": ("iterativo", False),
+    "una_pasada_paralelo": ("una_pasada", False),
+}
+ETAPAS = (
+    "forecast", "pedidos", "restricciones", "minimos", "iterativo", "una_pasada",
+    "iterativo_paralelo", "una_pasada_paralelo", "pipeline",
+)
+
+# Margen absoluto además de la tolerancia relativa: las etapas de pocos ms son ruidosas
+MARGEN_ABSOLUTO = {"segundos": 0.005, "pico_mb": 1.0}
+
+BASELINE_POR_DEFECTO = os.path.join(os.path.dirname(__file__), "baseline_planificador.json")
+PROJECT_ID = pipeline_v2.PROJECT_ID
+
+
+@dataclass
+class Escenario:
+    """Datos sintéticos con la forma que devuelven los cargadores (ver cargar_datos_reales)."""
+    stock: pd.DataFrame          # Centro, Material, Stock, Stock_Actual, Proveedor
+    df_sc: pd.DataFrame          # stock + CMD_SAP, CMD_Ajustado_Final, cantidad_min_fabricacion
+    df_obj: pd.DataFrame         # Master_Logistica ya renombrada (Centro, Dias_Stock_*)
+    df_minimos: pd.DataFrame     # Master_Pedidos_Min
+    df_rotacion: pd.DataFrame    # Stock_Dias_CAP_PAL
+    parametros: ParametrosCM
+    dias: int
+
+
+def _consumo(distribucion: str, media: float, n: int, rng) -> np.ndarray:
+    if distribucion == "gamma":
+        return rng.gamma(1.5, media / 1.5, n)
+    if distribucion == "lognormal":
+        sigma = 1.0
+        return rng.lognormal(np.log(media) - sigma ** 2 / 2, sigma, n)
+    if distribucion == "poisson":
+        return rng.poisson(media, n).astype(float)
+    if distribucion == "constante":
+        return np.full(n, float(media))
+    raise ValueError(f"Distribución {distribucion!r} no soportada. Opciones: {DISTRIBUCIONES_CONSUMO}")
+
+
+def generar_escenario(
+    n_centros: int = 5,
+    n_materiales: int = 200,
+    dias: int = 60,
+    consumo: str = "gamma",
+    consumo_medio: float = 8.0,
+    stock_dias: tuple = (-2.0, 20.0),
+    semilla: int = 0,
+) -> Escenario:
+    """
+    Escenario de n_centros × n_materiales CM sobre un horizonte de `dias`.
+    - consumo: distribución del consumo diario por CM (media `consumo_medio`), un 2 % a 0.
+    - stock_dias: rango (uniforme) del stock inicial en días de consumo; negativo = ya roto.
+    - Mínimos por material y rotación CAP/PAL para ~70 % de los CM, como en producción.
+    """
+    rng = np.random.default_rng(semilla)
+    centros = list(CENTROS_BASE[:n_centros]) + [f"9{i:03d}" for i in range(max(n_centros - len(CENTROS_BASE), 0))]
+    materiales = np.arange(100000, 100000 + n_materiales, dtype=np.int64)
+    n_cm = len(centros) * n_materiales
+
+    centro_cm = np.repeat(np.array(centros, dtype=object), n_materiales)
+    material_cm = np.tile(materiales, len(centros))
+
+    cmd = _consumo(consumo, consumo_medio, n_cm, rng).round(3)
+    cmd[rng.random(n_cm) < 0.02] = 0.0
+    cobertura = rng.uniform(stock_dias[0], stock_dias[1], n_cm)
+    stock = (cmd * cobertura).round(2)
+    proveedor = rng.integers(1, 21, n_materiales)[material_cm - materiales[0]]
+
+    df_sc = pd.DataFrame({
+        "Centro": centro_cm,
+        "Material": pd.array(material_cm, dtype="Int64"),
+        "Stock": stock,
+        "Stock_Actual": np.maximum(stock, 0.0),
+        "Proveedor": pd.array(proveedor, dtype="Int64"),
+        "CMD_SAP": (cmd * rng.uniform(0.8, 1.1, n_cm)).round(3),
+        "CMD_Ajustado_Final": cmd,
+        "cantidad_min_fabricacion": 0.0,
+    })
+
+    dias_seguridad = rng.integers(1, 6, len(centros))
+    df_obj = pd.DataFrame({
+        "Centro": centros,
+        "Dias_Stock_Objetivo": pd.array(dias_seguridad + rng.integers(5, 11, len(centros)), dtype="Int64"),
+        "Dias_Stock_Seguridad": pd.array(dias_seguridad, dtype="Int64"),
+    })
+
+    df_minimos = pd.DataFrame({
+        "Material": pd.array(materiales, dtype="Int64"),
+        "Cajas_capa": rng.integers(0, 20, n_materiales).astype(float),
+        "Cajas_palet": rng.integers(20, 200, n_materiales).astype(float),
+    })
+
+    con_rotacion = rng.random(n_cm) < 0.7
+    n_rot = int(con_rotacion.sum())
+    df_rotacion = pd.DataFrame({
+        "Centro": centro_cm[con_rotacion],
+        "Material": pd.array(material_cm[con_rotacion], dtype="Int64"),
+        "cajas_cap": rng.integers(1, 20, n_rot).astype(float),
+        "cajas_pal": rng.integers(0, 120, n_rot).astype(float),
+        "dias_stock_cap": rng.uniform(0, 5, n_rot),
+        "dias_stock_pal": rng.uniform(2, 25, n_rot),
+    })
+
+    return Escenario(
+        stock=df_sc[["Centro", "Material", "Stock", "Stock_Actual", "Proveedor"]],
+        df_sc=df_sc,
+        df_obj=df_obj,
+        df_minimos=df_minimos,
+        df_rotacion=df_rotacion,
+        parametros=construir_parametros_cm(df_sc, df_obj, df_minimos, df_rotacion),
+        dias=dias,
+    )
+
+
+def escribir_snapshot(escenario: Escenario, fuente) -> None:
+    """Vuelca el escenario como tablas de origen en una FuenteLocal (mismo SQL que producción)."""
+    hoy = datetime.now(timezone.utc).date()
+    sc = escenario.df_sc
+    cm = pd.DataFrame({"Centro": sc["Centro"], "Material": sc["Material"].astype("int64")})
+
+    def escribir(df, tabla):
+        fuente.escribir_df(df, f"{PROJECT_ID}.{tabla}")
+
+    def vacia(**columnas):
+        return pd.DataFrame({c: pd.Series([], dtype=t) for c, t in columnas.items()})
+
+    escribir(cm.assign(Proveedor=sc["Proveedor"].astype("int64"), Fecha_Pedido=hoy - timedelta(days=7),
+                       Pedido=np.arange(len(cm)), Posicion=10), "granier_staging.stg_ME2L")
+    escribir(cm.assign(Fecha=hoy), "granier_staging.stg_ZLO12")
+    escribir(cm.assign(Libre_util_centro=sc["Stock"], Cantidad_pdte_salida=0.0),
+             "granier_logistica.ZLO12_STREAMING_CURRENT")
+    escribir(cm.assign(CMD_SAP=sc["CMD_SAP"], CMD_Ajustado_Final=sc["CMD_Ajustado_Final"],
+                       cantidad_min_fabricacion=sc["cantidad_min_fabricacion"]),
+             "granier_logistica.v_ZLO12_curado")
+    escribir(vacia(Centro="string", Material="int64"), "granier_logistica.Tbl_excluidos_flujo_comercializado")
+    escribir(vacia(Centro="string", Material="int64", Proveedor="int64", Cantidad="float64",
+                   Fecha_de_entrega="datetime64[ns]"), "granier_logistica.Tbl_Pedidos_Pendientes")
+    escribir(vacia(Centro="string", Material="int64", Proveedor="int64", Cantidad_Rotura="float64",
+                   Estado="string", Fecha_Rotura="datetime64[ns]"), "granier_logistica.Tbl_Roturas_Proveedor")
+    escribir(pd.DataFrame({
+        "centro": escenario.df_obj["Centro"],
+        "stock_objetivo": escenario.df_obj["Dias_Stock_Objetivo"].astype("int64"),
+        "stock_seguridad": escenario.df_obj["Dias_Stock_Seguridad"].astype("int64"),
+        "centro_suministrador": "1004",
+    }), "granier_logistica.Master_Logistica")
+    escribir(escenario.df_minimos.astype({"Material": "int64"}), "granier_logistica.Master_Pedidos_Min")
+    escribir(escenario.df_rotacion.astype({"Material": "int64"}), "granier_logistica.Stock_Dias_CAP_PAL")
+    materiales = escenario.df_minimos["Material"].astype("int64")
+    escribir(pd.DataFrame({
+        "Material": materiales,
+        "Codigo_Base": materiales,
+        "Texto_breve": "Material " + materiales.astype(str),
+        "N_antiguo_material": "",
+    }), "granier_maestros.Master_ArticulosSAP")
+
+
+def _silencioso(fn):
+    """Ejecuta fn sin el print de progreso del motor (distorsiona los tiempos)."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn()
+
+
+def _medir(fn, repeticiones: int):
+    """(mejor tiempo en s, pico de memoria en bytes, resultado). El pico va en una pasada aparte."""
+    tiempos = []
+    for _ in range(repeticiones):
+        t0 = time.perf_counter()
+        resultado = _silencioso(fn)
+        tiempos.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    try:
+        _silencioso(fn)
+        _, pico = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(tiempos), pico, resultado
+
+
+def _etapas(escenario: Escenario, directorio: str | None, procesos: int = 0):
+    """(nombre, función, nº de filas procesadas) de cada etapa, encadenando entradas reales."""
+    fecha_plan = date.today()
+    stock = escenario.stock[["Centro", "Material", "Stock", "Stock_Actual"]]
+    parametros = escenario.parametros
+    dias = escenario.dias
+    estado = {}
+
+    def forecast():
+        estado["forecast"] = forecast_stock_centros_dias(stock, parametros, None, dias, clamp_cero=True)
+        return estado["forecast"]
+
+    def pedidos():
+        estado["pedidos"] = generar_pedidos_centros_desde_forecastV2(estado["forecast"], parametros)
+        return estado["pedidos"]
+
+    def restricciones():
+        estado["restricciones"] = ajustar_pedidos_por_restricciones_logisticas_v2(
+            estado["pedidos"], 2, parametros, fecha_plan
+        )
+        return estado["restricciones"]
+
+    def minimos():
+        return ajustar_pedidos_a_minimos_logisticos_v2(estado["restricciones"], parametros)
+
+    def modo(planificar):
+        return lambda: planificar(stock, parametros, dias, fecha_plan, None)
+
+    yield "forecast", forecast, lambda r: len(r)
+    yield "pedidos", pedidos, lambda r: len(estado["forecast"])
+    yield "restricciones", restricciones, lambda r: len(estado["pedidos"])
+    yield "minimos", minimos, lambda r: len(estado["restricciones"])
+    yield "iterativo", modo(pipeline_v2._planificar_iterativo), lambda r: len(r[1])
+    yield "una_pasada", modo(pipeline_v2._planificar_una_pasada), lambda r: len(r[1])
+
+    if procesos > 1:
+        from planificacion_paralela import planificar_cms
+
+        def paralelo(planificar):
+            return lambda: planificar_cms(planificar, stock, parametros, dias, fecha_plan, None, procesos=procesos)
+
+        # Por debajo de MIN_CM_PARALELO planificar_cms planifica en serie
+        yield "iterativo_paralelo", paralelo(pipeline_v2._planificar_iterativo), lambda r: len(r[1])
+        yield "una_pasada_paralelo", paralelo(pipeline_v2._planificar_una_pasada), lambda r: len(r[1])
+
+    if directorio is not None:
+        from cache_referencia import CACHE_REFERENCIA
+        from carga_params import MEMO_FILTRO_CM, MEMO_ULTIMO_PROVEEDOR
+        from fuente_datos import FuenteLocal
+
+        fuente = FuenteLocal(directorio)
+        escribir_snapshot(escenario, fuente)
+        seguridad = int(escenario.df_obj["Dias_Stock_Seguridad"].max())
+        fecha_corte = (fecha_plan + timedelta(days=dias - seguridad)).isoformat()
+
+        def pipeline():
+            # En frío: sin caché de referencia ni memos diarias de una pasada anterior
+            CACHE_REFERENCIA.invalidar()
+            MEMO_FILTRO_CM.invalidar()
+            MEMO_ULTIMO_PROVEEDOR.invalidar()
+            # Escritura síncrona: la etapa incluye las cargas, comparable con el baseline
+            return pipeline_v2.ejecutar_pipeline_v2(
+                proveedor_id=None, consumo_extra_pct=0.0, fecha_corte=fecha_corte, fuente=fuente,
+                escritura_diferida=False
+            )
+
+        yield "pipeline", pipeline, lambda r: r["forecast_rows"]
+
+
+def comprobar_modos_equivalentes(salidas: dict):
+    """
+    Los (pedidos, forecast) de cada etapa de MODOS_EQUIVALENTES medida deben ser iguales a los
+    de su referencia (salvo dtypes: el iterativo arrastra object de sus concat iniciales).
+    """
+    for nombre, (referencia, mismo_orden) in MODOS_EQUIVALENTES.items():
+        if nombre not in salidas or referencia not in salidas:
+            continue
+        for parte, a, b in zip(("pedidos", "forecast"), salidas[referencia], salidas[nombre]):
+            if not mismo_orden:
+                a, b = (df.sort_values(list(df.columns), kind="stable") for df in (a, b))
+            try:
+                pd.testing.assert_frame_equal(
+                    a.reset_index(drop=True), b.reset_index(drop=True), check_dtype=False
+                )
+            except AssertionError as e:
+                raise AssertionError(f"{nombre} no da los mismos {parte} que {referencia}: {e}") from None
+
+
+def _parsear_escala(texto: str) -> int:
+    texto = texto.strip().lower()
+    return int(float(texto[:-1]) * 1000) if texto.endswith("k") else int(texto)
+
+
+def ejecutar_escala(
+    n_cm: int,
+    n_centros: int,
+    dias: int,
+    consumo: str,
+    stock_dias: tuple,
+    repeticiones: int,
+    etapas: tuple,
+    con_pipeline: bool,
+    procesos: int = 0,
+) -> dict:
+    """{etapa: {segundos, pico_mb, filas, cm_por_seg, filas_por_seg}} de una escala."""
+    n_materiales = max(n_cm // n_centros, 1)
+    escenario = generar_escenario(n_centros, n_materiales, dias, consumo, stock_dias=stock_dias)
+    n_cm_real = len(escenario.stock)
+
+    resultados = {}
+    salidas_modos = {}
+    with tempfile.TemporaryDirectory(prefix="bench_planificador_") as directorio:
+        for nombre, fn, filas in _etapas(escenario, directorio if con_pipeline else None, procesos):
+            if nombre not in etapas:
+                # forecast → pedidos → restricciones → mínimos: cada una usa la salida de la anterior
+                posteriores = ENCADENADAS[ENCADENADAS.index(nombre) + 1:] if nombre in ENCADENADAS else ()
+                if any(e in etapas for e in posteriores):
+                    _silencioso(fn)
+                continue
+            segundos, pico, resultado = _medir(fn, repeticiones)
+            if nombre in MODOS_EQUIVALENTES or nombre == "iterativo":
+                salidas_modos[nombre] = resultado
+            n_filas = int(filas(resultado))
+            resultados[nombre] = {
+                "segundos": segundos,
+                "pico_mb": pico / 2 ** 20,
+                "filas": n_filas,
+                "cm_por_seg": n_cm_real / segundos if segundos > 0 else float("inf"),
+                "filas_por_seg": n_filas / segundos if segundos > 0 else float("inf"),
+            }
+            print(
+                f"  {nombre:<20}{segundos * 1000:11.1f} ms{pico / 2 ** 20:10.1f} MB"
+                f"{resultados[nombre]['cm_por_seg']:14,.0f} CM/s{n_filas:12,d} filas"
+            )
+    comprobar_modos_equivalentes(salidas_modos)
+    return resultados
+
+
+def comparar_con_baseline(resultados: dict, baseline: dict, tolerancia: float) -> list:
+    """Regresiones (texto) de tiempo o memoria por encima de baseline × (1 + tolerancia) + margen."""
+    regresiones = []
+    for escala, etapas in resultados.items():
+        for etapa, medida in etapas.items():
+            base = baseline.get("escalas", {}).get(escala, {}).get(etapa)
+            if base is None:
+                continue
+            for metrica, unidad in (("segundos", "s"), ("pico_mb", "MB")):
+                limite = base[metrica] * (1.0 + tolerancia) + MARGEN_ABSOLUTO[metrica]
+                if medida[metrica] > limite:
+                    regresiones.append(
+                        f"{escala}/{etapa}: {metrica} {medida[metrica]:.3f} {unidad} > "
+                        f"{limite:.3f} {unidad} (baseline {base[metrica]:.3f})"
+                    )
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a escala sintética del motor de planificación V2")
+    parser.add_argument("--escalas", default="1k,10k,100k", help="nº de CM por escala, p. ej. 1k,10k,100k")
+    parser.add_argument("--centros", type=int, default=len(CENTROS_BASE))
+    parser.add_argument("--dias", type=int, default=60)
+    parser.add_argument("--consumo", choices=DISTRIBUCIONES_CONSUMO, default="gamma")
+    parser.add_argument("--stock-dias", type=float, nargs=2, default=(-2.0, 20.0), metavar=("MIN", "MAX"))
+    parser.add_argument("--repeticiones", type=int, default=3)
+    parser.add_argument("--etapas", default=",".join(ETAPAS))
+    parser.add_argument("--sin-pipeline", action="store_true", help="no medir el pipeline completo (requiere duckdb)")
+    parser.add_argument("--procesos", type=int, default=os.cpu_count() or 1,
+                        help="procesos de las etapas *_paralelo (1 = no medirlas)")
+    parser.add_argument("--baseline", default=BASELINE_POR_DEFECTO)
+    parser.add_argument("--guardar-baseline", action="store_true")
+    parser.add_argument("--tolerancia", type=float, default=0.30, help="empeoramiento admitido (0.30 = 30 %%)")
+    parser.add_argument("--json", help="guardar también los resultados en este fichero")
+    args = parser.parse_args()
+
+    etapas = tuple(e.strip() for e in args.etapas.split(",") if e.strip())
+    desconocidas = set(etapas) - set(ETAPAS)
+    if desconocidas:
+        parser.error(f"etapas no soportadas: {sorted(desconocidas)}. Opciones: {ETAPAS}")
+
+    con_pipeline = "pipeline" in etapas and not args.sin_pipeline
+    if con_pipeline:
+        try:
+            import duckdb  # noqa: F401
+        except ImportError:
+            print("⚠ duckdb no instalado: se omite la etapa pipeline (pip install duckdb)")
+            con_pipeline = False
+
+    resultados = {}
+    for escala in args.escalas.split(","):
+        n_cm = _parsear_escala(escala)
+        print(f"\nEscala {escala.strip()} ({n_cm} CM, {args.centros} centros, {args.dias} días, consumo {args.consumo})")
+        resultados[escala.strip()] = ejecutar_escala(
+            n_cm, args.centros, args.dias, args.consumo, tuple(args.stock_dias),
+            args.repeticiones, etapas, con_pipeline, args.procesos,
+        )
+
+    informe = {
+        "meta": {
+            "fecha": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "maquina": platform.node(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "centros": args.centros,
+            "dias": args.dias,
+            "consumo": args.consumo,
+            "stock_dias": list(args.stock_dias),
+            "procesos": args.procesos,
+        },
+        "escalas": resultados,
+    }
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(informe, f, indent=2)
+
+    if args.guardar_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(informe, f, indent=2)
+        print(f"\n💾 Baseline guardado en {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"\n⚠ Sin baseline en {args.baseline}: ejecutar con --guardar-baseline para crearlo")
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regresiones = comparar_con_baseline(resultados, baseline, args.tolerancia)
+    if regresiones:
+        print(f"\n❌ Regresiones frente a {args.baseline} (tolerancia {args.tolerancia:.0%}):")
+        for r in regresiones:
+            print(f"   {r}")
+        sys.exit(1)
+    print(f"\n✅ Sin regresiones frente a {args.baseline} (tolerancia {args.tolerancia:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# ============================================================
+# Micro-benchmark: ajustar_pedidos_por_restricciones_logisticas_v2
+# Versión columnar frente a la referencia fila a fila (iterrows).
+#
+#   python -m benchmarks.bench_restricciones_logisticas [--pedidos 10000] [--repeticiones 5]
+# ============================================================
+
+import argparse
+import time
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from parametros_cm import ParametrosCM
+from funciones_stg import ajustar_pedidos_por_restricciones_logisticas_v2
+
+
+def ajustar_filas(
+    pedidos_df: pd.DataFrame,
+    dia_corte: int,
+    consumo_diario: dict,
+    dias_stock_objetivo: dict,
+    fecha_inicio: date
+):
+    """
+    Referencia fila a fila (iterrows) de ajustar_pedidos_por_restricciones_logisticas_v2,
+    la implementación anterior a la versión columnar, para validarla y medirla.
+    """
+    if pedidos_df.empty:
+        return pedidos_df
+
+    pedidos = pedidos_df.copy()
+
+    dia_hoy = (date.today() - fecha_inicio).days
+    dows = (fecha_inicio.weekday() + pedidos["Dia_Rotura"].to_numpy(dtype=np.int64)) % 7
+    nuevas_filas = []
+
+    for (_, row), dow in zip(pedidos.iterrows(), dows):
+        centro   = row["Centro"]
+        material = row["Material"]
+
+        consumo  = consumo_diario.get((centro, material))
+        dias_obj = dias_stock_objetivo.get((centro, material))
+
+        if consumo is None or dias_obj is None:
+            nuevas_filas.append(row)
+            continue
+
+        dia_rotura = row["Dia_Rotura"]
+
+        # Caso donde NO adelanta
+        if dow >= dia_corte:
+            nuevas_filas.append(row)
+            continue
+
+        # Adelanto
+        dias_retro = dow + 5
+        nuevo_dia = dia_rotura - dias_retro
+
+        if nuevo_dia < dia_hoy:
+            nuevo_dia = dia_hoy
+
+        dias_adelantados = row["Dia_Carga"] - nuevo_dia
+        dias_reales = max(1, dias_obj - dias_adelantados)
+
+        nueva_cantidad = consumo * dias_reales
+
+        final_row = row.copy()
+        final_row["Dia_Carga"]   = nuevo_dia
+        final_row["Dia_Entrega"] = nuevo_dia
+        final_row["Cantidad"]    = nueva_cantidad
+        # Mantener comentarios previos si existieran
+        prev = final_row.get("Comentarios", "")
+        nuevo = ""
+
+        if prev:
+            final_row["Comentarios"] = prev + " • " + nuevo
+        else:
+            final_row["Comentarios"] = nuevo
+
+
+        nuevas_filas.append(final_row)
+
+    return pd.DataFrame(nuevas_filas)
+
+
+def generar_pedidos(n_pedidos: int, semilla: int = 0):
+    """Pedidos sintéticos sobre el eje de días + diccionarios de consumo/objetivo y su tabla ParametrosCM."""
+    rng = np.random.default_rng(semilla)
+    centros = rng.choice(["0801", "2801", "2901", "4601", "1009"], n_pedidos)
+    materiales = rng.integers(100000, 100000 + n_pedidos // 4 + 1, n_pedidos)
+    dia_rotura = rng.integers(0, 60, n_pedidos)
+    dia_carga = np.maximum(dia_rotura - rng.integers(0, 6, n_pedidos), 0)
+
+    pedidos = pd.DataFrame({
+        "Centro": centros,
+        "Material": materiales,
+        "Dia_Carga": dia_carga,
+        "Dia_Entrega": dia_carga,
+        "Cantidad": rng.integers(1, 500, n_pedidos),
+        "Dia_Rotura": dia_rotura,
+        "Comentarios": "",
+    })
+
+    claves = set(zip(centros, materiales))
+    consumo_diario = {k: float(rng.gamma(1.5, 6.0)) for k in claves}
+    dias_stock_objetivo = {k: int(rng.integers(7, 15)) for k in claves}
+
+    parametros = ParametrosCM.desde_dataframe(pd.DataFrame({
+        "Centro": [c for c, _ in consumo_diario],
+        "Material": [m for _, m in consumo_diario],
+        "consumo_diario": list(consumo_diario.values()),
+        "dias_stock_objetivo": [dias_stock_objetivo[k] for k in consumo_diario],
+    }))
+    return pedidos, consumo_diario, dias_stock_objetivo, parametros
+
+
+def _mejor_tiempo(fn, repeticiones: int) -> float:
+    tiempos = []
+    for _ in range(repeticiones):
+        t0 = time.perf_counter()
+        fn()
+        tiempos.append(time.perf_counter() - t0)
+    return min(tiempos)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark de ajustar_pedidos_por_restricciones_logisticas_v2")
+    parser.add_argument("--pedidos", type=int, default=10_000)
+    parser.add_argument("--repeticiones", type=int, default=5)
+    args = parser.parse_args()
+
+    pedidos, consumo, objetivo, parametros = generar_pedidos(args.pedidos)
+    fecha_inicio = date.today()
+
+    def filas():
+        return ajustar_filas(pedidos, 2, consumo, objetivo, fecha_inicio)
+
+    def columnar():
+        return ajustar_pedidos_por_restricciones_logisticas_v2(pedidos, 2, parametros, fecha_inicio)
+
+    pd.testing.assert_frame_equal(filas(), columnar())
+
+    t_filas = _mejor_tiempo(filas, args.repeticiones)
+    t_columnar = _mejor_tiempo(columnar, args.repeticiones)
+
+    print(f"Pedidos: {args.pedidos}")
+    print(f"  fila a fila : {t_filas * 1000:9.1f} ms")
+    print(f"  columnar    : {t_columnar * 1000:9.1f} ms")
+    print(f"  speedup     : {t_filas / t_columnar:9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
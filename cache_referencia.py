@@ -0,0 +1,223 @@
+# ============================================================
+# cache_referencia.py – Caché en proceso de tablas de referencia
+# ============================================================
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date, datetime, timezone
+
+import pandas as pd
+
+
+# Cada cuánto se revisa la marca de modificación de las tablas de una entrada (segundos)
+TTL_REFERENCIA_SEG = 15 * 60
+# Límites de tamaño: nº de entradas y memoria total (bytes) de los DataFrames cacheados
+MAX_ENTRADAS_REFERENCIA = 32
+MAX_BYTES_REFERENCIA = 512 * 1024 * 1024
+
+
+@dataclass
+class _Entrada:
+    df: pd.DataFrame
+    modificadas: dict
+    bytes: int
+    revisada: float
+
+
+class CacheReferencia:
+    """
+    Caché LRU de resultados de consultas sobre tablas maestras que cambian poco.
+
+    - Dentro del TTL se devuelve la entrada sin tocar la fuente de datos.
+    - Pasado el TTL se consulta solo la marca de modificación de las tablas (en BigQuery,
+      get_table: sin bytes facturados); la consulta se repite únicamente si alguna tabla
+      ha cambiado.
+    - Acotada en nº de entradas y en memoria: al superar cualquiera de los dos límites se
+      descartan las entradas menos usadas.
+    - Las peticiones concurrentes sobre la misma clave esperan a una única carga y reciben
+      el mismo DataFrame: es compartido, así que no se debe modificar in place.
+    """
+
+    def __init__(
+        self,
+        ttl_seg: float = TTL_REFERENCIA_SEG,
+        max_entradas: int = MAX_ENTRADAS_REFERENCIA,
+        max_bytes: int = MAX_BYTES_REFERENCIA,
+    ):
+        self.ttl_seg = ttl_seg
+        self.max_entradas = max_entradas
+        self.max_bytes = max_bytes
+        self._entradas: OrderedDict = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._locks_clave: dict = {}
+        self.aciertos = 0
+        self.revalidaciones = 0
+        self.cargas = 0
+
+    def obtener(self, fuente, clave, tablas, cargar) -> pd.DataFrame:
+        """
+        Devuelve el DataFrame cacheado para `clave` o lo carga con `cargar()`.
+        `tablas`: ids completos (proyecto.dataset.tabla) cuya modificación invalida la entrada.
+        """
+        with self._lock:
+            if len(self._locks_clave) > 4 * self.max_entradas:
+                # Las claves incluyen parámetros: purgar locks de entradas ya descartadas
+                self._locks_clave = {
+                    k: l for k, l in self._locks_clave.items() if k in self._entradas or l.locked()
+                }
+            lock_clave = self._locks_clave.setdefault(clave, threading.Lock())
+
+        with lock_clave:
+            ahora = time.monotonic()
+            with self._lock:
+                entrada = self._entradas.get(clave)
+                if entrada is not None:
+                    self._entradas.move_to_end(clave)
+                    if ahora - entrada.revisada < self.ttl_seg:
+                        self.aciertos += 1
+                        return entrada.df
+
+            modificadas = tablas_modificadas(fuente, tablas)
+
+            if entrada is not None and modificadas is not None and modificadas == entrada.modificadas:
+                with self._lock:
+                    entrada.revisada = ahora
+                    self.revalidaciones += 1
+                return entrada.df
+
+            df = cargar()
+            with self._lock:
+                self.cargas += 1
+                self._guardar(clave, _Entrada(
+                    df=df,
+                    modificadas=modificadas,
+                    bytes=int(df.memory_usage(deep=True).sum()),
+                    revisada=ahora,
+                ))
+            return df
+
+    def invalidar(self, clave=None):
+        """Descarta una entrada (o todas si clave es None)."""
+        with self._lock:
+            if clave is None:
+                self._entradas.clear()
+                self._bytes = 0
+            elif clave in self._entradas:
+                self._bytes -= self._entradas.pop(clave).bytes
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            return {
+                "entradas": len(self._entradas),
+                "bytes": self._bytes,
+                "aciertos": self.aciertos,
+                "revalidaciones": self.revalidaciones,
+                "cargas": self.cargas,
+            }
+
+    def _guardar(self, clave, entrada: _Entrada):
+        anterior = self._entradas.pop(clave, None)
+        if anterior is not None:
+            self._bytes -= anterior.bytes
+
+        # Un resultado que no cabe ni solo no se cachea
+        if entrada.bytes > self.max_bytes:
+            return
+
+        self._entradas[clave] = entrada
+        self._bytes += entrada.bytes
+        while len(self._entradas) > self.max_entradas or self._bytes > self.max_bytes:
+            _, descartada = self._entradas.popitem(last=False)
+            self._bytes -= descartada.bytes
+
+
+def tablas_modificadas(fuente, tablas) -> dict | None:
+    """{tabla: modificada} de las tablas; None si no se pudo leer algún metadato (se recarga)."""
+    try:
+        return {t: fuente.modificada(t) for t in tablas}
+    except Exception as e:
+        print(f"⚠ No se pudo leer la modificación de {tablas}: {e}")
+        return None
+
+
+def hoy_bigquery() -> date:
+    """Fecha de CURRENT_DATE() en BigQuery (UTC), que es lo que fija los resultados diarios."""
+    return datetime.now(timezone.utc).date()
+
+
+class MemoDiaria:
+    """
+    Memoización de resultados que solo dependen de la clave y del día (CURRENT_DATE).
+
+    - En proceso: un DataFrame por clave, compartido (no modificar in place). Al cambiar
+      el día se descartan las entradas del anterior.
+    - Opcionalmente en disco (`directorio`): un Parquet por día y clave, para que otros
+      procesos / reinicios del mismo día no repitan la consulta.
+    - Peticiones concurrentes sobre la misma clave esperan a una única carga.
+    """
+
+    def __init__(self, nombre: str, directorio: str | None = None):
+        self.nombre = nombre
+        self.directorio = directorio
+        self._dia = None
+        self._entradas: dict = {}
+        self._lock = threading.Lock()
+        self._locks_clave: dict = {}
+
+    def obtener(self, clave: tuple, cargar) -> pd.DataFrame:
+        dia = hoy_bigquery()
+        with self._lock:
+            if dia != self._dia:
+                self._dia = dia
+                self._entradas.clear()
+                self._locks_clave.clear()
+            lock_clave = self._locks_clave.setdefault(clave, threading.Lock())
+
+        with lock_clave:
+            with self._lock:
+                df = self._entradas.get(clave)
+            if df is not None:
+                return df
+
+            ruta = self._ruta(dia, clave)
+            if ruta is not None and os.path.exists(ruta):
+                df = pd.read_parquet(ruta)
+            else:
+                df = cargar()
+                if ruta is not None:
+                    self._escribir(df, ruta)
+
+            with self._lock:
+                if dia == self._dia:
+                    self._entradas[clave] = df
+            return df
+
+    def invalidar(self):
+        with self._lock:
+            self._entradas.clear()
+
+    def _ruta(self, dia: date, clave: tuple) -> str | None:
+        if not self.directorio:
+            return None
+        firma = hashlib.sha1(repr(clave).encode()).hexdigest()[:16]
+        return os.path.join(self.directorio, f"{self.nombre}_{dia.isoformat()}_{firma}.parquet")
+
+    @staticmethod
+    def _escribir(df: pd.DataFrame, ruta: str):
+        # Escritura atómica: otro proceso nunca ve un Parquet a medias
+        try:
+            os.makedirs(os.path.dirname(ruta), exist_ok=True)
+            tmp = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+            df.to_parquet(tmp, index=False)
+            os.replace(tmp, ruta)
+        except Exception as e:
+            print(f"⚠ No se pudo guardar {ruta}: {e}")
+
+
+# Instancia compartida por el proceso
+CACHE_REFERENCIA = CacheReferencia()
@@ -0,0 +1,146 @@
+# ============================================================
+# cache_resultados.py – Caché de respuestas completas de /planificar_v2
+# ============================================================
+#
+# Planificadores y Sheets refrescan /planificar_v2 una y otra vez con los mismos parámetros.
+# Mientras los datos de entrada no cambian, el plan es el mismo: se guarda la respuesta por
+# (fuente, día del plan, parámetros) junto con la versión de los datos (marca de modificación
+# de las tablas que se actualizan durante el día) y las peticiones idénticas simultáneas
+# esperan a un único cálculo.
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from datetime import date, datetime, timezone
+
+from cache_referencia import tablas_modificadas
+
+
+# Dentro de esta ventana (segundos) se responde sin tocar la fuente de datos; pasada, se
+# revisa la versión de los datos y solo se recalcula si ha cambiado
+FRESCURA_RESULTADOS_SEG = float(os.getenv("PLANIFICADOR_CACHE_RESULTADOS_SEG", "300"))
+MAX_ENTRADAS_RESULTADOS = 16
+
+
+@dataclass
+class _Resultado:
+    valor: object
+    version: dict | None
+    calculado: float       # time.time() del cálculo
+    revisado: float        # time.monotonic() de la última validación
+
+
+class CacheResultados:
+    """
+    Caché LRU de resultados calculados con single-flight:
+
+    - Dentro de la ventana de frescura se devuelve la entrada sin consultar nada.
+    - Pasada la ventana se lee la marca de modificación de `tablas` (get_table en BigQuery,
+      sin bytes facturados); si no ha cambiado se revalida la entrada, si no se recalcula.
+    - Peticiones concurrentes con la misma clave comparten un único cálculo en curso (y su
+      error, si falla). `refrescar=True` ignora la entrada guardada pero se une a un cálculo
+      que ya esté en curso, que es igual de reciente.
+    - El resultado es compartido entre peticiones: no se debe modificar in place.
+    """
+
+    def __init__(self, frescura_seg: float = FRESCURA_RESULTADOS_SEG, max_entradas: int = MAX_ENTRADAS_RESULTADOS):
+        self.frescura_seg = frescura_seg
+        self.max_entradas = max_entradas
+        self._entradas: OrderedDict = OrderedDict()
+        self._en_curso: dict = {}
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.revalidaciones = 0
+        self.compartidas = 0
+        self.calculos = 0
+
+    def obtener(self, fuente, clave: tuple, tablas, calcular, refrescar: bool = False) -> tuple:
+        """
+        Devuelve (resultado, info) para `clave`, calculándolo con `calcular()` si hace falta.
+        La clave se completa con la fuente y el día (el plan empieza en date.today()).
+        `info`: estado (acierto | revalidado | compartido | calculado), fecha y edad del cálculo.
+        """
+        clave = (fuente.id, date.today().isoformat(), *clave)
+
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is not None and not refrescar and time.monotonic() - entrada.revisado < self.frescura_seg:
+                self._entradas.move_to_end(clave)
+                self.aciertos += 1
+                return entrada.valor, _info("acierto", entrada)
+
+            futuro = self._en_curso.get(clave)
+            propio = futuro is None
+            if propio:
+                futuro = self._en_curso[clave] = Future()
+            else:
+                self.compartidas += 1
+
+        if not propio:
+            valor, info = futuro.result()
+            return valor, {**info, "estado": "compartido"}
+
+        try:
+            resultado = self._resolver(fuente, clave, tablas, calcular, None if refrescar else entrada)
+        except BaseException as e:
+            with self._lock:
+                self._en_curso.pop(clave, None)
+            futuro.set_exception(e)
+            raise
+
+        with self._lock:
+            self._en_curso.pop(clave, None)
+        futuro.set_result(resultado)
+        return resultado
+
+    def invalidar(self):
+        with self._lock:
+            self._entradas.clear()
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            return {
+                "entradas": len(self._entradas),
+                "en_curso": len(self._en_curso),
+                "aciertos": self.aciertos,
+                "revalidaciones": self.revalidaciones,
+                "compartidas": self.compartidas,
+                "calculos": self.calculos,
+            }
+
+    def _resolver(self, fuente, clave, tablas, calcular, entrada: _Resultado | None) -> tuple:
+        # La versión se lee antes de calcular: si los datos cambian durante el cálculo, la
+        # siguiente revalidación ve otra versión y recalcula
+        version = tablas_modificadas(fuente, tablas)
+
+        if entrada is not None and version is not None and version == entrada.version:
+            with self._lock:
+                entrada.revisado = time.monotonic()
+                self.revalidaciones += 1
+                if clave in self._entradas:
+                    self._entradas.move_to_end(clave)
+            return entrada.valor, _info("revalidado", entrada)
+
+        entrada = _Resultado(valor=calcular(), version=version, calculado=time.time(), revisado=time.monotonic())
+        with self._lock:
+            self.calculos += 1
+            self._entradas.pop(clave, None)
+            self._entradas[clave] = entrada
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+        return entrada.valor, _info("calculado", entrada)
+
+
+def _info(estado: str, entrada: _Resultado) -> dict:
+    return {
+        "estado": estado,
+        "calculado": datetime.fromtimestamp(entrada.calculado, timezone.utc).isoformat(timespec="seconds"),
+        "edad_seg": round(time.time() - entrada.calculado, 3),
+    }
+
+
+# Instancia compartida por el proceso
+CACHE_RESULTADOS = CacheResultados()
@@ -1,4 +1,13 @@
-from google.cloud import bigquery
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from cache_referencia import CACHE_REFERENCIA, MemoDiaria
+from fuente_datos import FuenteDatos, fuente_por_defecto
+from parametros_cm import construir_parametros_cm
 
 PROJECT_ID = "business-intelligence-444511"
 
@@ -10,21 +19,94 @@ def _sql_proveedor_filter(alias: str, proveedor_id: int | None) -> str:
 
 
 
-def generar_filtro_cm(client, proveedor_id: int | None = None, centro: str | None = None):
+# Directorio opcional para persistir en disco las memos diarias (filtro CM, último proveedor)
+DIR_MEMO_DIARIA = os.getenv("PLANIFICADOR_MEMO_DIR") or None
+
+MEMO_FILTRO_CM = MemoDiaria("filtro_cm", DIR_MEMO_DIARIA)
+MEMO_ULTIMO_PROVEEDOR = MemoDiaria("ultimo_proveedor", DIR_MEMO_DIARIA)
+
+
+def indice_ultimo_proveedor(fuente: FuenteDatos) -> pd.DataFrame:
+    """
+    Proveedor más reciente de cada Material en stg_ME2L (por Fecha_Pedido, Pedido, Posicion).
+    Se calcula una vez al día y se reutiliza para todos los centros / peticiones.
+    Devuelve Material, Proveedor (un registro por Material).
+    """
+    sql = f"""
+    SELECT
+      CAST(Material AS INT64) AS Material,
+      CAST(Proveedor AS INT64) AS Proveedor
+    FROM (
+      SELECT
+        Material,
+        Proveedor,
+        Fecha_Pedido,
+        Pedido,
+        Posicion,
+        ROW_NUMBER() OVER (
+          PARTITION BY Material
+          ORDER BY Fecha_Pedido DESC, Pedido DESC, Posicion DESC
+        ) AS rn
+      FROM `{PROJECT_ID}.granier_staging.stg_ME2L`
+      WHERE Material IS NOT NULL
+        AND Proveedor IS NOT NULL
+        AND Material != 30226
+    )
+    WHERE rn = 1
+    """
+    return MEMO_ULTIMO_PROVEEDOR.obtener(
+        (fuente.id,),
+        lambda: fuente.consulta_df(sql, tipos={"Material": "Int64", "Proveedor": "Int64"}),
+    )
+
+
+def generar_filtro_cm(fuente: FuenteDatos, proveedor_id: int | None = None, centro: str | None = None):
     """
     Devuelve un DataFrame con las parejas Centro–Material activas hoy.
 
     - Si `proveedor_id` viene informado, filtra el universo por proveedor.
     - Si `proveedor_id` viene vacío o None, construye el universo completo
       y resuelve un proveedor por Material usando el proveedor más reciente
-      de stg_ME2L según Fecha_Pedido.
+      de stg_ME2L según Fecha_Pedido (indice_ultimo_proveedor).
     - Si `centro` viene informado, filtra solo ese centro.
+
+    El resultado solo depende de (proveedor, centro, CURRENT_DATE): se memoiza por día en
+    proceso (y en disco si PLANIFICADOR_MEMO_DIR está definido). Es compartido: no
+    modificar in place.
+    """
+    centro = str(centro).strip() if centro is not None and str(centro).strip() != "" else None
+    proveedor_id = int(proveedor_id) if proveedor_id is not None else None
+
+    return MEMO_FILTRO_CM.obtener(
+        (fuente.id, proveedor_id, centro),
+        lambda: _consultar_filtro_cm(fuente, proveedor_id, centro),
+    )
+
+
+def generar_filtro_cm_lote(fuente: FuenteDatos, proveedores, centro: str | None = None) -> pd.DataFrame:
+    """
+    Universo CM de varios proveedores en una sola consulta: las filas con Proveedor == p son
+    las de generar_filtro_cm(fuente, p, centro). Un mismo Centro–Material puede aparecer con
+    varios proveedores. Memoizado por día como generar_filtro_cm (no modificar in place).
     """
+    centro = str(centro).strip() if centro is not None and str(centro).strip() != "" else None
+    proveedores = tuple(sorted({int(p) for p in proveedores}))
 
+    return MEMO_FILTRO_CM.obtener(
+        (fuente.id, ("lote",) + proveedores, centro),
+        lambda: _consultar_filtro_cm(fuente, None, centro, proveedores=proveedores),
+    )
+
+
+def _consultar_filtro_cm(
+    fuente: FuenteDatos,
+    proveedor_id: int | None,
+    centro: str | None,
+    proveedores: tuple | None = None
+) -> pd.DataFrame:
     centros_default = ["0801", "2801", "2901", "4601", "1009"]
 
-    if centro is not None and str(centro).strip() != "":
-        centro = str(centro).strip()
+    if centro is not None:
         filtro_centros_sql = f"= '{centro}'"
     else:
         centros_sql = ",".join([f"'{c}'" for c in centros_default])
@@ -33,8 +115,19 @@ def generar_filtro_cm(client, proveedor_id: int | None = None, centro: str | Non
     filtro_proveedor_me2l = _sql_proveedor_filter("m", proveedor_id)
     filtro_proveedor_pend = _sql_proveedor_filter("p", proveedor_id)
 
-    proveedor_select = str(int(proveedor_id)) if proveedor_id is not None else "lp.Proveedor"
-    proveedor_null_filter = "" if proveedor_id is not None else "AND lp.Proveedor IS NOT NULL"
+    proveedor_select = f", {int(proveedor_id)} AS Proveedor" if proveedor_id is not None else ""
+    proveedor_me2l = proveedor_pend = orden_proveedor = ""
+    parametros = None
+
+    if proveedores is not None:
+        # Lote: el proveedor forma parte del universo (un CM puede tener varios)
+        filtro_proveedor_me2l = "AND CAST(m.Proveedor AS INT64) IN UNNEST(@proveedores)"
+        filtro_proveedor_pend = "AND CAST(p.Proveedor AS INT64) IN UNNEST(@proveedores)"
+        proveedor_me2l = ",\n        CAST(m.Proveedor AS INT64) AS Proveedor"
+        proveedor_pend = ",\n        CAST(p.Proveedor AS INT64) AS Proveedor"
+        proveedor_select = ", u.Proveedor"
+        orden_proveedor = ", u.Proveedor"
+        parametros = {"proveedores": np.asarray(proveedores, dtype="int64")}
 
     sql = f"""
     WITH
@@ -47,7 +140,7 @@ def generar_filtro_cm(client, proveedor_id: int | None = None, centro: str | Non
     hist_me2l AS (
       SELECT DISTINCT
         CAST(m.Material AS INT64) AS Material,
-        CAST(m.Centro AS STRING)  AS Centro
+        CAST(m.Centro AS STRING)  AS Centro{proveedor_me2l}
       FROM `{PROJECT_ID}.granier_staging.stg_ME2L` m
       WHERE 1=1
         {filtro_proveedor_me2l}
@@ -58,7 +151,7 @@ def generar_filtro_cm(client, proveedor_id: int | None = None, centro: str | Non
     pendientes AS (
       SELECT DISTINCT
         CAST(p.Material AS INT64) AS Material,
-        CAST(p.Centro AS STRING)  AS Centro
+        CAST(p.Centro AS STRING)  AS Centro{proveedor_pend}
       FROM `{PROJECT_ID}.granier_logistica.Tbl_Pedidos_Pendientes` p
       WHERE 1=1
         {filtro_proveedor_pend}
@@ -79,84 +172,341 @@ def generar_filtro_cm(client, proveedor_id: int | None = None, centro: str | Non
       WHERE Fecha = CURRENT_DATE()
         AND Centro {filtro_centros_sql}
         AND Material != 30226
-    ),
-    latest_provider AS (
-      SELECT
-        CAST(Material AS INT64) AS Material,
-        CAST(Proveedor AS INT64) AS Proveedor
-      FROM (
-        SELECT
-          Material,
-          Proveedor,
-          Fecha_Pedido,
-          Pedido,
-          Posicion,
-          ROW_NUMBER() OVER (
-            PARTITION BY Material
-            ORDER BY Fecha_Pedido DESC, Pedido DESC, Posicion DESC
-          ) AS rn
-        FROM `{PROJECT_ID}.granier_staging.stg_ME2L`
-        WHERE Material IS NOT NULL
-          AND Proveedor IS NOT NULL
-          AND Material != 30226
-      )
-      WHERE rn = 1
     )
     SELECT DISTINCT
       u.Centro,
-      u.Material,
-      {proveedor_select} AS Proveedor
+      u.Material
+      {proveedor_select}
     FROM union_all u
     JOIN zlo z USING (Centro, Material)
     LEFT JOIN excluidos e USING (Centro, Material)
-    LEFT JOIN latest_provider lp USING (Material)
     WHERE e.Material IS NULL
-      {proveedor_null_filter}
-    ORDER BY u.Centro, u.Material
+    ORDER BY u.Centro, u.Material{orden_proveedor}
     """
 
-    return client.query(sql).to_dataframe()
+    df_cm = fuente.consulta_df(
+        sql, parametros, tipos={"Centro": "string", "Material": "Int64", "Proveedor": "Int64"}
+    )
+
+    if proveedor_id is not None or proveedores is not None:
+        return df_cm
+
+    # Sin proveedor: cada Material con su proveedor más reciente (los que no tienen, fuera)
+    return (
+        df_cm.merge(indice_ultimo_proveedor(fuente), on="Material", how="inner")
+        .sort_values(["Centro", "Material"], kind="stable")
+        .reset_index(drop=True)
+    )
+
 
+def parametro_universo_cm(df_cm, con_proveedor: bool = True) -> pd.DataFrame:
+    """
+    Universo CM como valor de parámetro: tabla Centro STRING, Material INT64[, Proveedor INT64]
+    (en BigQuery, ARRAY<STRUCT<...>>). Las consultas lo leen con UNNEST(@cm): el texto SQL
+    no crece con el universo y BigQuery puede reutilizar la compilación / caché entre
+    peticiones.
+    """
+    universo = pd.DataFrame({
+        "Centro": df_cm["Centro"].astype(str).to_numpy(dtype=object),
+        "Material": df_cm["Material"].astype("int64").to_numpy(),
+    })
+    if con_proveedor:
+        universo["Proveedor"] = df_cm["Proveedor"].astype("int64").to_numpy()
+    return universo
+
+
+def parametro_materiales(materiales) -> np.ndarray:
+    """Materiales en alcance como valor de parámetro ARRAY<INT64> (ordenados y sin duplicados)."""
+    return np.unique(pd.to_numeric(pd.Series(materiales), errors="coerce").dropna().astype("int64").to_numpy())
+
+
+# Consultas BigQuery lanzadas a la vez en cargar_datos_reales
+MAX_CONSULTAS_CONCURRENTES = 8
+
+# dtypes destino de cada consulta (se castean en Arrow al descargar)
+TIPOS_CM = {"Centro": "string", "Material": "Int64"}
+TIPOS_STOCK = {**TIPOS_CM, "Proveedor": "Int64", "Stock_Actual": "float64", "Stock": "float64"}
+TIPOS_CMD = {**TIPOS_CM, "CMD_SAP": "float64", "CMD_Ajustado_Final": "float64", "cantidad_min_fabricacion": "float64"}
+TIPOS_ROTACION = {**TIPOS_CM, "cajas_cap": "float64", "cajas_pal": "float64",
+                  "dias_stock_cap": "float64", "dias_stock_pal": "float64"}
+TIPOS_MINIMOS = {"Material": "Int64", "Cajas_capa": "float64", "Cajas_palet": "float64"}
+# Master_Logistica: los días objetivo / seguridad vienen tal cual (pueden traer decimales o
+# texto) y se convierten con to_numeric(errors="coerce") al montar los parámetros
+TIPOS_OBJ = {"Centro": "string"}
+TIPOS_FABR = {"Material": "Int64", "Stock": "float64"}
+TIPOS_PRECIO = {**TIPOS_CM, "Precio_estandar_PMV": "float64"}
+
+# Tablas que leen los cargadores y el pipeline V2 (p. ej. para copiarlas a un snapshot local)
+TABLAS_ENTRADA = tuple(f"{PROJECT_ID}.{t}" for t in (
+    "granier_staging.stg_ME2L",
+    "granier_staging.stg_ZLO12",
+    "granier_logistica.Tbl_excluidos_flujo_comercializado",
+    "granier_logistica.Tbl_Pedidos_Pendientes",
+    "granier_logistica.Tbl_Roturas_Proveedor",
+    "granier_logistica.ZLO12_STREAMING_CURRENT",
+    "granier_logistica.v_ZLO12_curado",
+    "granier_logistica.Master_Logistica",
+    "granier_logistica.Master_Pedidos_Min",
+    "granier_logistica.Stock_Dias_CAP_PAL",
+    "granier_logistica.Tbl_Produccion_Parmetros",
+    "granier_maestros.Master_Articulos_Centro",
+    "granier_maestros.Master_ArticulosSAP",
+))
+
+# Tablas que cambian durante el día (stock en streaming, pendientes): su marca de modificación
+# es la versión de los datos de un plan. El resto cambia como mucho a diario (memos diarias).
+TABLAS_VERSION_DATOS = tuple(f"{PROJECT_ID}.{t}" for t in (
+    "granier_logistica.ZLO12_STREAMING_CURRENT",
+    "granier_logistica.Tbl_Pedidos_Pendientes",
+))
+
+# Conjuntos que el pipeline V2 no usa: solo se cargan si se piden en `datasets_extra`
+DATASETS_EXTRA = ("stock_fabrica", "produccion", "precio_pmv")
+
+
+def _cronometrar(fn, *args, **kwargs):
+    """Ejecuta fn y devuelve (resultado, segundos)."""
+    t0 = time.perf_counter()
+    resultado = fn(*args, **kwargs)
+    return resultado, time.perf_counter() - t0
+
+
+def _clave_parametros(parametros: dict | None) -> tuple:
+    """Clave hashable con el nombre y valor(es) de cada parámetro (escalar, array o tabla)."""
+    if not parametros:
+        return ()
+    clave = []
+    for nombre, valor in sorted(parametros.items()):
+        if isinstance(valor, pd.DataFrame):
+            valor = tuple(valor.itertuples(index=False, name=None))
+        elif isinstance(valor, (list, tuple, np.ndarray, pd.Series, pd.Index)):
+            valor = tuple(np.asarray(valor).tolist())
+        clave.append((nombre, valor))
+    return tuple(clave)
+
+
+def consulta_referencia(
+    fuente: FuenteDatos,
+    tabla: str,
+    sql: str,
+    parametros: dict | None = None,
+    tipos: dict | None = None,
+    materiales=None
+) -> pd.DataFrame:
+    """
+    Consulta sobre una tabla maestra que cambia poco, servida desde CACHE_REFERENCIA:
+    solo se relanza si cambia el `modified` de `tabla`. La clave incluye los parámetros.
+
+    Con `materiales`, `sql` lee la tabla entera (una sola entrada de caché para todos los
+    universos CM) y el resultado se filtra aquí a esos materiales. Sin `materiales` el
+    DataFrame es el compartido entre peticiones: no modificar in place.
+    """
+    df = CACHE_REFERENCIA.obtener(
+        fuente,
+        clave=(fuente.id, sql, _clave_parametros(parametros)),
+        tablas=[tabla],
+        cargar=lambda: fuente.consulta_df(sql, parametros, tipos),
+    )
+    if materiales is None:
+        return df
+    return df[df["Material"].isin(materiales)].reset_index(drop=True)
 
 
 def cargar_datos_reales(
     proveedor_id: int | None = None,
     consumo_extra_pct: float = 0.0,
     centro: str | None = None,
-    fecha_corte: str | None = None
+    fecha_corte: str | None = None,
+    datasets_extra: tuple = (),
+    fuente: FuenteDatos | None = None
 ):
-    print("📥 get datos BQ (V2, ZLO12 curado)...")
-
-    client = bigquery.Client()
+    """
+    Carga stock y parámetros V2 desde `fuente` (por defecto fuente_por_defecto(): BigQuery,
+    o snapshots locales con PLANIFICADOR_FUENTE=local).
+
+    Solo se consulta lo que usa el pipeline V2; `datasets_extra` añade cualquiera de
+    DATASETS_EXTRA (stock_fabrica, produccion → puesto_trabajo / grupo_de_fabr, precio_pmv).
+    Las consultas por material se restringen a los materiales del universo CM (@materiales;
+    los maestros cacheados se leen enteros y se filtran en pandas).
+
+    Las tablas maestras salen de CACHE_REFERENCIA. Las consultas independientes se lanzan
+    como jobs concurrentes en un pool de hilos:
+      1) en cuanto empieza: filtro CM + Master_Logistica
+      2) en cuanto hay universo CM: stock, CMD, rotación, mínimos y los extras pedidos
+    La latencia queda acotada por la consulta más lenta de cada fase. Los tiempos por
+    consulta (segundos) y sus filas se devuelven en datos["tiempos_carga"] / datos["filas_carga"].
+    """
+    _validar_datasets_extra(datasets_extra)
 
+    fuente = fuente or fuente_por_defecto()
+    print(f"📥 get datos {fuente.id} (V2, ZLO12 curado)...")
     print(f"   → Generando filtro CM dinámico para proveedor {proveedor_id}...")
-    df_cm = generar_filtro_cm(client, proveedor_id, centro=centro)
 
-    if df_cm.empty:
-        proveedor_txt = "TODOS" if proveedor_id is None else str(proveedor_id)
-        raise ValueError(f"No se encontraron materiales para proveedor {proveedor_txt}")
+    df_cm, resultados, tiempos_carga, filas_carga = _cargar_consultas(
+        fuente,
+        lambda: generar_filtro_cm(fuente, proveedor_id, centro=centro),
+        "TODOS" if proveedor_id is None else str(proveedor_id),
+        fecha_corte,
+        datasets_extra
+    )
+    return _montar_datos(df_cm, resultados, tiempos_carga, filas_carga, consumo_extra_pct)
 
-    pares = [(row["Centro"], row["Material"], row["Proveedor"]) for _, row in df_cm.iterrows()]
 
-    cm_structs = ",\n        ".join(
-        [f"STRUCT('{c}' AS Centro, {m} AS Material, {int(p)} AS Proveedor)" for c, m, p in pares]
+def cargar_datos_lote(
+    proveedores,
+    consumo_extra_pct: float = 0.0,
+    centro: str | None = None,
+    fecha_corte: str | None = None,
+    datasets_extra: tuple = (),
+    fuente: FuenteDatos | None = None
+) -> tuple[dict, dict]:
+    """
+    cargar_datos_reales para varios proveedores con una sola tanda de consultas sobre la
+    unión de sus universos CM (generar_filtro_cm_lote). Cada proveedor recibe su partición:
+    su universo CM y su stock (pendientes y roturas se cuentan por proveedor); CMD,
+    rotación, mínimos y maestros se comparten.
+
+    Devuelve ({proveedor: datos}, {proveedor: motivo}): el segundo con los proveedores sin
+    universo CM o sin stock, que no impiden planificar el resto. `tiempos_carga` y
+    `filas_carga` de cada datos son los de la carga compartida.
+    """
+    _validar_datasets_extra(datasets_extra)
+    proveedores = list(dict.fromkeys(int(p) for p in proveedores))
+    if not proveedores:
+        raise ValueError("Hace falta al menos un proveedor")
+
+    fuente = fuente or fuente_por_defecto()
+    print(f"📥 get datos {fuente.id} (V2 lote, {len(proveedores)} proveedores)...")
+    print(f"   → Generando filtro CM dinámico para proveedores {proveedores}...")
+
+    df_cm, resultados, tiempos_carga, filas_carga = _cargar_consultas(
+        fuente,
+        lambda: generar_filtro_cm_lote(fuente, proveedores, centro=centro),
+        ", ".join(map(str, proveedores)),
+        fecha_corte,
+        datasets_extra
     )
 
-    print("   → Cargando stock (ZLO12 + pendientes - roturas)...")
+    cm_por_proveedor = dict(tuple(df_cm.groupby("Proveedor", sort=False)))
+    stock_por_proveedor = dict(tuple(resultados["stock"].groupby("Proveedor", sort=False)))
+
+    datos_por_proveedor = {}
+    errores = {}
+    for proveedor in proveedores:
+        df_cm_p = cm_por_proveedor.get(proveedor)
+        if df_cm_p is None:
+            errores[proveedor] = f"No se encontraron materiales para proveedor {proveedor}"
+            continue
+        resultados_p = {
+            **resultados,
+            "stock": stock_por_proveedor.get(proveedor, resultados["stock"].iloc[:0]).reset_index(drop=True),
+        }
+        try:
+            datos_por_proveedor[proveedor] = _montar_datos(
+                df_cm_p.reset_index(drop=True), resultados_p, tiempos_carga, filas_carga, consumo_extra_pct
+            )
+        except ValueError as e:
+            errores[proveedor] = str(e)
+
+    return datos_por_proveedor, errores
+
+
+def _validar_datasets_extra(datasets_extra):
+    desconocidos = set(datasets_extra) - set(DATASETS_EXTRA)
+    if desconocidos:
+        raise ValueError(f"datasets_extra no soportados: {sorted(desconocidos)}. Opciones: {DATASETS_EXTRA}")
+
+
+def _cargar_consultas(fuente: FuenteDatos, universo, descripcion: str, fecha_corte, datasets_extra):
+    """
+    Lanza las consultas de carga: `universo()` (filtro CM) + Master_Logistica y, con el
+    universo, stock, CMD, rotación, mínimos y extras. Devuelve (df_cm, resultados,
+    tiempos_carga, filas_carga).
+    """
+    t_inicio = time.perf_counter()
+
+    sql_fabr = f"""
+    SELECT
+      Material,
+      Stock
+    FROM `{PROJECT_ID}.granier_logistica.v_ZLO12_curado`
+    WHERE Centro = '1004'
+      AND Material IN UNNEST(@materiales)
+    """
+
+    # Maestros cacheados enteros (consulta_referencia filtra a los materiales del universo)
+    sql_param = f"""
+    SELECT
+      SAFE_CAST(Material AS INT64) AS Material,
+      Puesto_de_trabajo,
+      Un_Hora,
+      ` StockObj_Dias`,
+      ` Grupo_de_Fabr`
+    FROM `{PROJECT_ID}.granier_logistica.Tbl_Produccion_Parmetros`
+    WHERE SAFE_CAST(Material AS INT64) IS NOT NULL
+    """
+
+    sql_obj = f"""
+    SELECT
+      centro AS Centro,
+      stock_objetivo AS Dias_Stock_Objetivo,
+      stock_seguridad AS Dias_Stock_Seguridad
+    FROM `{PROJECT_ID}.granier_logistica.Master_Logistica`
+    WHERE centro_suministrador = '1004'
+    """
+
+    sql_minimos = f"""
+    SELECT
+      CAST(Material AS INT64) AS Material,
+      Cajas_capa,
+      Cajas_palet
+    FROM `{PROJECT_ID}.granier_logistica.Master_Pedidos_Min`
+    """
+
+    sql_precio = f"""
+    SELECT 
+        CAST(Material AS INT64) AS Material,
+        CAST(Centro AS STRING) AS Centro,
+        Precio_estandar_PMV
+    FROM `{PROJECT_ID}.granier_maestros.Master_Articulos_Centro`
+    """
+
+    with ThreadPoolExecutor(max_workers=MAX_CONSULTAS_CONCURRENTES) as pool:
+        print("   → Lanzando en paralelo: Master_Logistica...")
+
+        futuros = {
+            "filtro_cm": pool.submit(_cronometrar, universo),
+            "master_logistica": pool.submit(
+                _cronometrar, consulta_referencia, fuente,
+                f"{PROJECT_ID}.granier_logistica.Master_Logistica", sql_obj, None, TIPOS_OBJ
+            ),
+        }
+
+        df_cm, _ = futuros["filtro_cm"].result()
 
-    fecha_entrega_filter = f"AND p.Fecha_de_entrega <= DATE('{fecha_corte}')" if fecha_corte else ""
-    fecha_rotura_filter = f"AND r.Fecha_Rotura <= DATE('{fecha_corte}')" if fecha_corte else ""
+        if df_cm.empty:
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise ValueError(f"No se encontraron materiales para proveedor {descripcion}")
 
-    sql_stock = f"""
+        # Universo CM y fecha de corte como parámetros de consulta (SQL de tamaño constante)
+        parametros_cm_sql = {"cm": parametro_universo_cm(df_cm)}
+        parametros_materiales = {"materiales": parametro_materiales(df_cm["Material"])}
+        parametros_stock = dict(parametros_cm_sql)
+        if fecha_corte:
+            parametros_stock["fecha_corte"] = pd.to_datetime(fecha_corte).date()
+
+        fecha_entrega_filter = "AND p.Fecha_de_entrega <= @fecha_corte" if fecha_corte else ""
+        fecha_rotura_filter = "AND r.Fecha_Rotura <= @fecha_corte" if fecha_corte else ""
+
+        sql_stock = f"""
     WITH cm AS (
-      SELECT * FROM UNNEST([
-        {cm_structs}
-      ])
+      SELECT * FROM UNNEST(@cm)
     ),
     pendientes AS (
       SELECT
         cm.Centro,
         cm.Material,
+        cm.Proveedor,
         SUM(IFNULL(SAFE_CAST(p.Cantidad AS FLOAT64), 0)) AS Cantidad_Pendiente_Entrada
       FROM cm
       LEFT JOIN `{PROJECT_ID}.granier_logistica.Tbl_Pedidos_Pendientes` p
@@ -165,12 +515,13 @@ def cargar_datos_reales(
        AND CAST(p.Proveedor AS INT64) = cm.Proveedor
       WHERE 1=1
         {fecha_entrega_filter}
-      GROUP BY 1, 2
+      GROUP BY 1, 2, 3
     ),
     roturas AS (
       SELECT
         cm.Centro,
         cm.Material,
+        cm.Proveedor,
         SUM(IFNULL(r.Cantidad_Rotura, 0)) AS Cantidad_Rotura
       FROM cm
       LEFT JOIN `{PROJECT_ID}.granier_logistica.Tbl_Roturas_Proveedor` r
@@ -180,11 +531,12 @@ def cargar_datos_reales(
        AND r.Estado = 'ABIERTA'
       WHERE 1=1
         {fecha_rotura_filter}
-      GROUP BY 1, 2
+      GROUP BY 1, 2, 3
     )
     SELECT
       z.Centro,
       z.Material,
+      cm.Proveedor,
       IFNULL(SAFE_CAST(z.Libre_util_centro AS FLOAT64), 0) AS Stock_Actual,
       IFNULL(SAFE_CAST(z.Libre_util_centro AS FLOAT64), 0)
         - IFNULL(SAFE_CAST(z.Cantidad_pdte_salida AS FLOAT64), 0)
@@ -197,23 +549,16 @@ def cargar_datos_reales(
     LEFT JOIN pendientes p
       ON CAST(z.Centro AS STRING) = p.Centro
      AND CAST(z.Material AS INT64) = p.Material
+     AND cm.Proveedor = p.Proveedor
     LEFT JOIN roturas r
       ON CAST(z.Centro AS STRING) = r.Centro
      AND CAST(z.Material AS INT64) = r.Material
+     AND cm.Proveedor = r.Proveedor
     """
 
-    df_stock = client.query(sql_stock).to_dataframe()
-
-    if df_stock.empty:
-        raise ValueError("No hay datos en ZLO12_STREAMING_CURRENT para los materiales detectados.")
-
-    print("   → Cargando CMD + parámetros desde v_ZLO12_curado...")
-
-    sql_cmd = f"""
+        sql_cmd = f"""
     WITH cm AS (
-      SELECT DISTINCT Centro, Material FROM UNNEST([
-        {cm_structs}
-      ])
+      SELECT DISTINCT Centro, Material FROM UNNEST(@cm)
     )
     SELECT
       z.Centro,
@@ -225,109 +570,9 @@ def cargar_datos_reales(
     JOIN cm USING (Centro, Material)
     """
 
-    df_cmd = client.query(sql_cmd).to_dataframe()
-
-    if df_cmd.empty:
-        raise ValueError("No hay datos de CMD en v_ZLO12_curado para los materiales detectados.")
-
-    df_sc = df_stock.merge(df_cmd, on=["Centro", "Material"], how="left")
-    df_sc = df_sc.merge(df_cm[["Centro", "Material", "Proveedor"]], on=["Centro", "Material"], how="left")
-
-    df_sc["CMD_Ajustado_Final"] = df_sc["CMD_Ajustado_Final"].fillna(df_sc["CMD_SAP"])
-    df_sc["CMD_SAP"] = df_sc["CMD_SAP"].fillna(0)
-    df_sc["CMD_Ajustado_Final"] = df_sc["CMD_Ajustado_Final"].fillna(0)
-    df_sc["cantidad_min_fabricacion"] = df_sc["cantidad_min_fabricacion"].fillna(0)
-
-    consumo_diario = {
-        (row["Centro"], row["Material"]): float(row["CMD_Ajustado_Final"]) * (1.0 + float(consumo_extra_pct))
-        for _, row in df_sc.iterrows()
-    }
-
-    cmd_sap = {
-        (row["Centro"], row["Material"]): float(row["CMD_SAP"])
-        for _, row in df_sc.iterrows()
-    }
-
-    cantidad_min_fabricacion = {
-        row["Material"]: float(row["cantidad_min_fabricacion"])
-        for _, row in df_sc.iterrows()
-    }
-
-    print("   → Cargando stock de fábrica (Centro 1004)...")
-
-    sql_fabr = f"""
-    SELECT
-      Material,
-      Stock
-    FROM `{PROJECT_ID}.granier_logistica.v_ZLO12_curado`
-    WHERE Centro = "1004"
-    """
-
-    df_fabr = client.query(sql_fabr).to_dataframe()
-    stock_fabrica = {row["Material"]: float(row["Stock"]) for _, row in df_fabr.iterrows()}
-
-    print("   → Cargando parámetros de producción (Tbl_Produccion_Parmetros)...")
-
-    sql_param = f"""
-    SELECT
-      Material,
-      Puesto_de_trabajo,
-      Un_Hora,
-      ` StockObj_Dias`,
-      ` Grupo_de_Fabr`
-    FROM `{PROJECT_ID}.granier_logistica.Tbl_Produccion_Parmetros`
-    """
-
-    df_param = client.query(sql_param).to_dataframe()
-    df_param.columns = [c.strip() for c in df_param.columns]
-
-    puesto_trabajo = {row["Material"]: row["Puesto_de_trabajo"] for _, row in df_param.iterrows()}
-    grupo_de_fabr = {row["Material"]: row["Grupo_de_Fabr"] for _, row in df_param.iterrows()}
-
-    print("   → Cargando stock objetivo/seguridad por centro (Master_Logistica)...")
-
-    sql_obj = f"""
-    SELECT
-      centro AS Centro,
-      stock_objetivo AS Dias_Stock_Objetivo,
-      stock_seguridad AS Dias_Stock_Seguridad
-    FROM `{PROJECT_ID}.granier_logistica.Master_Logistica`
-    WHERE centro_suministrador = "1004"
-    """
-
-    df_obj = client.query(sql_obj).to_dataframe()
-
-    dias_obj_por_centro = {row["Centro"]: int(row["Dias_Stock_Objetivo"] or 0) for _, row in df_obj.iterrows()}
-    dias_seg_por_centro = {row["Centro"]: int(row["Dias_Stock_Seguridad"] or 0) for _, row in df_obj.iterrows()}
-
-    dias_stock_objetivo = {
-        (row["Centro"], row["Material"]): dias_obj_por_centro.get(row["Centro"], 0)
-        for _, row in df_sc.iterrows()
-    }
-    dias_stock_seguridad = {
-        (row["Centro"], row["Material"]): dias_seg_por_centro.get(row["Centro"], 0)
-        for _, row in df_sc.iterrows()
-    }
-
-    print("   → Cargando mínimos logísticos (Master_Pedidos_Min)...")
-
-    sql_minimos = f"""
-    SELECT
-      CAST(Material AS INT64) AS Material,
-      Cajas_capa,
-      Cajas_palet
-    FROM `{PROJECT_ID}.granier_logistica.Master_Pedidos_Min`
-    """
-
-    df_minimos = client.query(sql_minimos).to_dataframe()
-
-    print("   → Cargando rotación CAP/PAL (Stock_Dias_CAP_PAL)...")
-
-    sql_rotacion = f"""
+        sql_rotacion = f"""
     WITH cm AS (
-      SELECT DISTINCT Centro, Material FROM UNNEST([
-        {cm_structs}
-      ])
+      SELECT DISTINCT Centro, Material FROM UNNEST(@cm)
     )
     SELECT
       r.Centro,
@@ -340,41 +585,108 @@ def cargar_datos_reales(
     JOIN cm USING (Centro, Material)
     """
 
-    df_rotacion = client.query(sql_rotacion).to_dataframe()
+        print("   → Lanzando en paralelo: stock (ZLO12 + pendientes - roturas), CMD (v_ZLO12_curado), "
+              f"rotación CAP/PAL, mínimos logísticos{''.join(', ' + d for d in datasets_extra)}...")
+
+        futuros["stock"] = pool.submit(
+            _cronometrar, fuente.consulta_df, sql_stock, parametros_stock, TIPOS_STOCK
+        )
+        futuros["cmd"] = pool.submit(
+            _cronometrar, fuente.consulta_df, sql_cmd, parametros_cm_sql, TIPOS_CMD
+        )
+        futuros["rotacion"] = pool.submit(
+            _cronometrar, fuente.consulta_df, sql_rotacion, parametros_cm_sql, TIPOS_ROTACION
+        )
+        futuros["minimos_logisticos"] = pool.submit(
+            _cronometrar, consulta_referencia, fuente,
+            f"{PROJECT_ID}.granier_logistica.Master_Pedidos_Min", sql_minimos, None, TIPOS_MINIMOS,
+            parametros_materiales["materiales"]
+        )
+
+        if "stock_fabrica" in datasets_extra:
+            futuros["stock_fabrica"] = pool.submit(
+                _cronometrar, fuente.consulta_df, sql_fabr, parametros_materiales, TIPOS_FABR
+            )
+        if "produccion" in datasets_extra:
+            futuros["parametros_produccion"] = pool.submit(
+                _cronometrar, consulta_referencia, fuente,
+                f"{PROJECT_ID}.granier_logistica.Tbl_Produccion_Parmetros", sql_param, None,
+                {"Material": "Int64"}, parametros_materiales["materiales"]
+            )
+        if "precio_pmv" in datasets_extra:
+            futuros["precio_pmv"] = pool.submit(
+                _cronometrar, consulta_referencia, fuente,
+                f"{PROJECT_ID}.granier_maestros.Master_Articulos_Centro", sql_precio, None,
+                TIPOS_PRECIO, parametros_materiales["materiales"]
+            )
+
+        resultados = {}
+        tiempos_carga = {}
+        for nombre, futuro in futuros.items():
+            resultados[nombre], tiempos_carga[nombre] = futuro.result()
+
+    tiempos_carga["total"] = time.perf_counter() - t_inicio
+    filas_carga = {nombre: len(df) for nombre, df in resultados.items()}
+    for nombre, segundos in tiempos_carga.items():
+        print(f"   ⏱ {nombre}: {segundos:.2f} s")
+
+    return df_cm, resultados, tiempos_carga, filas_carga
+
+
+def _montar_datos(df_cm, resultados: dict, tiempos_carga: dict, filas_carga: dict, consumo_extra_pct: float) -> dict:
+    """Datos del pipeline V2 a partir del universo CM y los resultados de _cargar_consultas."""
+    df_stock = resultados["stock"]
 
-    print("   → Cargando Precio_estandar_PMV desde Master_Articulos_Centro...")
+    if df_stock.empty:
+        raise ValueError("No hay datos en ZLO12_STREAMING_CURRENT para los materiales detectados.")
 
-    sql_precio = f"""
-    SELECT 
-        CAST(Material AS INT64) AS Material,
-        CAST(Centro AS STRING) AS Centro,
-        Precio_estandar_PMV
-    FROM `{PROJECT_ID}.granier_maestros.Master_Articulos_Centro`
-    """
+    df_cmd = resultados["cmd"]
 
-    df_precio = client.query(sql_precio).to_dataframe()
+    if df_cmd.empty:
+        raise ValueError("No hay datos de CMD en v_ZLO12_curado para los materiales detectados.")
 
-    precio_pmv = {
-        (row["Centro"], row["Material"]): float(row["Precio_estandar_PMV"])
-        for _, row in df_precio.iterrows()
-        if row["Precio_estandar_PMV"] is not None
-    }
+    df_sc = df_stock.merge(df_cmd, on=["Centro", "Material"], how="left")
+
+    df_sc["CMD_Ajustado_Final"] = df_sc["CMD_Ajustado_Final"].fillna(df_sc["CMD_SAP"])
+    df_sc["CMD_SAP"] = df_sc["CMD_SAP"].fillna(0)
+    df_sc["CMD_Ajustado_Final"] = df_sc["CMD_Ajustado_Final"].fillna(0)
+    df_sc["cantidad_min_fabricacion"] = df_sc["cantidad_min_fabricacion"].fillna(0)
+
+    df_obj = resultados["master_logistica"]
+
+    dias_seg_por_centro = dict(zip(
+        df_obj["Centro"],
+        pd.to_numeric(df_obj["Dias_Stock_Seguridad"], errors="coerce").fillna(0).astype(int).tolist()
+    ))
+
+    # Tabla única (Centro, Material) → parámetros, en arrays de solo lectura
+    parametros_cm = construir_parametros_cm(
+        df_sc=df_sc,
+        df_obj=df_obj,
+        df_minimos=resultados["minimos_logisticos"],
+        df_rotacion=resultados["rotacion"],
+        df_precio=resultados.get("precio_pmv"),
+        consumo_extra_pct=consumo_extra_pct
+    )
 
     print("✅ Datos cargados correctamente (V2).")
 
-    return {
+    datos = {
         "stock_inicial_centros": df_sc[["Centro", "Material", "Stock", "Stock_Actual", "Proveedor"]],
-        "consumo_diario": consumo_diario,
-        "cmd_sap": cmd_sap,
-        "stock_fabrica": stock_fabrica,
-        "cantidad_min_fabricacion": cantidad_min_fabricacion,
-        "dias_stock_objetivo": dias_stock_objetivo,
-        "dias_stock_seguridad": dias_stock_seguridad,
+        "parametros_cm": parametros_cm,
         "dias_seg_por_centro": dias_seg_por_centro,
-        "puesto_trabajo": puesto_trabajo,
-        "grupo_de_fabr": grupo_de_fabr,
-        "minimos_logisticos": df_minimos,
-        "rotacion": df_rotacion,
-        "precio_pmv": precio_pmv,
         "cm_proveedor": df_cm[["Centro", "Material", "Proveedor"]],
+        "tiempos_carga": tiempos_carga,
+        "filas_carga": filas_carga,
     }
+
+    if "stock_fabrica" in resultados:
+        df_fabr = resultados["stock_fabrica"]
+        datos["stock_fabrica"] = dict(zip(df_fabr["Material"], df_fabr["Stock"].astype(float)))
+
+    if "parametros_produccion" in resultados:
+        df_param = resultados["parametros_produccion"].rename(columns=lambda c: c.strip())
+        datos["puesto_trabajo"] = dict(zip(df_param["Material"], df_param["Puesto_de_trabajo"]))
+        datos["grupo_de_fabr"] = dict(zip(df_param["Material"], df_param["Grupo_de_Fabr"]))
+
+    return datos
@@ -0,0 +1,142 @@
+# ============================================================
+# consultas_bq.py – Descarga de resultados BigQuery en columnar (Arrow)
+# ============================================================
+
+import threading
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from google.cloud import bigquery
+
+try:
+    from google.cloud import bigquery_storage
+except ImportError:  # sin el paquete la descarga va por REST (igualmente a Arrow)
+    bigquery_storage = None
+
+
+# Tipos destino admitidos en `tipos` → tipo Arrow al que se castea antes de pasar a pandas
+TIPOS_ARROW = {
+    "Int64": pa.int64(),
+    "float64": pa.float64(),
+    "string": pa.string(),
+    "boolean": pa.bool_(),
+}
+
+# Igual que to_dataframe(): enteros y booleanos nullable de pandas
+_TIPOS_PANDAS = {
+    pa.int64(): pd.Int64Dtype(),
+    pa.bool_(): pd.BooleanDtype(),
+}
+
+_bqstorage = None
+_bqstorage_lock = threading.Lock()
+
+
+def cliente_bqstorage():
+    """
+    BigQueryReadClient compartido por el proceso (crear uno por consulta cuesta un canal gRPC).
+    None si google-cloud-bigquery-storage no está instalado o no se puede crear.
+    """
+    global _bqstorage
+    if bigquery_storage is None:
+        return None
+    with _bqstorage_lock:
+        if _bqstorage is None:
+            try:
+                _bqstorage = bigquery_storage.BigQueryReadClient()
+            except Exception as e:
+                print(f"⚠ Storage Read API no disponible, se descarga por REST: {e}")
+                return None
+        return _bqstorage
+
+
+def arrow_a_pandas(tabla: pa.Table, tipos: dict | None = None) -> pd.DataFrame:
+    """
+    Convierte una tabla Arrow a DataFrame casteando antes, en columnar, las columnas de
+    `tipos` ({columna: "Int64" | "float64" | "string" | "boolean"}).
+    INT64 / BOOL quedan como Int64 / boolean nullable, igual que con to_dataframe().
+    """
+    for columna, dtype in (tipos or {}).items():
+        if dtype not in TIPOS_ARROW:
+            raise ValueError(f"Tipo {dtype!r} no soportado para {columna}. Opciones: {list(TIPOS_ARROW)}")
+        if columna in tabla.column_names:
+            i = tabla.column_names.index(columna)
+            tabla = tabla.set_column(i, columna, pc.cast(tabla.column(i), TIPOS_ARROW[dtype]))
+
+    return tabla.to_pandas(types_mapper=_TIPOS_PANDAS.get)
+
+
+def _tipo_bq_escalar(valor) -> str:
+    if isinstance(valor, (bool, np.bool_)):
+        return "BOOL"
+    if isinstance(valor, (int, np.integer)):
+        return "INT64"
+    if isinstance(valor, (float, np.floating)):
+        return "FLOAT64"
+    if isinstance(valor, datetime):
+        return "TIMESTAMP"
+    if isinstance(valor, date):
+        return "DATE"
+    return "STRING"
+
+
+def _tipo_bq_dtype(dtype) -> str:
+    # numpy y extension dtypes de pandas (Int64, boolean, string) exponen `kind`
+    return {"b": "BOOL", "i": "INT64", "u": "INT64", "f": "FLOAT64"}.get(dtype.kind, "STRING")
+
+
+def _nativo(valor):
+    return valor.item() if isinstance(valor, np.generic) else valor
+
+
+def parametros_bigquery(parametros: dict | None) -> list | None:
+    """
+    Convierte parámetros neutros ({nombre: valor}) en query parameters de BigQuery:
+      - DataFrame → ARRAY<STRUCT<columnas>> (tipos según dtype)
+      - lista / array / Series → ARRAY<tipo> (tipo según dtype)
+      - escalar → tipo según el valor (INT64, FLOAT64, BOOL, DATE, TIMESTAMP, STRING)
+    """
+    if not parametros:
+        return None
+
+    resultado = []
+    for nombre, valor in parametros.items():
+        if isinstance(valor, pd.DataFrame):
+            tipos_campos = {c: _tipo_bq_dtype(valor[c].dtype) for c in valor.columns}
+            structs = [
+                bigquery.StructQueryParameter(None, *[
+                    bigquery.ScalarQueryParameter(c, tipos_campos[c], _nativo(v))
+                    for c, v in zip(valor.columns, fila)
+                ])
+                for fila in valor.itertuples(index=False, name=None)
+            ]
+            resultado.append(bigquery.ArrayQueryParameter(nombre, "STRUCT", structs))
+        elif isinstance(valor, (list, tuple, np.ndarray, pd.Series, pd.Index)):
+            arr = np.asarray(valor)
+            tipo = _tipo_bq_dtype(arr.dtype) if len(arr) == 0 or arr.dtype.kind != "O" \
+                else _tipo_bq_escalar(arr[0])
+            resultado.append(bigquery.ArrayQueryParameter(nombre, tipo, [_nativo(v) for v in arr]))
+        else:
+            resultado.append(bigquery.ScalarQueryParameter(nombre, _tipo_bq_escalar(valor), _nativo(valor)))
+    return resultado
+
+
+def consulta_df(
+    client,
+    sql: str,
+    parametros: dict | None = None,
+    tipos: dict | None = None,
+) -> pd.DataFrame:
+    """
+    Ejecuta `sql` y descarga el resultado como Arrow, por la Storage Read API si está
+    disponible (si no, por REST), sin pasar por filas JSON una a una.
+    `parametros`: {nombre: valor} (ver parametros_bigquery). `tipos`: dtypes destino por columna.
+    """
+    query_parameters = parametros_bigquery(parametros)
+    job_config = bigquery.QueryJobConfig(query_parameters=query_parameters) if query_parameters else None
+    filas = client.query(sql, job_config=job_config).result()
+    tabla = filas.to_arrow(bqstorage_client=cliente_bqstorage(), create_bqstorage_client=False)
+    return arrow_a_pandas(tabla, tipos)
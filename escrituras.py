@@ -0,0 +1,329 @@
+# ============================================================
+# escrituras.py – Persistencia de resultados en segundo plano (write-behind)
+# ============================================================
+#
+# Las cargas a BigQuery (load_table_from_dataframe(...).result()) son lo más lento del final
+# del pipeline y el cliente solo necesita los pedidos. Las escrituras de una ejecución se
+# agrupan, se encolan en un pool de hilos (forecast y pedidos a la vez) con reintentos, y la
+# respuesta sale al terminar la planificación; el estado del grupo se consulta por su id.
+#
+# Orden por tabla: las escrituras de una misma tabla se hacen de una en una y en el orden en
+# que se encolaron (un MERGE de histórico calcula sus cambios sobre lo que dejó el anterior).
+# Cada tabla tiene su cola y solo su primera escritura ocupa un hilo: la siguiente se envía al
+# pool cuando termina la anterior, así que una tabla con muchas escrituras no retiene hilos
+# que necesitan las demás. Al encolar un WRITE_TRUNCATE se descartan ("reemplazada") los de la
+# misma tabla que aún no han empezado: el contenido final es siempre el de la última ejecución.
+# Cada WRITE_TRUNCATE deja anotado su grupo como último escritor de la tabla: quien sirve un
+# resultado de caché sabe así si la tabla aún tiene su contenido o la ha reemplazado otra ejecución.
+#
+# Modos: los de FuenteDatos.escribir_df y "MERGE" (solo cambios a un histórico, ver
+# persistencia.escribir_historico).
+
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import wait as esperar_futuros
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+
+import pandas as pd
+
+from persistencia import escribir_historico
+
+
+# Escritura diferida por defecto (0: el pipeline espera a que terminen, como antes)
+ESCRITURA_DIFERIDA = os.getenv("PLANIFICADOR_ESCRITURA_DIFERIDA", "1") == "1"
+# Cargas a la vez (todas las tablas y ejecuciones)
+MAX_ESCRITURAS_CONCURRENTES = int(os.getenv("PLANIFICADOR_MAX_ESCRITURAS", "8"))
+# Espera máxima (segundos) a las escrituras pendientes al apagar el servicio
+ESPERA_APAGADO_SEG = float(os.getenv("PLANIFICADOR_ESPERA_ESCRITURAS_SEG", "120"))
+# Intentos por escritura y espera antes del primer reintento (se duplica en cada uno)
+INTENTOS_ESCRITURA = 3
+ESPERA_REINTENTO_SEG = 2.0
+# Cuánto se conserva un grupo terminado (segundos) y cuántos como máximo
+TTL_ESCRITURAS_SEG = 60 * 60
+MAX_GRUPOS_TERMINADOS = 200
+
+ESTADOS_TERMINADOS = ("completada", "reemplazada", "error")
+
+
+def _iso(t):
+    return datetime.fromtimestamp(t, timezone.utc).isoformat(timespec="seconds") if t else None
+
+
+@dataclass
+class Escritura:
+    nombre: str                         # forecast | pedidos (etapa "escritura.<nombre>")
+    tabla: str
+    modo: str                           # WRITE_TRUNCATE | WRITE_APPEND | MERGE
+    filas: int
+    estado: str = "pendiente"           # pendiente | escribiendo | completada | reemplazada | error
+    filas_subidas: int | None = None
+    intentos: int = 0
+    segundos: float = 0.0
+    terminada: float | None = None
+    error: str | None = None
+    df: pd.DataFrame | None = field(default=None, repr=False)
+    opciones: dict = field(default_factory=dict, repr=False)
+    futuro: Future = field(default_factory=Future, repr=False)
+
+    def descripcion(self) -> dict:
+        datos = {
+            "nombre": self.nombre,
+            "tabla": self.tabla,
+            "modo": self.modo,
+            "filas": self.filas,
+            "filas_subidas": self.filas_subidas,
+            "estado": self.estado,
+            "intentos": self.intentos,
+            "segundos": round(self.segundos, 3),
+            "terminada": _iso(self.terminada),
+        }
+        if self.error is not None:
+            datos["error"] = self.error
+        return datos
+
+
+@dataclass
+class GrupoEscrituras:
+    """Escrituras de una ejecución del pipeline."""
+    id: str
+    fuente_id: str
+    escrituras: list
+    creado: float = field(default_factory=time.time)
+
+    @property
+    def futuros(self) -> list:
+        return [e.futuro for e in self.escrituras]
+
+    @property
+    def estado(self) -> str:
+        """error si falló alguna; pendiente / escribiendo mientras quede alguna; si no, completado."""
+        estados = {e.estado for e in self.escrituras}
+        if "error" in estados:
+            return "error"
+        if "escribiendo" in estados:
+            return "escribiendo"
+        if "pendiente" in estados:
+            return "pendiente"
+        return "completado"
+
+    @property
+    def terminado(self) -> float | None:
+        if any(e.estado not in ESTADOS_TERMINADOS for e in self.escrituras):
+            return None
+        return max((e.terminada for e in self.escrituras), default=self.creado)
+
+    def descripcion(self) -> dict:
+        return {
+            "escrituras_id": self.id,
+            "estado": self.estado,
+            "fuente": self.fuente_id,
+            "creado": _iso(self.creado),
+            "terminado": _iso(self.terminado),
+            "escrituras": [e.descripcion() for e in self.escrituras],
+        }
+
+
+class GestorEscrituras:
+    """
+    Cola de escrituras en memoria del proceso, ejecutadas en un ThreadPoolExecutor acotado.
+    Al apagar, `drenar` espera (con límite) a las pendientes y devuelve las que no terminaron.
+    """
+
+    def __init__(
+        self,
+        max_concurrentes: int = MAX_ESCRITURAS_CONCURRENTES,
+        intentos: int = INTENTOS_ESCRITURA,
+        espera_reintento_seg: float = ESPERA_REINTENTO_SEG,
+        ttl_seg: float = TTL_ESCRITURAS_SEG,
+        max_terminados: int = MAX_GRUPOS_TERMINADOS,
+    ):
+        self.intentos = intentos
+        self.espera_reintento_seg = espera_reintento_seg
+        self.ttl_seg = ttl_seg
+        self.max_terminados = max_terminados
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrentes, thread_name_prefix="escritura")
+        self._grupos: dict = {}
+        self._lock = threading.Lock()
+        # Por (fuente, tabla): escrituras que esperan turno y tablas con una escritura en curso
+        self._colas: dict = {}
+        self._en_curso: set = set()
+        self._ultimos_grupos: dict = {}
+        self.completadas = 0
+        self.reemplazadas = 0
+        self.fallidas = 0
+        self.reintentos = 0
+        self.filas_subidas = 0
+
+    def enviar(self, fuente, escrituras) -> GrupoEscrituras:
+        """
+        Encola `escrituras` [(nombre, df, tabla, modo[, opciones])] en `fuente` y devuelve su
+        grupo al momento. `opciones`: argumentos extra de la escritura (ámbito y fecha_plan en MERGE).
+        """
+        grupo_id = uuid.uuid4().hex
+        reemplazadas = []
+        with self._lock:
+            self._purgar()
+            lista = []
+            for nombre, df, tabla, modo, *opciones in escrituras:
+                escritura = Escritura(
+                    nombre=nombre, tabla=tabla, modo=modo, filas=len(df), df=df,
+                    opciones=opciones[0] if opciones else {}
+                )
+                clave = (fuente.id, tabla)
+                cola = self._colas.setdefault(clave, deque())
+                if modo == "WRITE_TRUNCATE":
+                    reemplazadas += [e for _, e in cola if e.modo == "WRITE_TRUNCATE"]
+                    cola = self._colas[clave] = deque((f, e) for f, e in cola if e.modo != "WRITE_TRUNCATE")
+                    self._ultimos_grupos[clave] = grupo_id
+                cola.append((fuente, escritura))
+                lista.append(escritura)
+            grupo = GrupoEscrituras(id=grupo_id, fuente_id=fuente.id, escrituras=lista)
+            self._grupos[grupo.id] = grupo
+            for escritura in lista:
+                self._lanzar((fuente.id, escritura.tabla))
+
+        for escritura in reemplazadas:
+            self._terminar(escritura, "reemplazada")
+            escritura.futuro.set_result(None)
+        return grupo
+
+    def esperar(self, grupo: GrupoEscrituras, timeout: float | None = None):
+        """Bloquea hasta que termine el grupo; relanza el error de la primera escritura fallida."""
+        esperar_futuros(grupo.futuros, timeout=timeout)
+        for futuro in grupo.futuros:
+            futuro.result(timeout=0)
+
+    def drenar(self, timeout: float | None = ESPERA_APAGADO_SEG) -> list:
+        """
+        Espera hasta `timeout` segundos a que terminen las escrituras de todos los grupos y
+        devuelve las que siguen sin terminar (pendientes o escribiendo). No relanza errores:
+        las fallidas ya están registradas en su grupo.
+        """
+        with self._lock:
+            futuros = [f for g in self._grupos.values() for f in g.futuros]
+        esperar_futuros(futuros, timeout=timeout)
+        with self._lock:
+            return [
+                e for g in self._grupos.values() for e in g.escrituras if e.estado not in ESTADOS_TERMINADOS
+            ]
+
+    def ultimo_grupo(self, fuente, tabla: str) -> str | None:
+        """Grupo del último WRITE_TRUNCATE encolado en `tabla` de `fuente` (None si no hay)."""
+        with self._lock:
+            return self._ultimos_grupos.get((fuente.id, tabla))
+
+    def obtener(self, escrituras_id: str) -> GrupoEscrituras | None:
+        with self._lock:
+            return self._grupos.get(escrituras_id)
+
+    def listar(self) -> list:
+        with self._lock:
+            self._purgar()
+            return sorted(self._grupos.values(), key=lambda g: g.creado)
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            pendientes = [
+                e for g in self._grupos.values() for e in g.escrituras if e.estado not in ESTADOS_TERMINADOS
+            ]
+            return {
+                "pendientes": len(pendientes),
+                "filas_pendientes": sum(e.filas for e in pendientes),
+                "completadas": self.completadas,
+                "reemplazadas": self.reemplazadas,
+                "fallidas": self.fallidas,
+                "reintentos": self.reintentos,
+                "filas_subidas": self.filas_subidas,
+            }
+
+    def _lanzar(self, clave: tuple):
+        # Con el lock: envía al pool la siguiente escritura de la tabla si no hay otra en curso
+        if clave in self._en_curso:
+            return
+        cola = self._colas.get(clave)
+        if not cola:
+            self._colas.pop(clave, None)
+            return
+        fuente, escritura = cola.popleft()
+        self._en_curso.add(clave)
+        self._pool.submit(self._escribir, clave, fuente, escritura)
+
+    def _escribir(self, clave: tuple, fuente, escritura: Escritura):
+        try:
+            self._cargar(fuente, escritura)
+        except BaseException as e:
+            escritura.futuro.set_exception(e)
+        else:
+            escritura.futuro.set_result(None)
+        finally:
+            with self._lock:
+                self._en_curso.discard(clave)
+                self._lanzar(clave)
+
+    def _cargar(self, fuente, escritura: Escritura):
+        escritura.estado = "escribiendo"
+        t0 = time.perf_counter()
+        while True:
+            escritura.intentos += 1
+            try:
+                if escritura.modo == "MERGE":
+                    escritura.filas_subidas = escribir_historico(
+                        fuente, escritura.nombre, escritura.df, escritura.tabla, **escritura.opciones
+                    )
+                else:
+                    fuente.escribir_df(escritura.df, escritura.tabla, escritura.modo)
+                    escritura.filas_subidas = escritura.filas
+                break
+            except Exception as e:
+                escritura.error = f"{type(e).__name__}: {e}"
+                if escritura.intentos >= self.intentos:
+                    print(f"❌ Escritura de {escritura.tabla} fallida tras {escritura.intentos} intentos: {e}")
+                    traceback.print_exc()
+                    escritura.segundos = time.perf_counter() - t0
+                    self._terminar(escritura, "error")
+                    raise
+                espera = self.espera_reintento_seg * 2 ** (escritura.intentos - 1)
+                print(f"⚠ Escritura de {escritura.tabla} fallida ({e}); reintento en {espera:.0f}s")
+                with self._lock:
+                    self.reintentos += 1
+                time.sleep(espera)
+
+        escritura.segundos = time.perf_counter() - t0
+        escritura.error = None
+        self._terminar(escritura, "completada")
+
+    def _terminar(self, escritura: Escritura, estado: str):
+        escritura.df = None
+        # `terminada` antes que el estado: _purgar ordena los grupos terminados por esa marca
+        escritura.terminada = time.time()
+        escritura.estado = estado
+        with self._lock:
+            if estado == "completada":
+                self.completadas += 1
+                self.filas_subidas += escritura.filas_subidas or 0
+            elif estado == "reemplazada":
+                self.reemplazadas += 1
+            else:
+                self.fallidas += 1
+
+    def _purgar(self):
+        # Caducados por TTL y, si aun así sobran, los terminados más antiguos
+        ahora = time.time()
+        terminados = sorted(
+            (g for g in self._grupos.values() if g.terminado is not None),
+            key=lambda g: g.terminado,
+        )
+        sobran = len(terminados) - self.max_terminados
+        for i, g in enumerate(terminados):
+            if i < sobran or ahora - g.terminado > self.ttl_seg:
+                del self._grupos[g.id]
+
+
+# Instancia compartida por el proceso
+ESCRITURAS = GestorEscrituras()
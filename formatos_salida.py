@@ -0,0 +1,134 @@
+# ============================================================
+# formatos_salida.py – Pedidos en streaming: NDJSON, CSV y Arrow IPC
+# ============================================================
+#
+# La respuesta JSON de /planificar_v2 convierte todos los pedidos a una lista de dicts y la
+# serializa entera antes de enviar el primer byte. Estos formatos se codifican por bloques
+# de filas directamente desde el DataFrame (codificadores en C de pandas / Arrow) y se
+# envían según se generan, opcionalmente comprimidos con gzip.
+
+import io
+import zlib
+from datetime import date
+
+import pandas as pd
+
+
+# Formato → media type (negociación por ?formato= o cabecera Accept)
+FORMATOS = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+FORMATOS_STREAMING = ("ndjson", "csv", "arrow")
+
+FILAS_POR_BLOQUE = 5000
+# Compresión gzip: nivel moderado, el cuello de botella es la CPU del servidor, no la red
+NIVEL_GZIP = 5
+
+
+def negociar_formato(formato: str | None = None, accept: str | None = None) -> str:
+    """
+    Formato de la respuesta: el explícito (`formato`) o el de mayor calidad (q) de `accept`
+    entre FORMATOS; json si no se pide ninguno conocido. ValueError si `formato` no existe.
+    """
+    if formato:
+        if formato not in FORMATOS:
+            raise ValueError(f"formato {formato!r} no soportado. Opciones: {list(FORMATOS)}")
+        return formato
+
+    elegido, calidad = "json", 0.0
+    for tipo, q in _lista_con_calidad(accept):
+        for nombre, media in FORMATOS.items():
+            if tipo == media.split(";")[0] and q > calidad:
+                elegido, calidad = nombre, q
+    return elegido
+
+
+def acepta_gzip(accept_encoding: str | None) -> bool:
+    return any(codificacion in ("gzip", "*") and q > 0 for codificacion, q in _lista_con_calidad(accept_encoding))
+
+
+def flujo_pedidos(df: pd.DataFrame, formato: str, gzip: bool = False, filas_por_bloque: int = FILAS_POR_BLOQUE):
+    """Generador de bytes con `df` codificado en `formato` (uno de FORMATOS_STREAMING)."""
+    codificadores = {"ndjson": _bloques_ndjson, "csv": _bloques_csv, "arrow": _bloques_arrow}
+    if formato not in codificadores:
+        raise ValueError(f"formato {formato!r} no es de streaming. Opciones: {list(codificadores)}")
+    bloques = (b for b in codificadores[formato](df, filas_por_bloque) if b)
+    return _comprimir(bloques) if gzip else bloques
+
+
+def _lista_con_calidad(cabecera: str | None):
+    """[(valor, q)] de una cabecera tipo Accept ("text/csv;q=0.9, */*;q=0.1")."""
+    for parte in (cabecera or "").split(","):
+        valor, *parametros = [p.strip() for p in parte.split(";")]
+        if not valor:
+            continue
+        q = 1.0
+        for parametro in parametros:
+            if parametro.startswith("q="):
+                try:
+                    q = float(parametro[2:])
+                except ValueError:
+                    q = 0.0
+        yield valor.lower(), q
+
+
+def _columnas_fecha(df: pd.DataFrame) -> list:
+    # Las fechas de calendario llegan como datetime.date en columnas object (dias_a_fechas)
+    columnas = []
+    for columna in df.columns:
+        if df[columna].dtype == object:
+            primero = df[columna].first_valid_index()
+            if primero is not None and isinstance(df[columna].at[primero], date):
+                columnas.append(columna)
+    return columnas
+
+
+def _bloques_ndjson(df: pd.DataFrame, filas_por_bloque: int):
+    fechas = _columnas_fecha(df)
+    for inicio in range(0, len(df), filas_por_bloque):
+        bloque = df.iloc[inicio:inicio + filas_por_bloque]
+        if fechas:
+            # Fechas como "AAAA-MM-DD", igual que en la respuesta JSON
+            bloque = bloque.assign(**{c: bloque[c].map(date.isoformat, na_action="ignore") for c in fechas})
+        # double_precision máxima de pandas (15 cifras): por defecto redondea a 10
+        texto = bloque.to_json(orient="records", lines=True, force_ascii=False, double_precision=15)
+        yield (texto if texto.endswith("\n") else texto + "\n").encode("utf-8")
+
+
+def _bloques_csv(df: pd.DataFrame, filas_por_bloque: int):
+    yield df.iloc[:0].to_csv(index=False, lineterminator="\n").encode("utf-8")
+    for inicio in range(0, len(df), filas_por_bloque):
+        bloque = df.iloc[inicio:inicio + filas_por_bloque]
+        yield bloque.to_csv(index=False, header=False, lineterminator="\n").encode("utf-8")
+
+
+def _bloques_arrow(df: pd.DataFrame, filas_por_bloque: int):
+    import pyarrow as pa
+
+    tabla = pa.Table.from_pandas(df, preserve_index=False)
+    buffer = io.BytesIO()
+    with pa.ipc.new_stream(buffer, tabla.schema) as escritor:
+        for lote in tabla.to_batches(max_chunksize=filas_por_bloque):
+            escritor.write_batch(lote)
+            yield _vaciar(buffer)
+    # Esquema (si no hubo lotes) y marca de fin de stream
+    yield _vaciar(buffer)
+
+
+def _vaciar(buffer: io.BytesIO) -> bytes:
+    datos = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return datos
+
+
+def _comprimir(bloques):
+    compresor = zlib.compressobj(NIVEL_GZIP, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for bloque in bloques:
+        comprimido = compresor.compress(bloque)
+        if comprimido:
+            yield comprimido
+    yield compresor.flush()
@@ -0,0 +1,331 @@
+# ============================================================
+# fuente_datos.py – Origen de datos del planificador (BigQuery o local)
+# ============================================================
+#
+# Los cargadores y el pipeline V2 no hablan con BigQuery directamente sino con una
+# FuenteDatos:
+#   - FuenteBigQuery: producción (consultas vía Arrow / Storage Read API).
+#   - FuenteLocal: snapshots Parquet en disco consultados con DuckDB, con el mismo SQL.
+#     Permite ejecutar y cronometrar el pipeline completo sin red ni credenciales.
+#
+# Elección por entorno: PLANIFICADOR_FUENTE=bigquery|local, PLANIFICADOR_DATOS_DIR=<dir>.
+
+import os
+import re
+from abc import ABC, abstractmethod
+import threading
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from consultas_bq import arrow_a_pandas, consulta_df, parametros_bigquery
+
+
+# Origen por defecto del proceso y directorio de los snapshots Parquet (fuente local)
+FUENTE_DATOS = os.getenv("PLANIFICADOR_FUENTE", "bigquery")
+DIR_DATOS_LOCAL = os.getenv("PLANIFICADOR_DATOS_DIR", "datos_local")
+
+MODOS_ESCRITURA = ("WRITE_TRUNCATE", "WRITE_APPEND")
+
+
+class FuenteDatos(ABC):
+    """
+    Interfaz común. Los parámetros de consulta son neutros, {nombre: valor}:
+      - DataFrame → tabla de structs, se lee con UNNEST(@nombre)
+      - lista / array → se usa como `IN UNNEST(@nombre)`
+      - escalar → @nombre
+    Las tablas se nombran con su id completo de BigQuery (`proyecto.dataset.tabla`).
+    """
+
+    # Identifica el origen en claves de caché / memo (dos fuentes no comparten entradas)
+    id = "abstracta"
+
+    @abstractmethod
+    def consulta_df(self, sql: str, parametros: dict | None = None, tipos: dict | None = None) -> pd.DataFrame:
+        """Resultado de `sql` como DataFrame (`tipos`: ver consultas_bq.arrow_a_pandas)."""
+
+    @abstractmethod
+    def filas(self, sql: str, parametros: dict | None = None) -> list[dict]:
+        """Resultado de `sql` como lista de dicts con valores Python (None para nulos)."""
+
+    @abstractmethod
+    def modificada(self, tabla: str):
+        """Marca de última modificación de `tabla` (comparable por igualdad)."""
+
+    @abstractmethod
+    def escribir_df(self, df: pd.DataFrame, tabla: str, modo: str = "WRITE_TRUNCATE"):
+        """Escribe `df` en `tabla` reemplazándola (WRITE_TRUNCATE) o añadiendo (WRITE_APPEND)."""
+
+    @abstractmethod
+    def existe(self, tabla: str) -> bool:
+        """Si `tabla` existe en la fuente."""
+
+    @abstractmethod
+    def fusionar_df(
+        self, df: pd.DataFrame, tabla: str, claves: list, particion: str, clustering: tuple = ()
+    ):
+        """
+        MERGE de `df` en `tabla`: la fila con las mismas `claves` y el mismo día de `particion`
+        (TIMESTAMP) se actualiza; el resto se inserta. Si `tabla` no existe se crea
+        particionada por día de `particion` y agrupada por `clustering`.
+        """
+
+
+class FuenteBigQuery(FuenteDatos):
+
+    def __init__(self, client=None):
+        if client is None:
+            from google.cloud import bigquery
+            client = bigquery.Client()
+        self.client = client
+        self.id = f"bigquery:{getattr(client, 'project', None)}"
+
+    def consulta_df(self, sql, parametros=None, tipos=None):
+        return consulta_df(self.client, sql, parametros, tipos)
+
+    def filas(self, sql, parametros=None):
+        from google.cloud import bigquery
+        query_parameters = parametros_bigquery(parametros)
+        job_config = bigquery.QueryJobConfig(query_parameters=query_parameters) if query_parameters else None
+        return [dict(fila.items()) for fila in self.client.query(sql, job_config=job_config).result()]
+
+    def modificada(self, tabla):
+        return self.client.get_table(tabla).modified
+
+    def escribir_df(self, df, tabla, modo="WRITE_TRUNCATE"):
+        from google.cloud import bigquery
+        _validar_modo(modo)
+        self.client.load_table_from_dataframe(
+            df, tabla, job_config=bigquery.LoadJobConfig(write_disposition=modo)
+        ).result()
+
+    def existe(self, tabla):
+        from google.api_core.exceptions import NotFound
+        try:
+            self.client.get_table(tabla)
+            return True
+        except NotFound:
+            return False
+
+    def fusionar_df(self, df, tabla, claves, particion, clustering=()):
+        # Carga a una tabla de paso y MERGE en el destino: solo viajan las filas de `df`
+        paso = f"{tabla}__fusion_{uuid.uuid4().hex[:12]}"
+        self.escribir_df(df, paso, modo="WRITE_TRUNCATE")
+        try:
+            self.client.query(_sql_crear_particionada(tabla, paso, particion, clustering)).result()
+            self.client.query(
+                _sql_merge(tabla, paso, list(df.columns), claves, particion, _dias_utc(df[particion]))
+            ).result()
+        finally:
+            self.client.delete_table(paso, not_found_ok=True)
+
+
+# `proyecto.dataset.tabla` entre backticks → vista "dataset"."tabla" sobre el Parquet
+_RE_TABLA = re.compile(r"`[\w-]+\.(\w+)\.(\w+)`")
+_RE_PARAMETRO = re.compile(r"@(\w+)")
+
+
+class FuenteLocal(FuenteDatos):
+    """
+    Snapshots Parquet en `directorio`/<dataset>/<tabla>.parquet consultados con DuckDB.
+
+    El SQL de BigQuery se traduce lo justo para el dialecto que usa el planificador
+    (SAFE_CAST, FLOAT64, backticks y parámetros @). Cada tabla es una vista sobre su
+    Parquet, así que reemplazar el fichero se ve en la siguiente consulta.
+    Requiere `pip install duckdb` (no es dependencia de producción).
+    """
+
+    def __init__(self, directorio: str = DIR_DATOS_LOCAL):
+        try:
+            import duckdb
+        except ImportError as e:
+            raise ImportError(
+                "La fuente local necesita DuckDB: pip install duckdb "
+                "(o PLANIFICADOR_FUENTE=bigquery)"
+            ) from e
+
+        self.directorio = os.path.abspath(directorio)
+        self.id = f"local:{self.directorio}"
+        self._con = duckdb.connect()
+        self._vistas: set = set()
+        self._lock = threading.Lock()
+
+    def ruta(self, tabla: str) -> str:
+        """Parquet de `proyecto.dataset.tabla` (el proyecto se ignora)."""
+        _, dataset, nombre = tabla.split(".")
+        return os.path.join(self.directorio, dataset, f"{nombre}.parquet")
+
+    def consulta_df(self, sql, parametros=None, tipos=None):
+        cursor = self._ejecutar(sql, parametros)
+        try:
+            leer = getattr(cursor, "to_arrow_table", None) or cursor.fetch_arrow_table
+            return arrow_a_pandas(leer(), tipos)
+        finally:
+            cursor.close()
+
+    def filas(self, sql, parametros=None):
+        cursor = self._ejecutar(sql, parametros)
+        try:
+            columnas = [d[0] for d in cursor.description]
+            return [dict(zip(columnas, fila)) for fila in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    def modificada(self, tabla):
+        return os.path.getmtime(self.ruta(tabla))
+
+    def escribir_df(self, df, tabla, modo="WRITE_TRUNCATE"):
+        _validar_modo(modo)
+        ruta = self.ruta(tabla)
+        if modo == "WRITE_APPEND" and os.path.exists(ruta):
+            df = pd.concat([pd.read_parquet(ruta), df], ignore_index=True)
+        self._guardar(df, ruta)
+
+    def existe(self, tabla):
+        return os.path.exists(self.ruta(tabla))
+
+    def fusionar_df(self, df, tabla, claves, particion, clustering=()):
+        # Parquet no tiene particiones ni clustering: mismo resultado que el MERGE, reescribiendo.
+        # El MultiIndex casa los NULL entre sí, como IS NOT DISTINCT FROM en _sql_merge
+        ruta = self.ruta(tabla)
+        if os.path.exists(ruta):
+            existente = pd.read_parquet(ruta)
+            clave_nueva = pd.MultiIndex.from_frame(df[claves].assign(__dia=_dias_utc(df[particion])))
+            clave_existente = pd.MultiIndex.from_frame(
+                existente[claves].assign(__dia=_dias_utc(existente[particion]))
+            )
+            df = pd.concat([existente[~clave_existente.isin(clave_nueva)], df], ignore_index=True)
+        self._guardar(df, ruta)
+
+    def _guardar(self, df: pd.DataFrame, ruta: str):
+        # Escritura atómica: una consulta concurrente nunca lee un Parquet a medias
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        tmp = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, ruta)
+
+    def _ejecutar(self, sql: str, parametros: dict | None):
+        # Un cursor por consulta: la conexión DuckDB no admite uso concurrente entre hilos
+        cursor = self._con.cursor()
+        try:
+            sql, valores = self._traducir(sql, parametros or {}, cursor)
+            cursor.execute(sql, valores)
+        except Exception:
+            cursor.close()
+            raise
+        return cursor
+
+    def _traducir(self, sql: str, parametros: dict, cursor):
+        for dataset, nombre in set(_RE_TABLA.findall(sql)):
+            self._asegurar_vista(dataset, nombre)
+        sql = _RE_TABLA.sub(r'"\1"."\2"', sql)
+        sql = sql.replace("`", '"')
+        sql = re.sub(r"\bSAFE_CAST\(", "TRY_CAST(", sql)
+        sql = re.sub(r"\bFLOAT64\b", "DOUBLE", sql)
+
+        valores = {}
+        for nombre, valor in parametros.items():
+            if isinstance(valor, pd.DataFrame):
+                # Tabla de structs: se registra en el cursor y UNNEST(@x) pasa a leerla
+                vista = f"__param_{nombre}"
+                cursor.register(vista, valor)
+                sql = sql.replace(f"UNNEST(@{nombre})", vista)
+            elif isinstance(valor, (list, tuple, np.ndarray, pd.Series, pd.Index)):
+                sql = re.sub(rf"\bIN\s+UNNEST\(@{nombre}\)", f"IN (SELECT UNNEST(${nombre}))", sql)
+                valores[nombre] = [v.item() if isinstance(v, np.generic) else v for v in valor]
+            else:
+                valores[nombre] = valor
+
+        sql = _RE_PARAMETRO.sub(lambda m: f"${m.group(1)}" if m.group(1) in valores else m.group(0), sql)
+        return sql, valores
+
+    def _asegurar_vista(self, dataset: str, nombre: str):
+        with self._lock:
+            if (dataset, nombre) in self._vistas:
+                return
+            ruta = os.path.join(self.directorio, dataset, f"{nombre}.parquet")
+            if not os.path.exists(ruta):
+                raise FileNotFoundError(f"No hay snapshot local de {dataset}.{nombre}: falta {ruta}")
+            ruta_sql = ruta.replace("'", "''")
+            self._con.execute(f'CREATE SCHEMA IF NOT EXISTS "{dataset}"')
+            self._con.execute(
+                f'CREATE OR REPLACE VIEW "{dataset}"."{nombre}" AS SELECT * FROM read_parquet(\'{ruta_sql}\')'
+            )
+            self._vistas.add((dataset, nombre))
+
+
+def _validar_modo(modo: str):
+    if modo not in MODOS_ESCRITURA:
+        raise ValueError(f"Modo de escritura {modo!r} no soportado. Opciones: {MODOS_ESCRITURA}")
+
+
+def _dias_utc(marcas: pd.Series) -> pd.Series:
+    # Día UTC de un TIMESTAMP, como DATE(ts) en BigQuery
+    return pd.to_datetime(marcas, utc=True).dt.date
+
+
+def _sql_crear_particionada(tabla: str, origen: str, particion: str, clustering: tuple) -> str:
+    cluster = f"CLUSTER BY {', '.join(clustering)}" if clustering else ""
+    return f"""
+    CREATE TABLE IF NOT EXISTS `{tabla}`
+    PARTITION BY DATE({particion})
+    {cluster}
+    AS SELECT * FROM `{origen}` WHERE FALSE
+    """
+
+
+def _sql_merge(tabla: str, origen: str, columnas: list, claves: list, particion: str, dias) -> str:
+    # Los días de `origen` como literales: el MERGE solo lee esas particiones del destino
+    lista_dias = ", ".join(f"DATE '{d.isoformat()}'" for d in sorted(set(dias)))
+    # NULL en una clave es un valor más (como en el MultiIndex de FuenteLocal): con `=` esas
+    # filas nunca casarían y cada MERGE las volvería a insertar
+    condicion = " AND ".join(f"T.`{c}` IS NOT DISTINCT FROM S.`{c}`" for c in claves)
+    actualizar = ", ".join(f"`{c}` = S.`{c}`" for c in columnas if c not in claves)
+    nombres = ", ".join(f"`{c}`" for c in columnas)
+    valores = ", ".join(f"S.`{c}`" for c in columnas)
+    return f"""
+    MERGE `{tabla}` T
+    USING `{origen}` S
+    ON {condicion}
+       AND DATE(T.`{particion}`) = DATE(S.`{particion}`)
+       AND DATE(T.`{particion}`) IN ({lista_dias})
+    WHEN MATCHED THEN UPDATE SET {actualizar}
+    WHEN NOT MATCHED THEN INSERT ({nombres}) VALUES ({valores})
+    """
+
+
+def crear_fuente(tipo: str = FUENTE_DATOS, directorio: str | None = None) -> FuenteDatos:
+    """FuenteDatos de tipo 'bigquery' o 'local' (snapshots en `directorio`)."""
+    if tipo == "bigquery":
+        return FuenteBigQuery()
+    if tipo == "local":
+        return FuenteLocal(directorio or DIR_DATOS_LOCAL)
+    raise ValueError(f"Fuente de datos {tipo!r} no soportada. Opciones: ['bigquery', 'local']")
+
+
+_fuente = None
+_fuente_lock = threading.Lock()
+
+
+def fuente_por_defecto() -> FuenteDatos:
+    """Fuente compartida por el proceso, según PLANIFICADOR_FUENTE / PLANIFICADOR_DATOS_DIR."""
+    global _fuente
+    with _fuente_lock:
+        if _fuente is None:
+            _fuente = crear_fuente()
+        return _fuente
+
+
+def copiar_tablas(origen: FuenteDatos, destino: FuenteDatos, tablas) -> dict:
+    """
+    Copia tablas completas de `origen` a `destino` (p. ej. BigQuery → snapshot local para
+    cronometrar el pipeline con volumen de producción). Devuelve {tabla: nº filas}.
+    """
+    filas = {}
+    for tabla in tablas:
+        df = origen.consulta_df(f"SELECT * FROM `{tabla}`")
+        destino.escribir_df(df, tabla)
+        filas[tabla] = len(df)
+        print(f"   📦 {tabla}: {len(df)} filas")
+    return filas
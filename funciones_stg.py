@@ -1,6 +1,9 @@
 from datetime import datetime, timedelta, date
 import pandas as pd
+import numpy as np
 import math
+
+from parametros_cm import ParametrosCM, indice_cm
 # ================================
 
 # ================================
@@ -78,58 +81,57 @@ def generar_pedidos_centros_desde_forecast(forecast_df, consumo_diario, dias_sto
     return pd.DataFrame(pedidos)
 def generar_pedidos_centros_desde_forecastV2(
     forecast_df: pd.DataFrame,
-    consumo_diario: dict,
-    dias_stock_seguridad: dict,
-    dias_stock_objetivo: dict,
+    parametros: ParametrosCM,
 ) -> pd.DataFrame:
     """
-    V2 (regla EPTY):
-      - Fecha_Entrega objetivo = Fecha_Rotura - seg
-      - Si cae antes del inicio del forecast, entonces Fecha_Entrega = día 0 del forecast
-      - Fecha_Carga = Fecha_Entrega (modo simplificado sin calendario)
+    V2 (regla EPTY), sobre el eje de días del motor ('Dia' en forecast_df):
+      - Dia_Entrega objetivo = Dia_Rotura - seg
+      - Si cae antes del inicio del forecast, entonces Dia_Entrega = día 0 del forecast
+      - Dia_Carga = Dia_Entrega (modo simplificado sin calendario)
       - Cantidad = ceil(consumo * (obj - seg)), mínimo 0
     """
+    cols = ["Centro","Material","Dia_Carga","Dia_Entrega","Cantidad","Dia_Rotura","Comentarios"]
     if forecast_df is None or forecast_df.empty:
-        return pd.DataFrame(columns=["Centro","Material","Fecha_Carga","Fecha_Entrega","Cantidad","Fecha_Rotura","Comentarios"])
-
-    df = forecast_df.copy()
-    df["Fecha"] = pd.to_datetime(df["Fecha"]).dt.date
-
-    pedidos = []
-    for (centro, material), g in df.groupby(["Centro","Material"]):
-        g = g.sort_values("Fecha")
-        fecha_inicio = g["Fecha"].min()
-
-        rot = g[g["Rotura"] == True]
-        if rot.empty:
-            continue
-
-        fecha_rotura = rot["Fecha"].iloc[0]
-        cons = float(consumo_diario.get((centro, material), 0.0) or 0.0)
-        seg  = int(dias_stock_seguridad.get((centro, material), 0) or 0)
-        obj  = int(dias_stock_objetivo.get((centro, material), 0) or 0)
-
-        dias_cubrir = max(0, obj - seg)
-        cantidad = math.ceil(max(0.0, cons * dias_cubrir))
-        if cantidad <= 0:
-            continue
-
-        # Regla: rotura - seg; si antes del inicio → día 0 del forecast
-        fecha_entrega_obj = fecha_rotura - timedelta(days=seg)
-        fecha_entrega = fecha_entrega_obj if fecha_entrega_obj >= fecha_inicio else fecha_inicio
-
-        pedidos.append({
-            "Centro": str(centro),
-            "Material": int(material),
-            "Fecha_Carga": fecha_entrega,
-            "Fecha_Entrega": fecha_entrega,
-            "Cantidad": cantidad,
-            "Fecha_Rotura": fecha_rotura,
-            "Comentarios": ""  # sin calendario -> sin tardíos
-        })
-
-    cols = ["Centro","Material","Fecha_Carga","Fecha_Entrega","Cantidad","Fecha_Rotura","Comentarios"]
-    return pd.DataFrame(pedidos, columns=cols)
+        return pd.DataFrame(columns=cols)
+
+    claves = ["Centro", "Material"]
+
+    # Primer día y primera rotura por CM en una sola pasada agrupada (orden de grupos = groupby)
+    dia_inicio = forecast_df.groupby(claves, sort=True)["Dia"].min()
+    rot = forecast_df.loc[forecast_df["Rotura"] == True, claves + ["Dia"]]
+    if rot.empty:
+        return pd.DataFrame(columns=cols)
+    dia_rotura = rot.groupby(claves, sort=True)["Dia"].min()
+
+    cms = dia_rotura.index
+    dia_rotura = dia_rotura.to_numpy(dtype=np.int64)
+    dia_inicio = dia_inicio.reindex(cms).to_numpy(dtype=np.int64)
+
+    pos = parametros.posiciones(cms.get_level_values("Centro"), cms.get_level_values("Material"))
+    cons = parametros.tomar("consumo_diario", pos, 0.0)
+    seg  = parametros.tomar("dias_stock_seguridad", pos, 0)
+    obj  = parametros.tomar("dias_stock_objetivo", pos, 0)
+
+    dias_cubrir = np.maximum(0, obj - seg)
+    necesidad = cons * dias_cubrir
+    cantidad = np.ceil(np.where(necesidad > 0, necesidad, 0.0))
+
+    # Regla: rotura - seg; si antes del inicio → día 0 del forecast
+    dia_entrega = np.maximum(dia_rotura - seg, dia_inicio)
+
+    ok = cantidad > 0
+    if not ok.any():
+        return pd.DataFrame(columns=cols)
+
+    return pd.DataFrame({
+        "Centro": cms.get_level_values("Centro")[ok].astype(str),
+        "Material": cms.get_level_values("Material")[ok].astype(np.int64),
+        "Dia_Carga": dia_entrega[ok],
+        "Dia_Entrega": dia_entrega[ok],
+        "Cantidad": cantidad[ok].astype(np.int64),
+        "Dia_Rotura": dia_rotura[ok],
+        "Comentarios": "",  # sin calendario -> sin tardíos
+    }, columns=cols)
 
 def ajustar_pedidos_a_fecha_trigger_desde_forecast(
     pedidos_df,
@@ -296,102 +298,378 @@ def asignar_entregas_a_centros(pedidos_df, ordenes_df):
     return pd.DataFrame(entregas)
 
 
+# ================================
+# Eje temporal en días enteros
+# ================================
+# El motor V2 trabaja con 'Dia' = días desde el día 0 del plan (int64).
+# Las fechas de calendario solo se materializan al escribir en BigQuery / JSON.
+
+def fechas_a_dias(fechas, fecha_inicio: date) -> np.ndarray:
+    """Convierte fechas (date, str o datetime64) a desplazamiento en días desde fecha_inicio."""
+    dias = pd.to_datetime(pd.Series(fechas)).to_numpy().astype("datetime64[D]")
+    return (dias - np.datetime64(fecha_inicio, "D")).astype(np.int64)
+
+
+def dias_a_fechas(dias, fecha_inicio: date) -> np.ndarray:
+    """Convierte desplazamientos en días a un array de datetime.date (frontera BigQuery/JSON)."""
+    dias = np.asarray(dias, dtype=np.int64)
+    return (np.datetime64(fecha_inicio, "D") + dias).astype(object)
+
+
+def columnas_dias_a_fechas(df: pd.DataFrame, fecha_inicio: date, columnas: dict) -> pd.DataFrame:
+    """
+    Sustituye columnas de días por columnas de fecha en la misma posición.
+    columnas: {"Dia_Entrega": "Fecha_Entrega", ...}
+    """
+    out = df.copy()
+    for col_dia, col_fecha in columnas.items():
+        if col_dia not in out.columns:
+            continue
+        pos = out.columns.get_loc(col_dia)
+        valores = dias_a_fechas(out.pop(col_dia).to_numpy(), fecha_inicio) if len(out) else []
+        out.insert(pos, col_fecha, valores)
+    return out
+
+
 def forecast_stock_centros(
     stock_inicial: pd.DataFrame,
     consumo_diario: dict,
     entregas_planificadas: pd.DataFrame,
     dias_forecast: int = 45,
     clamp_cero: bool = True,
+    fecha_inicio: date | None = None,
 ) -> pd.DataFrame:
     """
-    Genera forecast por (Centro, Material) día a día.
+    Genera forecast por (Centro, Material) día a día, con fechas de calendario.
+
+    Envoltorio de forecast_stock_centros_dias para quien trabaja con fechas y un dict
+    {(centro, material): consumo_diario}.
 
     - 'Stock_estimado' queda CLAMPED (>=0) si clamp_cero=True → así no verás negativos en tablas/salidas.
     - Se añade 'Deficit' = max(0, -stock_raw_del_dia) para detectar roturas con precisión.
     - 'Rotura' = Deficit > 0.
-    - La dinámica encadena con 'stock_visible' (clamped) si clamp_cero=True, de modo que no se propagan negativos.
+    - fecha_inicio: ancla el día 0 del horizonte. Si no se informa se deduce de las
+      entregas (nunca antes de hoy), lo que hace depender el horizonte de todos los CM.
     """
+    if fecha_inicio is None:
+        fechas_disponibles = []
+        if "Fecha" in stock_inicial.columns:
+            fechas_disponibles.append(pd.to_datetime(stock_inicial["Fecha"], errors="coerce").min())
+        if entregas_planificadas is not None and not entregas_planificadas.empty and "Fecha_Entrega" in entregas_planificadas.columns:
+            fechas_disponibles.append(pd.to_datetime(entregas_planificadas["Fecha_Entrega"], errors="coerce").min())
+        hoy = date.today()
+        fecha_disponible = min(fechas_disponibles).date() if fechas_disponibles else hoy
+        fecha_inicio = max(fecha_disponible, hoy)
+
+    entregas_dias = None
+    if entregas_planificadas is not None and not entregas_planificadas.empty:
+        entregas_dias = entregas_planificadas[["Centro", "Material", "Cantidad"]].copy()
+        entregas_dias["Dia_Entrega"] = fechas_a_dias(entregas_planificadas["Fecha_Entrega"], fecha_inicio)
+
+    parametros = ParametrosCM.desde_dataframe(pd.DataFrame({
+        "Centro": [c for c, _ in consumo_diario],
+        "Material": [m for _, m in consumo_diario],
+        "consumo_diario": list(consumo_diario.values()),
+    }))
+
+    forecast = forecast_stock_centros_dias(
+        stock_inicial, parametros, entregas_dias, dias_forecast, clamp_cero
+    )
+    if not forecast.empty:
+        forecast.insert(0, "Fecha", dias_a_fechas(forecast.pop("Dia"), fecha_inicio))
+    return forecast
 
-    forecast = []
 
-    # === Fecha de inicio del forecast ===
-    fechas_disponibles = []
-    if "Fecha" in stock_inicial.columns:
-        fechas_disponibles.append(pd.to_datetime(stock_inicial["Fecha"], errors="coerce").min())
-    if entregas_planificadas is not None and not entregas_planificadas.empty and "Fecha_Entrega" in entregas_planificadas.columns:
-        fechas_disponibles.append(pd.to_datetime(entregas_planificadas["Fecha_Entrega"], errors="coerce").min())
+def _stock_inicial_a_array(serie: pd.Series) -> np.ndarray:
+    """
+    Convierte la columna Stock a float64 con la misma regla que el bucle original:
+    float(x or 0) y 0.0 si no es convertible (NaN se conserva tal cual).
+    """
+    if serie.dtype.kind in "fiu":
+        return serie.to_numpy(dtype=float)
 
-    hoy = date.today()
-    fecha_disponible = min(fechas_disponibles).date() if fechas_disponibles else hoy
-    fecha_inicio = max(fecha_disponible, hoy)
+    valores = []
+    for v in serie:
+        try:
+            valores.append(float(v or 0))
+        except Exception:
+            valores.append(0.0)
+    return np.array(valores, dtype=float)
 
-    # === Asegurar tipos/coherencia en entregas ===
-    if entregas_planificadas is None or entregas_planificadas.empty:
-        entregas_planificadas = pd.DataFrame(columns=["Centro", "Material", "Fecha_Entrega", "Cantidad"])
-    else:
-        tmp = entregas_planificadas.copy()
-        tmp["Fecha_Entrega"] = pd.to_datetime(tmp["Fecha_Entrega"]).dt.date
-        entregas_planificadas = tmp
 
-    # Mapa: (centro, material) -> {fecha: cantidad_total_en_fecha}
-    entregas_map = {}
-    if not entregas_planificadas.empty:
-        grp = (
-            entregas_planificadas.groupby(["Centro", "Material", "Fecha_Entrega"])["Cantidad"]
-            .sum()
-            .reset_index()
+def _forecast_stock_centros_numpy(
+    stock_inicial: pd.DataFrame,
+    consumo: np.ndarray,
+    entregas_agrupadas: pd.DataFrame | None,
+    dias_forecast: int,
+    clamp_cero: bool,
+) -> pd.DataFrame:
+    """
+    Motor matricial del forecast, sobre el eje de días.
+
+    Las entregas (ya agregadas, con 'Dia_Entrega') se dispersan en una matriz densa día×CM
+    y el stock se encadena con operaciones vectoriales sobre todos los CM a la vez (un paso
+    por día). El orden de las operaciones en coma flotante es el mismo que en el bucle
+    original, así que el resultado es idéntico bit a bit.
+    `consumo` es el consumo diario alineado con las filas de stock_inicial.
+    """
+    n_cm = len(stock_inicial)
+    if n_cm == 0 or dias_forecast <= 0:
+        return pd.DataFrame([])
+
+    centros = stock_inicial["Centro"].to_numpy(dtype=object)
+    materiales = stock_inicial["Material"].to_numpy(dtype=object)
+
+    stock_raw = _stock_inicial_a_array(stock_inicial["Stock"])
+    consumo = np.asarray(consumo, dtype=float)
+
+    # === Matriz de entregas (día × CM) ===
+    entradas = np.zeros((dias_forecast, n_cm), dtype=float)
+    if entregas_agrupadas is not None and not entregas_agrupadas.empty:
+        # Join por clave normalizada: cada entrega va a todas las filas de su CM
+        filas_cm = indice_cm(centros, materiales).to_frame(index=False)
+        filas_cm["pos"] = np.arange(n_cm)
+        entregas_cm = indice_cm(
+            entregas_agrupadas["Centro"], entregas_agrupadas["Material"]
+        ).to_frame(index=False)
+        entregas_cm["Dia_Entrega"] = entregas_agrupadas["Dia_Entrega"].to_numpy(dtype=np.int64)
+        entregas_cm["Cantidad"] = entregas_agrupadas["Cantidad"].to_numpy(dtype=float)
+        entregas_cm = entregas_cm.merge(filas_cm, on=["Centro", "Material"], how="inner")
+
+        dias = entregas_cm["Dia_Entrega"].to_numpy()
+        en_horizonte = (dias >= 0) & (dias < dias_forecast)
+        entradas[dias[en_horizonte], entregas_cm["pos"].to_numpy()[en_horizonte]] = (
+            entregas_cm["Cantidad"].to_numpy()[en_horizonte]
         )
-        for _, r in grp.iterrows():
-            cm = (r["Centro"], r["Material"])
-            entregas_map.setdefault(cm, {})[r["Fecha_Entrega"]] = float(r["Cantidad"])
 
-    # Asegurar columnas mínimas en stock_inicial
+    # === Dinámica día a día, vectorizada sobre CM ===
+    stock_dia = np.empty((dias_forecast, n_cm), dtype=float)
+    deficit_dia = np.empty((dias_forecast, n_cm), dtype=float)
+
+    for d in range(dias_forecast):
+        stock_raw = stock_raw + entradas[d]
+        stock_raw = stock_raw - consumo
+
+        negativo = -stock_raw
+        deficit_dia[d] = np.where(negativo > 0, negativo, 0.0)
+        if clamp_cero:
+            stock_raw = np.where(stock_raw > 0, stock_raw, 0.0)
+        stock_dia[d] = stock_raw
+
+    deficit = deficit_dia.T.ravel()
+    forecast = pd.DataFrame({
+        "Dia": np.tile(np.arange(dias_forecast, dtype=np.int64), n_cm),
+        "Centro": np.repeat(centros, dias_forecast),
+        "Material": np.repeat(materiales, dias_forecast),
+        "Stock_estimado": stock_dia.T.ravel(),
+        "Deficit": deficit,
+        "Rotura": deficit > 0,
+    })
+    return forecast.infer_objects()
+
+
+def forecast_stock_centros_dias(
+    stock_inicial: pd.DataFrame,
+    parametros: ParametrosCM,
+    entregas_planificadas: pd.DataFrame | None,
+    dias_forecast: int,
+    clamp_cero: bool = True,
+) -> pd.DataFrame:
+    """
+    Forecast sobre el eje de días del motor V2 (forecast_stock_centros la envuelve con fechas).
+
+    - entregas_planificadas: columnas Centro, Material, Dia_Entrega, Cantidad.
+    - Devuelve Dia, Centro, Material, Stock_estimado, Deficit, Rotura: un bloque de
+      `dias_forecast` filas por fila de stock_inicial, en el mismo orden.
+    """
     required_cols = {"Centro", "Material", "Stock"}
     if not required_cols.issubset(set(stock_inicial.columns)):
         raise ValueError(f"stock_inicial debe tener columnas {required_cols}, tiene {set(stock_inicial.columns)}")
 
-    # Iterar por (Centro, Material)
-    for _, row in stock_inicial.iterrows():
-        centro = row["Centro"]
-        material = row["Material"]
-        try:
-            stock_raw = float(row["Stock"] or 0)
-        except Exception:
-            stock_raw = 0.0
+    grp = None
+    if entregas_planificadas is not None and not entregas_planificadas.empty:
+        grp = (
+            entregas_planificadas.groupby(["Centro", "Material", "Dia_Entrega"])["Cantidad"]
+            .sum()
+            .reset_index()
+        )
 
-        cons = float(consumo_diario.get((centro, material), 0.0))
-        entregas_cm = entregas_map.get((centro, material), {})
+    pos = parametros.posiciones(stock_inicial["Centro"], stock_inicial["Material"])
+    consumo = parametros.tomar("consumo_diario", pos, 0.0)
 
-        fecha = fecha_inicio
-        for _ in range(dias_forecast):
-            # Entradas del día (si las hay)
-            if fecha in entregas_cm:
-                stock_raw += float(entregas_cm[fecha])
+    return _forecast_stock_centros_numpy(stock_inicial, consumo, grp, dias_forecast, clamp_cero)
+
+
+def recalcular_forecast_cms(
+    forecast: pd.DataFrame,
+    stock_inicial: pd.DataFrame,
+    parametros: ParametrosCM,
+    entregas_planificadas: pd.DataFrame,
+    cms: set,
+    dias_forecast: int,
+    clamp_cero: bool = True,
+) -> pd.DataFrame:
+    """
+    Recalcula el forecast solo de los (Centro, Material) de `cms` y lo empalma en `forecast`.
 
-            # Consumo del día
-            stock_raw -= cons
+    - `forecast` debe venir de forecast_stock_centros_dias(stock_inicial, ...): un bloque de
+      `dias_forecast` filas por fila de stock_inicial, en el mismo orden.
+    - Con el horizonte anclado, cada CM solo depende de sus propias entregas, así que el resto
+      de bloques no cambia.
+    - Modifica `forecast` in place y devuelve únicamente el tramo recalculado.
+    """
+    claves_stock = pd.MultiIndex.from_arrays([stock_inicial["Centro"], stock_inicial["Material"]])
+    posiciones = np.flatnonzero(claves_stock.isin(list(cms)))
 
-            # Déficit y stock visible
-            deficit = max(0.0, -stock_raw)
-            stock_visible = max(0.0, stock_raw) if clamp_cero else stock_raw
+    if len(posiciones) == 0:
+        return forecast.iloc[0:0].copy()
 
-            forecast.append({
-                "Fecha": fecha,
-                "Centro": centro,
-                "Material": material,
-                "Stock_estimado": stock_visible,   # <- lo que usarán el resto de funciones
-                "Deficit": deficit,
-                "Rotura": deficit > 0,
-                # opcional para trazas: "Stock_Raw": stock_raw,
+    entregas_cms = entregas_planificadas
+    if entregas_planificadas is not None and not entregas_planificadas.empty:
+        claves_entregas = pd.MultiIndex.from_arrays(
+            [entregas_planificadas["Centro"], entregas_planificadas["Material"]]
+        )
+        entregas_cms = entregas_planificadas[claves_entregas.isin(list(cms))]
+
+    tramo = forecast_stock_centros_dias(
+        stock_inicial=stock_inicial.iloc[posiciones],
+        parametros=parametros,
+        entregas_planificadas=entregas_cms,
+        dias_forecast=dias_forecast,
+        clamp_cero=clamp_cero,
+    )
+
+    filas = (posiciones[:, None] * dias_forecast + np.arange(dias_forecast)).ravel()
+    for col in ("Stock_estimado", "Deficit", "Rotura"):
+        forecast.iloc[filas, forecast.columns.get_loc(col)] = tramo[col].to_numpy()
+
+    tramo.index = forecast.index[filas]
+    return tramo
+
+
+def planificar_pedidos_por_cm(
+    stock_inicial: pd.DataFrame,
+    parametros: ParametrosCM,
+    dias_forecast: int,
+    fecha_inicio: date,
+    dia_limite: int | None = None,
+    dia_corte: int = 2,
+    max_pedidos_por_cm: int = 50,
+) -> pd.DataFrame:
+    """
+    Planificador de una sola pasada por (Centro, Material).
+
+    Recorre el horizonte de cada CM una vez y coloca cada pedido en cuanto aparece la
+    primera rotura, aplicando en el acto las mismas reglas que el bucle iterativo:
+      - generar_pedidos_centros_desde_forecastV2: entrega en rotura - seg (nunca antes del día 0),
+        cantidad = ceil(consumo * (obj - seg))
+      - ajustar_pedidos_por_restricciones_logisticas_v2: adelanto al miércoles anterior
+      - ajustar_pedidos_a_minimos_logisticos_v2: PALET si dias_stock_pal < 11, si no CAP
+    Tras cada pedido solo se re-simula desde su día de entrega (los días previos no cambian).
+
+    Trabaja sobre el eje de días: fecha_inicio es el día 0 (para el día de la semana) y
+    dia_limite el último día en el que una rotura dispara pedido.
+    Devuelve los pedidos en el orden en que los emitiría el modo iterativo: ronda, Centro, Material.
+    """
+    cols = [
+        "Centro", "Material", "Dia_Carga", "Dia_Entrega", "Cantidad", "Dia_Rotura",
+        "Comentarios", "cajas_capa", "cajas_pal", "dias_stock_pal",
+    ]
+    if stock_inicial.empty or dias_forecast <= 0:
+        return pd.DataFrame(columns=cols)
+
+    dia_hoy = (date.today() - fecha_inicio).days
+    dow_inicio = fecha_inicio.weekday()
+    dia_limite = dias_forecast - 1 if dia_limite is None else min(dia_limite, dias_forecast - 1)
+
+    # Parámetros de todos los CM de una vez, por posición
+    pos = parametros.posiciones(stock_inicial["Centro"], stock_inicial["Material"])
+    con_params = (pos >= 0).tolist()
+    consumos = parametros.tomar("consumo_diario", pos, 0.0).tolist()
+    segs = parametros.tomar("dias_stock_seguridad", pos, 0).tolist()
+    objs = parametros.tomar("dias_stock_objetivo", pos, 0).tolist()
+    lookup = parametros.buscar(stock_inicial["Centro"], stock_inicial["Material"])
+    stocks = _stock_inicial_a_array(stock_inicial["Stock"])
+
+    pedidos = []
+    for centro, material, stock_0, cons, seg, obj, params_ok, cajas_capa, cajas_pal, dias_pal in zip(
+        stock_inicial["Centro"], stock_inicial["Material"], stocks, consumos, segs, objs, con_params,
+        lookup["cajas_capa"], lookup["cajas_pal"], lookup["dias_stock_pal"]
+    ):
+        cons_forecast = cons
+        cantidad_base = math.ceil(max(0.0, cons * max(0, obj - seg)))
+
+        capa = float(cajas_capa) if pd.notna(cajas_capa) else 0
+        palet = float(cajas_pal) if pd.notna(cajas_pal) else 0
+        dias_stock_pal = float(dias_pal) if pd.notna(dias_pal) else None
+
+        entradas = [0.0] * dias_forecast
+        stock_fin = [0.0] * dias_forecast
+        desde = 0
+
+        for ronda in range(max_pedidos_por_cm):
+            # Simular desde el último día de entrega y localizar la primera rotura
+            stock_raw = stock_0 if desde == 0 else stock_fin[desde - 1]
+            dia_rotura = None
+            for d in range(desde, dias_forecast):
+                stock_raw += entradas[d]
+                stock_raw -= cons_forecast
+                if dia_rotura is None and -stock_raw > 0 and d <= dia_limite:
+                    dia_rotura = d
+                stock_raw = max(0.0, stock_raw)
+                stock_fin[d] = stock_raw
+
+            if dia_rotura is None or cantidad_base <= 0:
+                break
+
+            # Pedido base (regla EPTY)
+            dia_carga = max(dia_rotura - seg, 0)
+            cantidad = cantidad_base
+            comentario = ""
+
+            # Restricción logística: rotura antes de dia_corte → miércoles anterior
+            dow = (dow_inicio + dia_rotura) % 7
+            if params_ok and dow < dia_corte:
+                nuevo_dia = max(dia_rotura - (dow + 5), dia_hoy)
+                dias_adelantados = dia_carga - nuevo_dia
+                cantidad = cons * max(1, obj - dias_adelantados)
+                dia_carga = nuevo_dia
+
+            # Mínimos logísticos
+            cantidad = float(cantidad) if pd.notna(cantidad) else 0
+            if cantidad > 0:
+                if palet > 0 and dias_stock_pal is not None and dias_stock_pal < 11:
+                    cantidad = math.ceil(cantidad / palet) * palet
+                    comentario = "Ajustado a PALET"
+                elif capa > 0:
+                    cantidad = math.ceil(cantidad / capa) * capa
+
+            pedidos.append({
+                "Ronda": ronda,
+                "Centro": str(centro),
+                "Material": int(material),
+                "Dia_Carga": dia_carga,
+                "Dia_Entrega": dia_carga,
+                "Cantidad": float(cantidad),
+                "Dia_Rotura": dia_rotura,
+                "Comentarios": comentario,
+                "cajas_capa": cajas_capa,
+                "cajas_pal": cajas_pal,
+                "dias_stock_pal": dias_pal,
             })
 
-            # Encadenar con el clamped para no propagar negativos
-            if clamp_cero:
-                stock_raw = stock_visible
+            # Entregas anteriores al día 0 no entran en el forecast (igual que forecast_stock_centros)
+            if dia_carga >= 0:
+                entradas[dia_carga] += float(cantidad)
+            desde = max(dia_carga, 0)
 
-            fecha += timedelta(days=1)
+    if not pedidos:
+        return pd.DataFrame(columns=cols)
 
-    return pd.DataFrame(forecast)
+    out = pd.DataFrame(pedidos)
+    out = out.sort_values(["Ronda", "Centro", "Material"], kind="stable").reset_index(drop=True)
+    out["Material"] = out["Material"].astype("Int64")
+    return out[cols]
 
 
 def reasignar_pedidos_desde_stock(pedidos_ajustados, stock_forecast, stock_objetivo, centro_principal="0801"):
@@ -710,150 +988,111 @@ def ajustar_pedidos_por_restricciones_logisticas(pedidos_df: pd.DataFrame, dia_c
 def ajustar_pedidos_por_restricciones_logisticas_v2(
     pedidos_df: pd.DataFrame,
     dia_corte: int,
-    consumo_diario: dict,
-    dias_stock_objetivo: dict
+    parametros: ParametrosCM,
+    fecha_inicio: date
 ):
-    import pandas as pd
-    from datetime import date, timedelta
+    """
+    Versión V2 sobre el eje de días (Dia_Rotura / Dia_Carga / Dia_Entrega desde fecha_inicio).
+    Si la rotura cae antes de `dia_corte` adelanta al miércoles de la semana anterior
+    (nunca antes de hoy) y recalcula la cantidad como consumo × días restantes.
+    Los pedidos de CM sin parámetros se dejan tal cual.
 
+    Columnar: máscaras + parámetros leídos por posición, sin iterar filas.
+    """
     if pedidos_df.empty:
         return pedidos_df
 
     pedidos = pedidos_df.copy()
 
-    pedidos["Fecha_Rotura"]  = pd.to_datetime(pedidos["Fecha_Rotura"]).dt.date
-    pedidos["Fecha_Carga"]   = pd.to_datetime(pedidos["Fecha_Carga"]).dt.date
-    pedidos["Fecha_Entrega"] = pd.to_datetime(pedidos["Fecha_Entrega"]).dt.date
-
-    hoy = date.today()
-    nuevas_filas = []
-
-    for _, row in pedidos.iterrows():
-        centro   = row["Centro"]
-        material = row["Material"]
-
-        consumo  = consumo_diario.get((centro, material))
-        dias_obj = dias_stock_objetivo.get((centro, material))
-
-        if consumo is None or dias_obj is None:
-            nuevas_filas.append(row)
-            continue
+    pos = parametros.posiciones(pedidos["Centro"], pedidos["Material"])
+    con_params = pos >= 0
 
-        fecha_rotura = row["Fecha_Rotura"]
-        dow = fecha_rotura.weekday()
-
-        # Caso donde NO adelanta
-        if dow >= dia_corte:
-            nuevas_filas.append(row)
-            continue
+    dia_hoy = (date.today() - fecha_inicio).days
+    dia_rotura = pedidos["Dia_Rotura"].to_numpy(dtype=np.int64)
+    dows = (fecha_inicio.weekday() + dia_rotura) % 7
 
-        # Adelanto
-        dias_retro = dow + 5
-        nueva_fecha = fecha_rotura - timedelta(days=dias_retro)
+    # Solo adelantan las roturas antes de dia_corte con parámetros informados
+    mover = con_params & (dows < dia_corte)
+    if not mover.any():
+        return pedidos
 
-        if nueva_fecha < hoy:
-            nueva_fecha = hoy
+    consumo = parametros.consumo_diario[pos[mover]]
+    dias_obj = parametros.dias_stock_objetivo[pos[mover]]
 
-        dias_adelantados = (row["Fecha_Carga"] - nueva_fecha).days
-        dias_reales = max(1, dias_obj - dias_adelantados)
+    # Miércoles de la semana anterior, nunca antes de hoy
+    nuevo_dia = np.maximum(dia_rotura[mover] - (dows[mover] + 5), dia_hoy)
 
-        nueva_cantidad = consumo * dias_reales
+    dias_adelantados = pedidos["Dia_Carga"].to_numpy(dtype=np.int64)[mover] - nuevo_dia
+    dias_reales = np.maximum(1, dias_obj - dias_adelantados)
 
-        final_row = row.copy()
-        final_row["Fecha_Carga"]   = nueva_fecha
-        final_row["Fecha_Entrega"] = nueva_fecha
-        final_row["Cantidad"]      = nueva_cantidad
-        # Mantener comentarios previos si existieran
-        prev = final_row.get("Comentarios", "")
-        nuevo = ""
+    cantidad = pedidos["Cantidad"].to_numpy(dtype=float)
+    cantidad[mover] = consumo * dias_reales
 
-        if prev:
-            final_row["Comentarios"] = prev + " • " + nuevo
-        else:
-            final_row["Comentarios"] = nuevo
+    dia_carga = pedidos["Dia_Carga"].to_numpy(dtype=np.int64).copy()
+    dia_entrega = pedidos["Dia_Entrega"].to_numpy(dtype=np.int64).copy()
+    dia_carga[mover] = nuevo_dia
+    dia_entrega[mover] = nuevo_dia
 
+    pedidos["Dia_Carga"] = dia_carga
+    pedidos["Dia_Entrega"] = dia_entrega
+    pedidos["Cantidad"] = cantidad
 
-        nuevas_filas.append(final_row)
+    # Mantener comentarios previos si existieran
+    if "Comentarios" not in pedidos.columns:
+        pedidos["Comentarios"] = np.nan
+        pedidos.loc[mover, "Comentarios"] = ""
+    else:
+        prev = pedidos.loc[mover, "Comentarios"]
+        pedidos.loc[mover, "Comentarios"] = prev.mask(prev.astype(bool), prev + " • ")
 
-    return pd.DataFrame(nuevas_filas)
+    return pedidos
 
 def ajustar_pedidos_a_minimos_logisticos_v2(
     pedidos_df: pd.DataFrame,
-    df_minimos: pd.DataFrame,
-    df_rotacion: pd.DataFrame
+    parametros: ParametrosCM
 ) -> pd.DataFrame:
-
+    """
+    Redondea la cantidad de cada pedido al mínimo logístico de su (Centro, Material):
+      - PALET si hay cajas_pal y dias_stock_pal < 11 (alta rotación) → comentario "Ajustado a PALET"
+      - si no, CAP (múltiplo superior de cajas_capa)
+      - sin datos o cantidad <= 0 → se deja tal cual
+    Los mínimos salen de la tabla de parámetros (solo lectura). Deja el resultado en
+    'Cantidad_ajustada' y añade cajas_capa / cajas_pal / dias_stock_pal como referencia.
+    """
     if pedidos_df.empty:
         return pedidos_df
 
     pedidos = pedidos_df.copy()
     pedidos["Material"] = pd.to_numeric(pedidos["Material"], errors="coerce").astype("Int64")
 
-    df_minimos.columns = [c.strip().lower() for c in df_minimos.columns]
-    df_minimos["material"] = pd.to_numeric(df_minimos["material"], errors="coerce").astype("Int64")
-
-    df_rotacion.columns = [c.strip().lower() for c in df_rotacion.columns]
-    df_rotacion["material"] = pd.to_numeric(df_rotacion["material"], errors="coerce").astype("Int64")
-
-    merged = (
-        pedidos
-        .merge(df_minimos[["material", "cajas_capa"]], left_on="Material", right_on="material", how="left")
-        .merge(df_rotacion[["centro", "material", "cajas_pal", "dias_stock_pal"]],
-               left_on=["Centro","Material"],
-               right_on=["centro","material"],
-               how="left")
-    )
-
-    ajustes = []
-    comentarios = []
-
-    for _, row in merged.iterrows():
-    
-        cantidad = float(row["Cantidad"]) if pd.notna(row["Cantidad"]) else 0
-    
-        capa = float(row["cajas_capa"]) if pd.notna(row["cajas_capa"]) else 0
-        palet = float(row["cajas_pal"]) if pd.notna(row["cajas_pal"]) else 0
-        dias_stock_pal = float(row["dias_stock_pal"]) if pd.notna(row["dias_stock_pal"]) else None
-        
-        comentario_prev = row.get("Comentarios", "") if "Comentarios" in row else ""
-
-        if cantidad <= 0:
-            ajustes.append(cantidad)
-            comentarios.append(comentario_prev)
-            continue
-
-        # 🔥 Ajuste a PALET (alta rotación)
-        if palet > 0 and dias_stock_pal is not None and dias_stock_pal < 11:
-            cantidad_ajustada = math.ceil(cantidad / palet) * palet
-            
-            nuevo = "Ajustado a PALET"
-            if comentario_prev:
-                comentarios.append(comentario_prev + " • " + nuevo)
-            else:
-                comentarios.append(nuevo)
-
-            ajustes.append(cantidad_ajustada)
-            continue
-
-        # Ajuste a CAP
-        if capa > 0:
-            cantidad_ajustada = math.ceil(cantidad / capa) * capa
-            ajustes.append(cantidad_ajustada)
-            comentarios.append(comentario_prev)
-        else:
-            ajustes.append(cantidad)
-            comentarios.append(comentario_prev)
-
-    merged["Cantidad_ajustada"] = ajustes
-    merged["Comentarios"] = comentarios
-
-    merged.drop(columns=["material", "centro"], inplace=True, errors="ignore")
-    merged = merged.loc[:, ~merged.columns.duplicated()]
-
-    return merged
-
+    lookup = parametros.buscar(pedidos["Centro"], pedidos["Material"])
+    capa = lookup["cajas_capa"].to_numpy()
+    palet = lookup["cajas_pal"].to_numpy()
+    dias_stock_pal = lookup["dias_stock_pal"].to_numpy()
 
+    cantidad = pd.to_numeric(pedidos["Cantidad"], errors="coerce").fillna(0).to_numpy(dtype=float)
 
+    # 🔥 Ajuste a PALET (alta rotación); si no, a CAP
+    a_palet = (cantidad > 0) & (palet > 0) & (dias_stock_pal < 11)
+    a_capa = (cantidad > 0) & ~a_palet & (capa > 0)
 
+    ajustada = cantidad.copy()
+    ajustada[a_palet] = np.ceil(cantidad[a_palet] / palet[a_palet]) * palet[a_palet]
+    ajustada[a_capa] = np.ceil(cantidad[a_capa] / capa[a_capa]) * capa[a_capa]
 
+    if "Comentarios" in pedidos.columns:
+        prev = pedidos["Comentarios"]
+    else:
+        prev = pd.Series("", index=pedidos.index)
+    nuevo = "Ajustado a PALET"
+    comentarios = prev.copy()
+    prev_palet = prev[a_palet]
+    comentarios[a_palet] = np.where(prev_palet.astype(bool), prev_palet + " • " + nuevo, nuevo)
+
+    pedidos["cajas_capa"] = capa
+    pedidos["cajas_pal"] = palet
+    pedidos["dias_stock_pal"] = dias_stock_pal
+    pedidos["Cantidad_ajustada"] = ajustada
+    pedidos["Comentarios"] = comentarios
 
+    return pedidos
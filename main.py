@@ -1,14 +1,37 @@
-from fastapi import FastAPI
-from google.cloud import bigquery
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from typing import Optional
+import pandas as pd
 from pipeline import ejecutar_pipeline
-from pipeline_v2 import ejecutar_pipeline_v2        # ⬅️ añadimos esto
+from pipeline_v2 import (        # ⬅️ añadimos esto
+    COLUMNAS_SHEETS, ejecutar_pipeline_v2, ejecutar_pipeline_v2_lote, tablas_reemplazadas
+)
+
+from carga_params import TABLAS_VERSION_DATOS, generar_filtro_cm, parametro_universo_cm
+from fuente_datos import fuente_por_defecto
+from cache_referencia import CACHE_REFERENCIA
+from cache_resultados import CACHE_RESULTADOS
+from escrituras import ESCRITURAS, ESPERA_APAGADO_SEG
+from formatos_salida import FORMATOS, acepta_gzip, flujo_pedidos, negociar_formato
+from metricas import METRICAS_PROCESO
+from trabajos import ColaLlena, GestorTrabajos
 
-from carga_params import generar_filtro_cm
 
+@asynccontextmanager
+async def ciclo_de_vida(app: FastAPI):
+    yield
+    # Apagado: las escrituras diferidas viven solo en memoria; se esperan antes de salir
+    pendientes = ESCRITURAS.estadisticas()["pendientes"]
+    if pendientes:
+        print(f"💾 Esperando {pendientes} escrituras pendientes (máx. {ESPERA_APAGADO_SEG:.0f}s)...")
+    for escritura in ESCRITURAS.drenar(ESPERA_APAGADO_SEG):
+        print(f"❌ Escritura de {escritura.tabla} sin terminar al apagar ({escritura.estado}, "
+              f"{escritura.filas} filas)")
 
-app = FastAPI()
-bq = bigquery.Client()
+
+app = FastAPI(lifespan=ciclo_de_vida)
 
 
 # -------------------------------------------------------------
@@ -65,31 +88,376 @@ def planificar(
 # -------------------------------------------------------------
 @app.get("/planificar_v2")
 def planificar_v2(
+    request: Request,
     proveedor_id: Optional[int] = None,
     consumo_extra_pct: float = 0.0,
     centro: str | None = None,
-    fecha_corte: str | None = None
+    fecha_corte: str | None = None,
+    modo: str = "iterativo",
+    timings: bool = False,
+    refrescar: bool = False,
+    formato: str | None = None,
+    esperar_escritura: bool = False
 ):
     """
     Versión experimental del pipeline (V2).
     Lleva: CMD ajustado por rotura + estacionalidad + restricción logística V2 + CAP/PAL.
+    `modo`: 'iterativo' (bucle de re-forecast) o 'una_pasada' (planificador por CM).
+    `timings`: incluir en la respuesta la duración y filas por etapa de la ejecución.
+    `refrescar`: recalcular aunque haya un resultado cacheado con los mismos datos.
+    `formato`: json (por defecto), ndjson, csv o arrow; sin él se negocia con la cabecera
+    Accept. Los formatos de streaming envían solo los pedidos, por bloques y con gzip si el
+    cliente lo acepta; el resto de la respuesta va en cabeceras X-Planificador-*.
+    Las peticiones repetidas se sirven de CACHE_RESULTADOS mientras no cambien los datos
+    (sin reescribir las tablas de salida; si otra ejecución las ha reemplazado desde entonces,
+    se recalcula); el bloque `cache` indica de dónde sale la respuesta.
+    La escritura de forecast y pedidos sigue en segundo plano tras responder (bloque
+    `escrituras`, ver GET /planificar_v2/escrituras/{id}); `esperar_escritura=true` responde
+    cuando las tablas ya están escritas.
+    Para ejecuciones largas, ver POST /planificar_v2/trabajos.
     """
+    formato = _formato_o_422(request, formato)
+    _validar_modo(modo)
+    parametros = {
+        "proveedor_id": proveedor_id,
+        "consumo_extra_pct": consumo_extra_pct,
+        "centro": centro,
+        "fecha_corte": fecha_corte,
+        "modo": modo,
+    }
+    resultado, info_cache = _calcular_v2(**parametros, refrescar=refrescar, esperar_escritura=esperar_escritura)
+    return _respuesta_v2(request, parametros, resultado, info_cache, timings, formato)
 
-    resultado = ejecutar_pipeline_v2(
-        proveedor_id=proveedor_id,
-        consumo_extra_pct=consumo_extra_pct,
-        centro=centro,
-        fecha_corte=fecha_corte
+
+def _calcular_v2(
+    proveedor_id, consumo_extra_pct, centro, fecha_corte, modo, refrescar=False, metricas=None, esperar_escritura=False
+):
+    """(resultado, info_cache) del pipeline V2, servido de CACHE_RESULTADOS si los datos no cambiaron."""
+    fuente = fuente_por_defecto()
+    return _obtener_resultado(
+        fuente,
+        clave=(proveedor_id, consumo_extra_pct, centro, fecha_corte, modo),
+        calcular=lambda: ejecutar_pipeline_v2(
+            proveedor_id=proveedor_id,
+            consumo_extra_pct=consumo_extra_pct,
+            centro=centro,
+            fecha_corte=fecha_corte,
+            modo_planificacion=modo,
+            fuente=fuente,
+            metricas=metricas,
+            escritura_diferida=False if esperar_escritura else None
+        ),
+        refrescar=refrescar,
+        esperar_escritura=esperar_escritura
     )
 
-    return {
+
+def _obtener_resultado(fuente, clave: tuple, calcular, refrescar: bool, esperar_escritura: bool) -> tuple:
+    """
+    CACHE_RESULTADOS.obtener sobre TABLAS_VERSION_DATOS. Si otra ejecución ha reemplazado
+    después alguna tabla de salida del resultado cacheado, se vuelve a planificar: la caché no
+    guarda los DataFrames escritos, y el nuevo cálculo reescribe las tablas.
+    Con `esperar_escritura` vuelve cuando ha terminado el grupo de escrituras del resultado,
+    también si sale de la caché o de un cálculo compartido con escritura diferida.
+    """
+    resultado, info_cache = CACHE_RESULTADOS.obtener(fuente, clave, TABLAS_VERSION_DATOS, calcular, refrescar)
+    if info_cache["estado"] != "calculado":
+        reemplazadas = tablas_reemplazadas(fuente, resultado["escrituras"])
+        if reemplazadas:
+            print(f"🔁 Resultado de caché con tablas reemplazadas ({', '.join(reemplazadas)}): recalculando")
+            resultado, info_cache = CACHE_RESULTADOS.obtener(
+                fuente, clave, TABLAS_VERSION_DATOS, calcular, refrescar=True
+            )
+    if esperar_escritura and resultado["escrituras"] is not None:
+        grupo = ESCRITURAS.obtener(resultado["escrituras"]["escrituras_id"])
+        if grupo is not None:
+            ESCRITURAS.esperar(grupo)
+    return resultado, info_cache
+
+
+def _respuesta_v2(request: Request, parametros: dict, resultado: dict, info_cache: dict, timings: bool, formato: str):
+    if formato != "json":
+        return _flujo_pedidos(request, resultado["pedidos"], formato, {
+            "Pedidos-Rows": resultado["pedidos_rows"],
+            "Forecast-Rows": resultado["forecast_rows"],
+            "Dias-Forecast": resultado["dias_forecast"],
+            "Cache": info_cache["estado"],
+            "Escrituras-Id": resultado["escrituras"]["escrituras_id"],
+        })
+
+    respuesta = {
         "status": "OK_V2",
-        "proveedor_id": proveedor_id,
+        "proveedor_id": parametros["proveedor_id"],
+        "consumo_extra_pct": parametros["consumo_extra_pct"],
+        "centro": parametros["centro"],
+        "fecha_corte": parametros["fecha_corte"],
+        "resultado": _resultado_json(resultado),
+        "cache": info_cache
+    }
+    if timings:
+        respuesta["timings"] = resultado["timings"]
+    return respuesta
+
+
+def _resultado_json(resultado: dict) -> dict:
+    # El resultado cacheado es compartido: se copia el nivel superior sin los timings, con
+    # los pedidos como lista de registros y el estado actual de sus escrituras
+    respuesta = {
+        **{k: v for k, v in resultado.items() if k not in ("timings", "pedidos")},
+        "pedidos": resultado["pedidos"].to_dict(orient="records"),
+    }
+    if "escrituras" in resultado:
+        respuesta["escrituras"] = _estado_escrituras(resultado["escrituras"])
+    return respuesta
+
+
+def _estado_escrituras(referencia: dict | None) -> dict | None:
+    """Estado actual del grupo de escrituras de un resultado (también si sale de la caché)."""
+    if referencia is None:
+        return None
+    escrituras_id = referencia["escrituras_id"]
+    grupo = ESCRITURAS.obtener(escrituras_id)
+    return {
+        **(grupo.descripcion() if grupo else {"escrituras_id": escrituras_id, "estado": "caducado"}),
+        "diferida": referencia["diferida"],
+        "estado_url": f"/planificar_v2/escrituras/{escrituras_id}",
+    }
+
+
+def _validar_modo(modo: str):
+    if modo not in ("iterativo", "una_pasada"):
+        raise HTTPException(status_code=422, detail=f"modo debe ser 'iterativo' o 'una_pasada', no {modo!r}")
+
+
+def _formato_o_422(request: Request, formato: str | None) -> str:
+    try:
+        return negociar_formato(formato, request.headers.get("accept"))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+def _flujo_pedidos(request: Request, pedidos, formato: str, cabeceras: dict) -> StreamingResponse:
+    """Pedidos en streaming (ndjson, csv o arrow), con gzip si el cliente lo acepta."""
+    gzip = acepta_gzip(request.headers.get("accept-encoding"))
+    headers = {f"X-Planificador-{nombre}": str(valor) for nombre, valor in cabeceras.items()}
+    headers["Vary"] = "Accept, Accept-Encoding"
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(
+        flujo_pedidos(pedidos, formato, gzip=gzip),
+        media_type=FORMATOS[formato],
+        headers=headers
+    )
+
+
+# -------------------------------------------------------------
+# 1.1.1) PLANIFICACIÓN V2 DE VARIOS PROVEEDORES (lote)
+# -------------------------------------------------------------
+@app.get("/planificar_v2/lote")
+def planificar_v2_lote(
+    request: Request,
+    proveedores: str,
+    consumo_extra_pct: float = 0.0,
+    centro: str | None = None,
+    fecha_corte: str | None = None,
+    modo: str = "iterativo",
+    timings: bool = False,
+    refrescar: bool = False,
+    formato: str | None = None,
+    esperar_escritura: bool = False
+):
+    """
+    Planificación V2 de varios proveedores (`proveedores=101,205,...`) con una sola carga de
+    datos: mismo resultado por proveedor que GET /planificar_v2, en "resultados"; los
+    proveedores sin datos van a "errores". Escribe una tabla de forecast por proveedor y los
+    pedidos de todo el lote en Tbl_Pedidos_Simples_V2.
+    `formato` y `esperar_escritura` como en /planificar_v2 (en streaming, los pedidos de todos
+    los proveedores).
+    """
+    formato = _formato_o_422(request, formato)
+    try:
+        lista = list(dict.fromkeys(int(p) for p in proveedores.split(",") if p.strip()))
+    except ValueError:
+        raise HTTPException(
+            status_code=422,
+            detail=f"proveedores debe ser una lista de enteros separados por comas, no {proveedores!r}"
+        )
+    if not lista:
+        raise HTTPException(status_code=422, detail="Hace falta al menos un proveedor")
+    _validar_modo(modo)
+
+    fuente = fuente_por_defecto()
+    resultado, info_cache = _obtener_resultado(
+        fuente,
+        clave=("lote", tuple(lista), consumo_extra_pct, centro, fecha_corte, modo),
+        calcular=lambda: ejecutar_pipeline_v2_lote(
+            lista,
+            consumo_extra_pct=consumo_extra_pct,
+            centro=centro,
+            fecha_corte=fecha_corte,
+            modo_planificacion=modo,
+            fuente=fuente,
+            escritura_diferida=False if esperar_escritura else None
+        ),
+        refrescar=refrescar,
+        esperar_escritura=esperar_escritura
+    )
+
+    if formato != "json":
+        pedidos = [r["pedidos"] for r in resultado["resultados"]]
+        return _flujo_pedidos(
+            request,
+            pd.concat(pedidos, ignore_index=True) if pedidos else pd.DataFrame(columns=COLUMNAS_SHEETS),
+            formato,
+            {
+                "Pedidos-Rows": sum(r["pedidos_rows"] for r in resultado["resultados"]),
+                "Proveedores": ",".join(str(r["proveedor"]) for r in resultado["resultados"]),
+                "Errores": ",".join(str(e["proveedor"]) for e in resultado["errores"]),
+                "Cache": info_cache["estado"],
+                "Escrituras-Id": (resultado["escrituras"] or {}).get("escrituras_id", ""),
+            }
+        )
+
+    respuesta = {
+        "status": "OK_V2_LOTE",
+        "proveedores": lista,
         "consumo_extra_pct": consumo_extra_pct,
         "centro": centro,
         "fecha_corte": fecha_corte,
-        "resultado": resultado
+        "resultados": [_resultado_json(r) for r in resultado["resultados"]],
+        "errores": resultado["errores"],
+        "escrituras": _estado_escrituras(resultado["escrituras"]),
+        "cache": info_cache
+    }
+    if timings:
+        respuesta["timings"] = resultado["timings"]
+    return respuesta
+
+
+# -------------------------------------------------------------
+# 1.1.2) PLANIFICACIÓN V2 EN SEGUNDO PLANO (trabajos)
+# -------------------------------------------------------------
+trabajos_v2 = GestorTrabajos(_calcular_v2)
+
+
+@app.post("/planificar_v2/trabajos", status_code=202)
+def crear_trabajo_v2(
+    proveedor_id: Optional[int] = None,
+    consumo_extra_pct: float = 0.0,
+    centro: str | None = None,
+    fecha_corte: str | None = None,
+    modo: str = "iterativo",
+    refrescar: bool = False
+):
+    """
+    Encola una planificación V2 (mismos parámetros que GET /planificar_v2) y devuelve su id
+    al momento. Estado y etapa en curso: GET /planificar_v2/trabajos/{id};
+    respuesta completa al terminar: GET /planificar_v2/trabajos/{id}/resultado.
+    """
+    _validar_modo(modo)
+    try:
+        trabajo = trabajos_v2.enviar({
+            "proveedor_id": proveedor_id,
+            "consumo_extra_pct": consumo_extra_pct,
+            "centro": centro,
+            "fecha_corte": fecha_corte,
+            "modo": modo,
+            "refrescar": refrescar,
+        })
+    except ColaLlena as e:
+        raise HTTPException(status_code=429, detail=str(e))
+
+    return {
+        **trabajo.descripcion(),
+        "estado_url": f"/planificar_v2/trabajos/{trabajo.id}",
+        "resultado_url": f"/planificar_v2/trabajos/{trabajo.id}/resultado",
+    }
+
+
+@app.get("/planificar_v2/trabajos")
+def listar_trabajos_v2():
+    return {"trabajos": [t.descripcion() for t in trabajos_v2.listar()]}
+
+
+@app.get("/planificar_v2/trabajos/{trabajo_id}")
+def estado_trabajo_v2(trabajo_id: str):
+    return _trabajo_o_404(trabajo_id).descripcion()
+
+
+@app.get("/planificar_v2/trabajos/{trabajo_id}/resultado")
+def resultado_trabajo_v2(request: Request, trabajo_id: str, timings: bool = False, formato: str | None = None):
+    """
+    200 con la respuesta de /planificar_v2 si terminó (mismos `timings` / `formato`);
+    202 con el estado si sigue en curso.
+    """
+    trabajo = _trabajo_o_404(trabajo_id)
+    if trabajo.estado == "error":
+        raise HTTPException(status_code=500, detail=trabajo.descripcion())
+    if trabajo.estado != "completado":
+        return JSONResponse(status_code=202, content=trabajo.descripcion())
+
+    resultado, info_cache = trabajo.resultado
+    return _respuesta_v2(
+        request, trabajo.parametros, resultado, info_cache, timings, _formato_o_422(request, formato)
+    )
+
+
+def _trabajo_o_404(trabajo_id: str):
+    trabajo = trabajos_v2.obtener(trabajo_id)
+    if trabajo is None:
+        raise HTTPException(status_code=404, detail=f"Trabajo {trabajo_id} no encontrado o caducado")
+    return trabajo
+
+
+# -------------------------------------------------------------
+# 1.1.3) ESCRITURAS EN SEGUNDO PLANO (forecast y pedidos)
+# -------------------------------------------------------------
+@app.get("/planificar_v2/escrituras")
+def listar_escrituras_v2():
+    return {
+        **ESCRITURAS.estadisticas(),
+        "grupos": [g.descripcion() for g in ESCRITURAS.listar()],
+    }
+
+
+@app.get("/planificar_v2/escrituras/{escrituras_id}")
+def estado_escrituras_v2(escrituras_id: str):
+    """Estado de las escrituras de una ejecución: por tabla, intentos, duración y error."""
+    grupo = ESCRITURAS.obtener(escrituras_id)
+    if grupo is None:
+        raise HTTPException(status_code=404, detail=f"Escrituras {escrituras_id} no encontradas o caducadas")
+    return grupo.descripcion()
+
+
+# -------------------------------------------------------------
+# 1.2) MÉTRICAS PROMETHEUS
+# -------------------------------------------------------------
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """Tiempos / filas por etapa acumulados del pipeline V2, estado de las cachés y de las escrituras."""
+    cache = CACHE_REFERENCIA.estadisticas()
+    resultados = CACHE_RESULTADOS.estadisticas()
+    escrituras = ESCRITURAS.estadisticas()
+    gauges = {
+        **{f"planificador_cache_referencia_{k}": cache[k] for k in ("entradas", "bytes")},
+        **{f"planificador_cache_resultados_{k}": resultados[k] for k in ("entradas", "en_curso")},
+        **{f"planificador_escrituras_{k}": escrituras[k] for k in ("pendientes", "filas_pendientes")},
+    }
+    contadores = {
+        **{f"planificador_cache_referencia_{k}_total": cache[k] for k in ("aciertos", "revalidaciones", "cargas")},
+        **{
+            f"planificador_cache_resultados_{k}_total": resultados[k]
+            for k in ("aciertos", "revalidaciones", "compartidas", "calculos")
+        },
+        **{
+            f"planificador_escrituras_{k}_total": escrituras[k]
+            for k in ("completadas", "reemplazadas", "fallidas", "reintentos", "filas_subidas")
+        },
     }
+    return PlainTextResponse(
+        METRICAS_PROCESO.exponer(gauges, contadores),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
 # -------------------------------------------------------------
 # 2) ENDPOINT DE ROTURAS TOTALES PARA REVISIÓN MANUAL
@@ -97,10 +465,10 @@ def planificar_v2(
 @app.get("/materiales_revisar")
 def materiales_revisar(proveedor_id: int):
 
-    client = bigquery.Client()
+    fuente = fuente_por_defecto()
 
     # 1) Reutilizamos el mismo filtro CM del pipeline
-    df_cm = generar_filtro_cm(client, proveedor_id)
+    df_cm = generar_filtro_cm(fuente, proveedor_id)
 
     if df_cm.empty:
         return {
@@ -108,20 +476,13 @@ def materiales_revisar(proveedor_id: int):
             "materiales_revisar": []
         }
 
-    # Convertir a lista de pares CM
-    pares = [(row["Centro"], row["Material"]) for _, row in df_cm.iterrows()]
-
-    # 2) Construcción dinámica para BigQuery
-    cm_structs = ",\n        ".join(
-        [f"STRUCT('{c}' AS Centro, {m} AS Material)" for c, m in pares]
-    )
+    # 2) Universo CM como parámetro ARRAY<STRUCT> (SQL de tamaño constante)
+    parametros = {"cm": parametro_universo_cm(df_cm, con_proveedor=False)}
 
     # 3) Query contra vista curada
-    query = f"""
+    query = """
         WITH cm AS (
-          SELECT * FROM UNNEST([
-            {cm_structs}
-          ])
+          SELECT * FROM UNNEST(@cm)
         )
         SELECT 
             z.Centro,
@@ -136,18 +497,18 @@ def materiales_revisar(proveedor_id: int):
         WHERE z.Flag_Rotura_Total = 1
     """
 
-    results = client.query(query).result()
+    results = fuente.filas(query, parametros)
 
     materiales = []
     for row in results:
         materiales.append({
-            "centro": row.Centro,
-            "material": row.Material,
-            "dias_rotura_21d": row.dias_rotura_21d,
-            "cmd_sap": row.CMD_SAP,
-            "cmd_ajustado_rotura": row.CMD_Ajustado_Rotura,
-            "ratio_ly": row.ratio_ly,
-            "cmd_ajustado_final": row.CMD_Ajustado_Final,
+            "centro": row["Centro"],
+            "material": row["Material"],
+            "dias_rotura_21d": row["dias_rotura_21d"],
+            "cmd_sap": row["CMD_SAP"],
+            "cmd_ajustado_rotura": row["CMD_Ajustado_Rotura"],
+            "ratio_ly": row["ratio_ly"],
+            "cmd_ajustado_final": row["CMD_Ajustado_Final"],
         })
 
     return {
@@ -0,0 +1,231 @@
+# ============================================================
+# metricas.py – Tiempos y contadores por etapa del pipeline V2
+# ============================================================
+#
+#   - MetricasEjecucion: registro de una ejecución (duración y filas por etapa, contadores,
+#     detalle por iteración). Su resumen() es el bloque `timings` de /planificar_v2.
+#   - MetricasProceso: acumulado de todas las ejecuciones del proceso, expuesto en formato
+#     texto de Prometheus por /metrics (sin dependencias externas).
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Límites (segundos) de los histogramas Prometheus
+BUCKETS_SEGUNDOS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class MetricasEjecucion:
+    """
+    Registro de una ejecución del pipeline. Una etapa puede registrarse varias veces (p. ej.
+    el forecast en cada iteración): se acumulan segundos, llamadas y filas.
+    La escribe un único hilo (el de la ejecución); progreso() puede leerse desde otros.
+    """
+
+    def __init__(self):
+        self.etapas: dict = {}
+        self.contadores: dict = {}
+        self.iteraciones: list = []
+        self.etapa_actual: str | None = None
+        self._inicio = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def etapa(self, nombre: str, filas: int | None = None):
+        """
+        Cronometra el bloque como `nombre`. Las filas pueden fijarse al final desde dentro:
+            with metricas.etapa("forecast") as e:
+                forecast = ...
+                e["filas"] = len(forecast)
+        """
+        registro = {"filas": filas}
+        anterior, self.etapa_actual = self.etapa_actual, nombre
+        t0 = time.perf_counter()
+        try:
+            yield registro
+        finally:
+            self.registrar(nombre, time.perf_counter() - t0, registro["filas"])
+            self.etapa_actual = anterior
+
+    def registrar(self, nombre: str, segundos: float, filas: int | None = None):
+        with self._lock:
+            etapa = self.etapas.setdefault(nombre, {"segundos": 0.0, "llamadas": 0, "filas": 0})
+            etapa["segundos"] += segundos
+            etapa["llamadas"] += 1
+            if filas is not None:
+                etapa["filas"] += int(filas)
+
+    def contar(self, nombre: str, n: int = 1):
+        with self._lock:
+            self.contadores[nombre] = self.contadores.get(nombre, 0) + int(n)
+
+    def iteracion(self, **datos):
+        """Detalle de una iteración del modo iterativo (roturas, CM recalculados, pedidos...)."""
+        with self._lock:
+            self.iteraciones.append(datos)
+
+    def combinar(self, resumenes: list):
+        """
+        Acumula el resumen() de ejecuciones parciales (p. ej. los fragmentos de una planificación
+        en paralelo): etapas y contadores se suman (segundos = tiempo de CPU de todos los
+        fragmentos), salvo "iteraciones", que toma el máximo. Las iteraciones de igual número
+        se funden: se suman CM recalculados, roturas y pedidos y se toma la más lenta.
+        """
+        with self._lock:
+            por_numero = {it["iteracion"]: dict(it) for it in self.iteraciones}
+            for resumen in resumenes:
+                for nombre, e in resumen["etapas"].items():
+                    etapa = self.etapas.setdefault(nombre, {"segundos": 0.0, "llamadas": 0, "filas": 0})
+                    for campo in ("segundos", "llamadas", "filas"):
+                        etapa[campo] += e[campo]
+
+                for nombre, valor in resumen["contadores"].items():
+                    actual = self.contadores.get(nombre, 0)
+                    self.contadores[nombre] = max(actual, valor) if nombre == "iteraciones" else actual + valor
+
+                for it in resumen["iteraciones"]:
+                    fundida = por_numero.get(it["iteracion"])
+                    if fundida is None:
+                        por_numero[it["iteracion"]] = dict(it)
+                        continue
+                    for campo in ("cms_recalculados", "roturas", "pedidos"):
+                        fundida[campo] += it[campo]
+                    fundida["segundos"] = max(fundida["segundos"], it["segundos"])
+
+            self.iteraciones = [por_numero[n] for n in sorted(por_numero)]
+
+    def progreso(self) -> dict:
+        """Instantánea para seguir una ejecución en curso: etapa actual y etapas ya medidas."""
+        with self._lock:
+            return {
+                "etapa_actual": self.etapa_actual,
+                "etapas_completadas": {n: round(e["segundos"], 4) for n, e in self.etapas.items()},
+                "iteraciones": self.contadores.get("iteraciones", 0),
+            }
+
+    def total_segundos(self) -> float:
+        return time.perf_counter() - self._inicio
+
+    def resumen(self) -> dict:
+        with self._lock:
+            return self._resumen()
+
+    def _resumen(self) -> dict:
+        return {
+            "total_seg": round(self.total_segundos(), 4),
+            "etapas": {
+                nombre: {**e, "segundos": round(e["segundos"], 4)} for nombre, e in self.etapas.items()
+            },
+            "contadores": dict(self.contadores),
+            "iteraciones": list(self.iteraciones),
+        }
+
+
+class _Histograma:
+
+    def __init__(self, limites=BUCKETS_SEGUNDOS):
+        self.limites = limites
+        self.cubetas = [0] * len(limites)
+        self.suma = 0.0
+        self.cuenta = 0
+
+    def observar(self, valor: float):
+        for i, limite in enumerate(self.limites):
+            if valor <= limite:
+                self.cubetas[i] += 1
+        self.suma += valor
+        self.cuenta += 1
+
+
+def _escapar(valor) -> str:
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _etiquetas(**etiquetas) -> str:
+    if not etiquetas:
+        return ""
+    return "{" + ",".join(f'{k}="{_escapar(v)}"' for k, v in etiquetas.items()) + "}"
+
+
+def _nombre_metrica(texto: str) -> str:
+    return "".join(c if c.isalnum() or c == "_" else "_" for c in texto)
+
+
+class MetricasProceso:
+    """
+    Acumulado del proceso (todas las ejecuciones), thread-safe:
+      - planificador_ejecuciones_total{estado}
+      - planificador_ejecucion_segundos (histograma de la duración total)
+      - planificador_etapa_segundos{etapa} (histograma: una observación por ejecución y etapa)
+      - planificador_etapa_filas_total{etapa}
+      - planificador_<contador>_total de los contadores de cada ejecución
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ejecuciones: dict = {}
+        self.duracion = _Histograma()
+        self.etapas: dict = {}
+        self.filas: dict = {}
+        self.contadores: dict = {}
+
+    def observar(self, metricas: MetricasEjecucion, estado: str = "ok"):
+        with self._lock:
+            self.ejecuciones[estado] = self.ejecuciones.get(estado, 0) + 1
+            self.duracion.observar(metricas.total_segundos())
+            for nombre, etapa in metricas.etapas.items():
+                self.etapas.setdefault(nombre, _Histograma()).observar(etapa["segundos"])
+                self.filas[nombre] = self.filas.get(nombre, 0) + etapa["filas"]
+            for nombre, valor in metricas.contadores.items():
+                self.contadores[nombre] = self.contadores.get(nombre, 0) + valor
+
+    def exponer(self, gauges: dict | None = None, contadores: dict | None = None) -> str:
+        """
+        Texto en formato de exposición de Prometheus (text/plain; version=0.0.4).
+        `gauges` / `contadores`: métricas adicionales de otros componentes {nombre_metrica: valor}.
+        """
+        lineas = []
+
+        def cabecera(nombre, tipo, ayuda):
+            lineas.append(f"# HELP {nombre} {ayuda}")
+            lineas.append(f"# TYPE {nombre} {tipo}")
+
+        def histograma(nombre, h: _Histograma, **etiquetas):
+            for limite, n in zip(h.limites, h.cubetas):
+                lineas.append(f"{nombre}_bucket{_etiquetas(**etiquetas, le=limite)} {n}")
+            lineas.append(f"{nombre}_bucket{_etiquetas(**etiquetas, le='+Inf')} {h.cuenta}")
+            lineas.append(f"{nombre}_sum{_etiquetas(**etiquetas)} {h.suma}")
+            lineas.append(f"{nombre}_count{_etiquetas(**etiquetas)} {h.cuenta}")
+
+        with self._lock:
+            cabecera("planificador_ejecuciones_total", "counter", "Ejecuciones del pipeline V2 por estado")
+            for estado, n in sorted(self.ejecuciones.items()):
+                lineas.append(f"planificador_ejecuciones_total{_etiquetas(estado=estado)} {n}")
+
+            cabecera("planificador_ejecucion_segundos", "histogram", "Duración total del pipeline V2")
+            histograma("planificador_ejecucion_segundos", self.duracion)
+
+            cabecera("planificador_etapa_segundos", "histogram", "Duración por etapa y ejecución del pipeline V2")
+            for nombre, h in sorted(self.etapas.items()):
+                histograma("planificador_etapa_segundos", h, etapa=nombre)
+
+            cabecera("planificador_etapa_filas_total", "counter", "Filas procesadas por etapa")
+            for nombre, n in sorted(self.filas.items()):
+                lineas.append(f"planificador_etapa_filas_total{_etiquetas(etapa=nombre)} {n}")
+
+            for nombre, n in sorted(self.contadores.items()):
+                metrica = f"planificador_{_nombre_metrica(nombre)}_total"
+                cabecera(metrica, "counter", f"Acumulado de {nombre}")
+                lineas.append(f"{metrica} {n}")
+
+        for tipo, extra in (("gauge", gauges), ("counter", contadores)):
+            for nombre, valor in sorted((extra or {}).items()):
+                cabecera(nombre, tipo, nombre.replace("_", " "))
+                lineas.append(f"{nombre} {valor}")
+
+        return "\n".join(lineas) + "\n"
+
+
+# Instancia compartida por el proceso
+METRICAS_PROCESO = MetricasProceso()
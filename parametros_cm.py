@@ -0,0 +1,221 @@
+# ============================================================
+# parametros_cm.py – Parámetros por Centro-Material (solo lectura)
+# ============================================================
+
+from dataclasses import dataclass, fields
+
+import numpy as np
+import pandas as pd
+
+
+# Columnas numéricas de la tabla y valor cuando un CM no trae dato
+COLUMNAS_PARAMETROS = {
+    "consumo_diario": 0.0,
+    "cmd_sap": 0.0,
+    "dias_stock_objetivo": 0,
+    "dias_stock_seguridad": 0,
+    "cantidad_min_fabricacion": 0.0,
+    "precio_pmv": np.nan,
+    "cajas_capa": np.nan,
+    "cajas_pal": np.nan,
+    "dias_stock_pal": np.nan,
+}
+
+COLUMNAS_MINIMOS = ("cajas_capa", "cajas_pal", "dias_stock_pal")
+
+
+def _solo_lectura(arr) -> np.ndarray:
+    arr = np.array(arr, copy=True)
+    arr.setflags(write=False)
+    return arr
+
+
+def indice_cm(centros, materiales) -> pd.MultiIndex:
+    """MultiIndex (Centro, Material) normalizado: Centro str, Material int64."""
+    return pd.MultiIndex.from_arrays(
+        [
+            pd.Index(np.asarray(centros, dtype=object)).astype(str),
+            pd.Index(pd.to_numeric(pd.Series(materiales), errors="coerce").astype("int64")),
+        ],
+        names=["Centro", "Material"],
+    )
+
+
+@dataclass(frozen=True)
+class ParametrosCM:
+    """
+    Parámetros de planificación por (Centro, Material) como estructura de arrays.
+
+    La posición de cada CM en `indice` es su ordinal estable: todos los arrays están
+    alineados con él, así que una vez resueltas las posiciones de un lote de CM
+    (`posiciones`) cada parámetro se lee con un take (`tomar`), sin hashear tuplas.
+
+    Se construye una vez por carga y no se modifica: los arrays son de solo lectura,
+    así que la misma instancia se puede compartir entre peticiones concurrentes.
+    """
+    indice: pd.MultiIndex
+    consumo_diario: np.ndarray
+    cmd_sap: np.ndarray
+    dias_stock_objetivo: np.ndarray
+    dias_stock_seguridad: np.ndarray
+    cantidad_min_fabricacion: np.ndarray
+    precio_pmv: np.ndarray
+    cajas_capa: np.ndarray
+    cajas_pal: np.ndarray
+    dias_stock_pal: np.ndarray
+
+    @classmethod
+    def desde_dataframe(cls, tabla: pd.DataFrame) -> "ParametrosCM":
+        """
+        Construye la tabla desde un DataFrame con Centro, Material y las columnas de
+        COLUMNAS_PARAMETROS (las que falten o vengan vacías toman su valor por defecto).
+        Si un CM viene repetido se queda la última fila.
+        """
+        indice = indice_cm(tabla["Centro"], tabla["Material"])
+        ultimas = ~indice.duplicated(keep="last")
+        tabla = tabla[ultimas]
+
+        columnas = {}
+        for nombre, defecto in COLUMNAS_PARAMETROS.items():
+            if nombre in tabla.columns:
+                valores = pd.to_numeric(tabla[nombre], errors="coerce")
+                if not pd.isna(defecto):
+                    valores = valores.fillna(defecto)
+            else:
+                valores = pd.Series(defecto, index=tabla.index, dtype=float)
+            dtype = np.int64 if isinstance(defecto, int) else float
+            columnas[nombre] = _solo_lectura(valores.to_numpy(dtype=dtype))
+
+        return cls(indice=indice[ultimas], **columnas)
+
+    def __len__(self) -> int:
+        return len(self.indice)
+
+    @property
+    def centros(self) -> np.ndarray:
+        return self.indice.get_level_values("Centro").to_numpy()
+
+    @property
+    def materiales(self) -> np.ndarray:
+        return self.indice.get_level_values("Material").to_numpy()
+
+    def posiciones(self, centros, materiales) -> np.ndarray:
+        """Ordinal de cada (Centro, Material) en la tabla; -1 si no está."""
+        return self.indice.get_indexer(indice_cm(centros, materiales))
+
+    def tomar(self, columna: str, posiciones: np.ndarray, relleno=None) -> np.ndarray:
+        """
+        Valores de `columna` en las posiciones dadas. Las posiciones -1 (CM desconocido)
+        toman `relleno` (por defecto NaN).
+        """
+        valores = getattr(self, columna)
+        posiciones = np.asarray(posiciones, dtype=np.int64)
+        encontrado = posiciones >= 0
+        if relleno is None:
+            relleno = np.nan
+        if len(valores) == 0:
+            return np.full(len(posiciones), relleno)
+        return np.where(encontrado, valores[np.where(encontrado, posiciones, 0)], relleno)
+
+    def buscar(self, centros, materiales, columnas=COLUMNAS_MINIMOS) -> pd.DataFrame:
+        """Columnas pedidas alineadas con la entrada (NaN si el CM no está)."""
+        pos = self.posiciones(centros, materiales)
+        return pd.DataFrame({c: self.tomar(c, pos).astype(float) for c in columnas})
+
+    def subconjunto(self, posiciones) -> "ParametrosCM":
+        """
+        Tabla con solo los CM de `posiciones` (se ignoran -1 y repetidos), p. ej. para repartir
+        el universo entre procesos sin enviar a cada uno los parámetros de todos los CM.
+        """
+        posiciones = np.asarray(posiciones, dtype=np.int64)
+        posiciones = pd.unique(posiciones[posiciones >= 0])
+        return ParametrosCM(
+            indice=self.indice[posiciones],
+            **{f.name: _solo_lectura(getattr(self, f.name)[posiciones]) for f in fields(self) if f.name != "indice"}
+        )
+
+    def a_dataframe(self) -> pd.DataFrame:
+        """Vista tabular (Centro, Material + parámetros), útil para joins y depuración."""
+        tabla = pd.DataFrame({"Centro": self.centros, "Material": self.materiales})
+        for f in fields(self):
+            if f.name != "indice":
+                tabla[f.name] = getattr(self, f.name)
+        return tabla
+
+
+def _normalizar_columnas(df: pd.DataFrame) -> pd.DataFrame:
+    return df.rename(columns=lambda c: c.strip().lower())
+
+
+def construir_parametros_cm(
+    df_sc: pd.DataFrame,
+    df_obj: pd.DataFrame,
+    df_minimos: pd.DataFrame,
+    df_rotacion: pd.DataFrame,
+    df_precio: pd.DataFrame | None = None,
+    consumo_extra_pct: float = 0.0,
+) -> ParametrosCM:
+    """
+    Une en una sola tabla, con operaciones vectoriales, los parámetros que usa el motor V2:
+      - df_sc (stock + v_ZLO12_curado): CMD_SAP, CMD_Ajustado_Final, cantidad_min_fabricacion
+      - df_obj (Master_Logistica): días objetivo / seguridad por centro
+      - df_minimos (Master_Pedidos_Min, por Material) y df_rotacion (Stock_Dias_CAP_PAL)
+      - df_precio (Master_Articulos_Centro), opcional
+    No modifica los DataFrames de entrada. En las tablas maestras, si una clave viene
+    repetida se usa la primera fila (en Master_Logistica, la última, como antes).
+    """
+    tabla = pd.DataFrame({
+        "Centro": df_sc["Centro"].astype(str).to_numpy(),
+        "Material": pd.to_numeric(df_sc["Material"], errors="coerce").astype("int64").to_numpy(),
+        "consumo_diario": pd.to_numeric(df_sc["CMD_Ajustado_Final"], errors="coerce").to_numpy(dtype=float)
+                          * (1.0 + float(consumo_extra_pct)),
+        "cmd_sap": pd.to_numeric(df_sc["CMD_SAP"], errors="coerce").to_numpy(dtype=float),
+        "cantidad_min_fabricacion": pd.to_numeric(
+            df_sc["cantidad_min_fabricacion"], errors="coerce"
+        ).to_numpy(dtype=float),
+    })
+
+    por_centro = (
+        df_obj.assign(Centro=df_obj["Centro"].astype(str))
+        .drop_duplicates("Centro", keep="last")
+        .set_index("Centro")
+    )
+    for columna, origen in (
+        ("dias_stock_objetivo", "Dias_Stock_Objetivo"),
+        ("dias_stock_seguridad", "Dias_Stock_Seguridad"),
+    ):
+        dias = pd.to_numeric(por_centro[origen], errors="coerce").fillna(0)
+        tabla[columna] = tabla["Centro"].map(dias).fillna(0).astype(np.int64)
+
+    minimos = _normalizar_columnas(df_minimos)
+    minimos = pd.DataFrame({
+        "Material": pd.to_numeric(minimos["material"], errors="coerce"),
+        "cajas_capa": pd.to_numeric(minimos["cajas_capa"], errors="coerce"),
+    }).dropna(subset=["Material"]).drop_duplicates("Material")
+    minimos["Material"] = minimos["Material"].astype("int64")
+
+    rotacion = _normalizar_columnas(df_rotacion)
+    rotacion = pd.DataFrame({
+        "Centro": rotacion["centro"].astype(str),
+        "Material": pd.to_numeric(rotacion["material"], errors="coerce"),
+        "cajas_pal": pd.to_numeric(rotacion["cajas_pal"], errors="coerce"),
+        "dias_stock_pal": pd.to_numeric(rotacion["dias_stock_pal"], errors="coerce"),
+    }).dropna(subset=["Material"]).drop_duplicates(["Centro", "Material"])
+    rotacion["Material"] = rotacion["Material"].astype("int64")
+
+    tabla = (
+        tabla
+        .merge(minimos, on="Material", how="left")
+        .merge(rotacion, on=["Centro", "Material"], how="left")
+    )
+
+    if df_precio is not None and not df_precio.empty:
+        precio = pd.DataFrame({
+            "Centro": df_precio["Centro"].astype(str),
+            "Material": pd.to_numeric(df_precio["Material"], errors="coerce"),
+            "precio_pmv": pd.to_numeric(df_precio["Precio_estandar_PMV"], errors="coerce"),
+        }).dropna(subset=["Material", "precio_pmv"]).drop_duplicates(["Centro", "Material"], keep="last")
+        precio["Material"] = precio["Material"].astype("int64")
+        tabla = tabla.merge(precio, on=["Centro", "Material"], how="left")
+
+    return ParametrosCM.desde_dataframe(tabla)
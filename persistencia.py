@@ -0,0 +1,210 @@
+# ============================================================
+# persistencia.py – Histórico de forecast y pedidos por cambios (MERGE)
+# ============================================================
+#
+# Modo "truncate" (por defecto): cada ejecución reemplaza las tablas de salida completas.
+#
+# Modo "historico": cada tabla de salida tiene su <tabla>_Hist, particionada por día de
+# Fecha_ejecucion y agrupada por Centro, Material, que solo recibe lo que cambia respecto al
+# estado vigente (la última fila de cada clave):
+#   - filas nuevas o con algún valor distinto, con la Fecha_ejecucion de la ejecución;
+#   - bajas: claves vigentes del ámbito de la ejecución (sus CM, desde fecha_plan) que ya no
+#     salen, con Eliminado = TRUE.
+# Se aplican con un MERGE por clave y día: una segunda ejecución el mismo día sobrescribe las
+# filas de ese día. El estado a una fecha F es la última fila por clave con
+# DATE(Fecha_ejecucion) <= F y Eliminado = FALSE.
+
+import os
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+from fuente_datos import FuenteDatos
+
+
+PERSISTENCIA = os.getenv("PLANIFICADOR_PERSISTENCIA", "truncate")
+MODOS_PERSISTENCIA = ("truncate", "historico")
+
+SUFIJO_HISTORICO = "_Hist"
+COLUMNA_EJECUCION = "Fecha_ejecucion"
+CLUSTERING_HISTORICO = ("Centro", "Material")
+# Días de histórico que se leen para el estado vigente: una clave sin cambios desde antes se
+# vuelve a subir (correcto, solo cuesta esas filas) y la lectura poda el resto de particiones
+VENTANA_HISTORICO_DIAS = 90
+
+# Por tabla: clave de fila y columna de fecha que delimita el horizonte de la ejecución.
+# Un CM puede tener varios pedidos con la misma entrega: Linea los numera.
+CLAVES_HISTORICO = {
+    "forecast": (["Centro", "Material", "Fecha"], "Fecha"),
+    "pedidos": (["Proveedor", "Centro", "Material", "Fecha_Entrega", "Linea"], "Fecha_Entrega"),
+}
+ORDEN_LINEAS_PEDIDOS = ["Fecha_Carga", "Fecha_Rotura", "Cantidad"]
+
+
+def tabla_historico(tabla: str) -> str:
+    return f"{tabla}{SUFIJO_HISTORICO}"
+
+
+def escribir_historico(
+    fuente: FuenteDatos, nombre: str, df: pd.DataFrame, tabla: str, ambito: pd.DataFrame, fecha_plan: date
+) -> int:
+    """
+    Aplica en `tabla` (una <tabla>_Hist) los cambios de `df` ("forecast" o "pedidos", según
+    `nombre`) respecto a su estado vigente. `ambito`: CM planificados (Centro, Material y,
+    si la clave lo lleva, Proveedor), para las bajas. Devuelve las filas subidas.
+    """
+    claves, columna_fecha = CLAVES_HISTORICO[nombre]
+    nuevo = preparar_historico(nombre, df)
+    anterior = (
+        estado_vigente(fuente, tabla, claves, columna_fecha, ambito, fecha_plan)
+        if fuente.existe(tabla) else pd.DataFrame()
+    )
+    cambios = filas_cambiadas(nuevo, anterior, claves)
+
+    bajas = int(cambios["Eliminado"].sum()) if not cambios.empty else 0
+    print(f"   🗂 {tabla}: {len(cambios)} filas con cambios de {len(nuevo)} ({bajas} bajas)")
+    if not cambios.empty:
+        fuente.fusionar_df(
+            cambios, tabla, claves=claves, particion=COLUMNA_EJECUCION, clustering=CLUSTERING_HISTORICO
+        )
+    return len(cambios)
+
+
+def preparar_historico(nombre: str, df: pd.DataFrame) -> pd.DataFrame:
+    """Filas de `df` con la clave completa (Linea en pedidos) y Eliminado = FALSE."""
+    df = df.copy()
+    if nombre == "pedidos" and not df.empty:
+        grupo = CLAVES_HISTORICO["pedidos"][0][:-1]
+        df = df.sort_values(grupo + ORDEN_LINEAS_PEDIDOS, kind="stable")
+        df["Linea"] = df.groupby(grupo, dropna=False).cumcount().astype("int64")
+        df = df.reset_index(drop=True)
+    df["Eliminado"] = False
+    return df
+
+
+def estado_vigente(
+    fuente: FuenteDatos, tabla: str, claves: list, columna_fecha: str, ambito: pd.DataFrame, fecha_plan: date
+) -> pd.DataFrame:
+    """Última fila de cada clave de `tabla` dentro del ámbito (CM de `ambito`, desde fecha_plan)."""
+    columnas_ambito = [c for c in ("Proveedor", "Centro", "Material") if c in claves]
+    union = " AND ".join(f"h.{c} = a.{c}" for c in columnas_ambito)
+    sql = f"""
+    SELECT h.*
+    FROM `{tabla}` h
+    JOIN UNNEST(@ambito) a ON {union}
+    WHERE h.{COLUMNA_EJECUCION} >= @desde_ejecucion
+      AND h.{columna_fecha} >= @fecha_plan
+    QUALIFY ROW_NUMBER() OVER (
+        PARTITION BY {", ".join(f"h.{c}" for c in claves)}
+        ORDER BY h.{COLUMNA_EJECUCION} DESC
+    ) = 1
+    """
+    return fuente.consulta_df(sql, {
+        "ambito": _parametro_ambito(ambito, columnas_ambito),
+        "desde_ejecucion": datetime.now(timezone.utc) - timedelta(days=VENTANA_HISTORICO_DIAS),
+        "fecha_plan": fecha_plan,
+    })
+
+
+def filas_cambiadas(nuevo: pd.DataFrame, anterior: pd.DataFrame, claves: list) -> pd.DataFrame:
+    """
+    Filas de `nuevo` sin clave vigente en `anterior` o con algún valor distinto, más las
+    claves vigentes de `anterior` que no están en `nuevo` (con Eliminado = TRUE y la
+    Fecha_ejecucion de `nuevo`).
+    """
+    if not anterior.empty and "Eliminado" in anterior.columns:
+        anterior = anterior[~anterior["Eliminado"].fillna(False).astype(bool)].reset_index(drop=True)
+    if anterior.empty:
+        return nuevo
+
+    # Sin pedidos la tabla puede venir sin columnas de clave: todo lo vigente es baja
+    clave_nueva = (
+        _indice_claves(nuevo, claves) if len(nuevo)
+        else pd.MultiIndex.from_arrays([[] for _ in claves], names=claves)
+    )
+    clave_anterior = _indice_claves(anterior, claves)
+
+    posiciones = clave_anterior.get_indexer(clave_nueva)
+    cambiada = posiciones < 0
+    encontradas = np.flatnonzero(~cambiada)
+    comparables = [
+        c for c in nuevo.columns
+        if c in anterior.columns and c not in claves and c not in (COLUMNA_EJECUCION, "Eliminado")
+    ]
+    for columna in comparables:
+        iguales = _iguales(
+            nuevo[columna].iloc[encontradas].reset_index(drop=True),
+            anterior[columna].iloc[posiciones[encontradas]].reset_index(drop=True),
+        )
+        cambiada[encontradas[~iguales]] = True
+
+    bajas = anterior[~clave_anterior.isin(clave_nueva)]
+    if bajas.empty:
+        return nuevo[cambiada].reset_index(drop=True)
+
+    if not len(nuevo):
+        return bajas.assign(**{COLUMNA_EJECUCION: pd.Timestamp.now(tz="Europe/Madrid"), "Eliminado": True})
+    bajas = bajas.assign(**{COLUMNA_EJECUCION: nuevo[COLUMNA_EJECUCION].iloc[0], "Eliminado": True})
+    return pd.concat([nuevo[cambiada], _alinear(bajas, nuevo)], ignore_index=True)
+
+
+def _parametro_ambito(ambito: pd.DataFrame, columnas: list) -> pd.DataFrame:
+    # Mismos tipos que parametro_universo_cm: Centro STRING, Material / Proveedor INT64
+    ambito = ambito[columnas].dropna().drop_duplicates()
+    return pd.DataFrame({
+        c: ambito[c].astype(str).to_numpy(dtype=object) if c == "Centro"
+        else pd.to_numeric(ambito[c]).astype("int64").to_numpy()
+        for c in columnas
+    })
+
+
+def _indice_claves(df: pd.DataFrame, claves: list) -> pd.MultiIndex:
+    # Claves como texto: mismos valores aunque los tipos vengan distintos del origen
+    # (Int64 / int64, date / datetime64)
+    columnas = []
+    for c in claves:
+        serie = df[c]
+        if pd.api.types.is_datetime64_any_dtype(serie):
+            serie = serie.dt.strftime("%Y-%m-%d")
+        elif pd.api.types.is_numeric_dtype(serie) and not pd.api.types.is_bool_dtype(serie):
+            serie = serie.astype("Int64")
+        columnas.append(serie.astype("string").fillna("").to_numpy())
+    return pd.MultiIndex.from_arrays(columnas, names=claves)
+
+
+def _iguales(a: pd.Series, b: pd.Series) -> np.ndarray:
+    numericas = all(
+        pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s) for s in (a, b)
+    )
+    if numericas:
+        x = a.to_numpy(dtype=float, na_value=np.nan)
+        y = b.to_numpy(dtype=float, na_value=np.nan)
+        return np.isclose(x, y, rtol=1e-9, atol=1e-9, equal_nan=True)
+    return _texto(a) == _texto(b)
+
+
+def _texto(serie: pd.Series) -> np.ndarray:
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        serie = serie.dt.strftime("%Y-%m-%d")
+    return serie.astype("string").fillna("").to_numpy()
+
+
+def _alinear(bajas: pd.DataFrame, nuevo: pd.DataFrame) -> pd.DataFrame:
+    # Mismas columnas y tipos que las filas nuevas para subir todo en una carga
+    bajas = bajas.reindex(columns=nuevo.columns)
+    for columna in nuevo.columns:
+        origen, destino = bajas[columna], nuevo[columna]
+        if origen.dtype == destino.dtype:
+            continue
+        if pd.api.types.is_datetime64_any_dtype(origen) and destino.dtype == object:
+            bajas[columna] = origen.dt.date
+        elif pd.api.types.is_datetime64_any_dtype(destino):
+            bajas[columna] = pd.to_datetime(origen, utc=True).dt.tz_convert(destino.dt.tz) \
+                if destino.dt.tz is not None else pd.to_datetime(origen)
+        else:
+            try:
+                bajas[columna] = origen.astype(destino.dtype)
+            except (TypeError, ValueError):
+                pass
+    return bajas
@@ -2,20 +2,272 @@
 # pipeline_v2.py – Forecast + Pedidos con lógica avanzada
 # ============================================================
 
+import time
 from datetime import date, timedelta
-from google.cloud import bigquery
+import numpy as np
 import pandas as pd
 from typing import Optional
-from carga_params import cargar_datos_reales
+from carga_params import cargar_datos_lote, cargar_datos_reales, consulta_referencia, parametro_materiales
+from escrituras import ESCRITURA_DIFERIDA, ESCRITURAS
+from fuente_datos import FuenteDatos, fuente_por_defecto
+from metricas import METRICAS_PROCESO, MetricasEjecucion
+from persistencia import MODOS_PERSISTENCIA, PERSISTENCIA, tabla_historico
+from parametros_cm import ParametrosCM
+from planificacion_paralela import planificar_cms
 from funciones_stg import (
-    forecast_stock_centros,
+    forecast_stock_centros_dias,
+    recalcular_forecast_cms,
+    columnas_dias_a_fechas,
     generar_pedidos_centros_desde_forecastV2,
     ajustar_pedidos_por_restricciones_logisticas_v2,
-    ajustar_pedidos_a_minimos_logisticos_v2
+    ajustar_pedidos_a_minimos_logisticos_v2,
+    planificar_pedidos_por_cm
 )
 
 PROJECT_ID = "business-intelligence-444511"
 DATASET = "granier_logistica"
+TABLA_PEDIDOS = f"{PROJECT_ID}.{DATASET}.Tbl_Pedidos_Simples_V2"
+
+
+MAX_ITERS_PIPELINE = 50
+
+COLUMNAS_DIAS_PEDIDOS = {
+    "Dia_Carga": "Fecha_Carga",
+    "Dia_Entrega": "Fecha_Entrega",
+    "Dia_Rotura": "Fecha_Rotura",
+}
+
+# Columnas (y orden) de los pedidos en la respuesta JSON
+COLUMNAS_SHEETS = [
+    "Ano",
+    "Semana_Num",
+    "Semana_ISO",
+    "Centro",
+    "Proveedor",
+    "Codigo_Base",
+    "Material",
+    "Texto_breve",
+    "N_antiguo_material",
+    "Fecha_Rotura",
+    "Fecha_Entrega",
+    "Cantidad",
+    "Stock",
+    "Stock_Actual",
+    "CMD_Sap",
+    "CMD_Ajustado",
+    "Dias_stock_llegada"
+]
+
+
+# ============================================================
+#                MODOS DE PLANIFICACIÓN
+# ============================================================
+def _planificar_iterativo(
+    stock_centros_forecast: pd.DataFrame,
+    parametros: ParametrosCM,
+    dias_forecast: int,
+    fecha_plan: date,
+    dia_limite: int | None,
+    metricas: MetricasEjecucion | None = None
+):
+    """
+    Modo iterativo: forecast → pedidos → ajustes → re-forecast hasta que no quedan roturas.
+    Coloca como mucho un pedido por CM en cada iteración.
+    Devuelve (pedidos_total, forecast_final) sobre el eje de días desde fecha_plan.
+    `metricas`: registra tiempos por etapa y, por iteración, roturas y pedidos.
+    """
+    metricas = metricas or MetricasEjecucion()
+    entregas_totales = pd.DataFrame(columns=["Centro", "Material", "Dia_Entrega", "Cantidad"])
+    pedidos_total = pd.DataFrame(columns=[
+        "Centro", "Material", "Dia_Carga", "Dia_Entrega",
+        "Cantidad", "Dia_Rotura", "Comentarios"
+    ])
+
+    with metricas.etapa("forecast") as e:
+        forecast = forecast_stock_centros_dias(
+            stock_inicial=stock_centros_forecast,
+            parametros=parametros,
+            entregas_planificadas=entregas_totales,
+            dias_forecast=dias_forecast,
+            clamp_cero=True
+        )
+        e["filas"] = len(forecast)
+
+    # En cada iteración solo se revisan los CM que recibieron pedido en la anterior:
+    # el resto no cambia y, o ya no rompe, o no admite pedido (cantidad 0).
+    forecast_activo = forecast
+
+    for i in range(MAX_ITERS_PIPELINE):
+
+        print(f"\n🔁 Iteración {i}")
+        metricas.contar("iteraciones")
+        t_iteracion = time.perf_counter()
+        cms_sucios = ()
+
+        if i > 0:
+            cms_sucios = set(zip(nuevos["Centro"], nuevos["Material"]))
+            with metricas.etapa("forecast") as e:
+                forecast_activo = recalcular_forecast_cms(
+                    forecast=forecast,
+                    stock_inicial=stock_centros_forecast,
+                    parametros=parametros,
+                    entregas_planificadas=entregas_totales,
+                    cms=cms_sucios,
+                    dias_forecast=dias_forecast
+                )
+                e["filas"] = len(forecast_activo)
+            print(f"   → Forecast recalculado para {len(cms_sucios)} CM con pedidos nuevos")
+
+        if dia_limite is not None:
+            forecast_para_pedidos = forecast_activo[forecast_activo["Dia"] <= dia_limite]
+            roturas = forecast_para_pedidos[forecast_para_pedidos["Rotura"] == True]
+            print(f"   → Forecast filtrado hasta día {dia_limite}: {len(forecast_para_pedidos)} filas")
+        else:
+            forecast_para_pedidos = forecast_activo
+            roturas = forecast_activo[forecast_activo["Rotura"] == True]
+
+        metricas.contar("roturas", len(roturas))
+
+        if roturas.empty:
+            metricas.iteracion(iteracion=i, cms_recalculados=len(cms_sucios), roturas=0, pedidos=0,
+                               segundos=round(time.perf_counter() - t_iteracion, 4))
+            if dia_limite is not None:
+                print(f"✅ SIN ROTURAS hasta fecha límite (día {dia_limite}) → Pipeline estable")
+            else:
+                print("✅ SIN ROTURAS → Pipeline estable")
+            break
+
+        print(f"   → Roturas detectadas: {len(roturas)}")
+
+        with metricas.etapa("pedidos", filas=len(forecast_para_pedidos)):
+            nuevos = generar_pedidos_centros_desde_forecastV2(
+                forecast_df=forecast_para_pedidos,
+                parametros=parametros
+            )
+
+        if nuevos.empty:
+            metricas.iteracion(iteracion=i, cms_recalculados=len(cms_sucios), roturas=len(roturas), pedidos=0,
+                               segundos=round(time.perf_counter() - t_iteracion, 4))
+            print("⚠ Roturas detectadas pero NO se generan pedidos. Rompo.")
+            break
+
+        print("   → Nuevos pedidos generados")
+
+        with metricas.etapa("restricciones", filas=len(nuevos)):
+            nuevos = ajustar_pedidos_por_restricciones_logisticas_v2(
+                pedidos_df=nuevos,
+                dia_corte=2,
+                parametros=parametros,
+                fecha_inicio=fecha_plan
+            )
+
+        with metricas.etapa("minimos", filas=len(nuevos)):
+            nuevos = ajustar_pedidos_a_minimos_logisticos_v2(
+                nuevos,
+                parametros=parametros
+            )
+
+        if "Cantidad_ajustada" in nuevos.columns:
+            nuevos["Cantidad"] = nuevos["Cantidad_ajustada"]
+            nuevos.drop(columns=["Cantidad_ajustada"], inplace=True)
+
+        pedidos_total = pd.concat([pedidos_total, nuevos], ignore_index=True)
+        entregas_totales = pd.concat(
+            [entregas_totales, nuevos[["Centro", "Material", "Dia_Entrega", "Cantidad"]]],
+            ignore_index=True
+        )
+        metricas.iteracion(iteracion=i, cms_recalculados=len(cms_sucios), roturas=len(roturas),
+                           pedidos=len(nuevos), segundos=round(time.perf_counter() - t_iteracion, 4))
+    else:
+        # Se agotaron las iteraciones: empalmar los pedidos de la última
+        with metricas.etapa("forecast"):
+            recalcular_forecast_cms(
+                forecast=forecast,
+                stock_inicial=stock_centros_forecast,
+                parametros=parametros,
+                entregas_planificadas=entregas_totales,
+                cms=set(zip(nuevos["Centro"], nuevos["Material"])),
+                dias_forecast=dias_forecast
+            )
+
+    # El forecast empalmado ya incorpora todos los pedidos
+    return pedidos_total, forecast
+
+
+def _planificar_una_pasada(
+    stock_centros_forecast: pd.DataFrame,
+    parametros: ParametrosCM,
+    dias_forecast: int,
+    fecha_plan: date,
+    dia_limite: int | None,
+    metricas: MetricasEjecucion | None = None
+):
+    """
+    Modo una_pasada: recorre el horizonte de cada CM una sola vez colocando todos sus pedidos.
+    Mismos pedidos que el modo iterativo. Devuelve (pedidos_total, forecast_final)
+    sobre el eje de días desde fecha_plan.
+    """
+    metricas = metricas or MetricasEjecucion()
+
+    with metricas.etapa("planificacion_por_cm", filas=len(stock_centros_forecast)):
+        pedidos_total = planificar_pedidos_por_cm(
+            stock_inicial=stock_centros_forecast,
+            parametros=parametros,
+            dias_forecast=dias_forecast,
+            fecha_inicio=fecha_plan,
+            dia_limite=dia_limite,
+            dia_corte=2,
+            max_pedidos_por_cm=MAX_ITERS_PIPELINE
+        )
+    print(f"   → Pedidos planificados en una pasada: {len(pedidos_total)}")
+
+    with metricas.etapa("forecast") as e:
+        forecast_final = forecast_stock_centros_dias(
+            stock_inicial=stock_centros_forecast,
+            parametros=parametros,
+            entregas_planificadas=pedidos_total[["Centro", "Material", "Dia_Entrega", "Cantidad"]],
+            dias_forecast=dias_forecast,
+            clamp_cero=True
+        )
+        e["filas"] = len(forecast_final)
+    return pedidos_total, forecast_final
+
+
+# ============================================================
+#                 ENRIQUECIMIENTO DE SALIDA
+# ============================================================
+def _enriquecer_pedidos(
+    out_p: pd.DataFrame,
+    forecast_final: pd.DataFrame,
+    parametros: ParametrosCM
+) -> pd.DataFrame:
+    """
+    Añade CMD_Sap, CMD_Ajustado y Dias_stock_llegada a los pedidos de salida: los CMD por
+    posición en la tabla de parámetros y el stock de llegada con un join contra el forecast
+    final (sin apply por fila).
+    Dias_stock_llegada = stock estimado el día de entrega / CMD_Ajustado (NaN si falta o CMD 0).
+    """
+    claves = out_p[["Centro", "Material", "Dia_Entrega"]].reset_index(drop=True)
+
+    stock_llegada = forecast_final[["Centro", "Material", "Dia", "Stock_estimado"]].rename(
+        columns={"Dia": "Dia_Entrega"}
+    )
+    stock_llegada["Material"] = pd.to_numeric(stock_llegada["Material"], errors="coerce").astype("Int64")
+
+    stock = claves.merge(
+        stock_llegada, on=["Centro", "Material", "Dia_Entrega"], how="left"
+    )["Stock_estimado"].to_numpy(dtype=float)
+
+    pos = parametros.posiciones(out_p["Centro"], out_p["Material"])
+    cmd_sap = parametros.tomar("cmd_sap", pos)
+    cmd_adj = parametros.tomar("consumo_diario", pos)
+    valido = ~np.isnan(stock) & ~np.isnan(cmd_adj) & (cmd_adj != 0)
+
+    out_p = out_p.copy()
+    out_p["CMD_Sap"] = cmd_sap
+    out_p["CMD_Ajustado"] = cmd_adj
+    out_p["Dias_stock_llegada"] = np.divide(stock, cmd_adj, out=np.full(len(stock), np.nan), where=valido)
+    return out_p
 
 
 # ============================================================
@@ -25,37 +277,275 @@ def ejecutar_pipeline_v2(
     proveedor_id: int | None,
     consumo_extra_pct: float,
     centro: str | None = None,
-    fecha_corte: str | None = None
+    fecha_corte: str | None = None,
+    modo_planificacion: str = "iterativo",
+    fuente: FuenteDatos | None = None,
+    metricas: MetricasEjecucion | None = None,
+    escritura_diferida: bool | None = None
+):
+    """
+    Ejecuta el pipeline V2 instrumentado: el resultado lleva en "timings" la duración y filas
+    por etapa, contadores y detalle por iteración, y la ejecución (ok o error) se acumula en
+    METRICAS_PROCESO para /metrics. Pasar `metricas` permite seguir el progreso desde fuera
+    (MetricasEjecucion.progreso()).
+    `escritura_diferida` (por defecto ESCRITURA_DIFERIDA): devolver el resultado sin esperar a
+    que se escriban forecast y pedidos; el estado de la escritura se consulta en ESCRITURAS
+    con resultado["escrituras"]["escrituras_id"].
+    """
+    return _instrumentar(
+        _ejecutar_pipeline_v2, metricas,
+        proveedor_id, consumo_extra_pct, centro, fecha_corte, modo_planificacion, fuente, escritura_diferida
+    )
+
+
+def ejecutar_pipeline_v2_lote(
+    proveedores,
+    consumo_extra_pct: float,
+    centro: str | None = None,
+    fecha_corte: str | None = None,
+    modo_planificacion: str = "iterativo",
+    fuente: FuenteDatos | None = None,
+    metricas: MetricasEjecucion | None = None,
+    escritura_diferida: bool | None = None
+):
+    """
+    Pipeline V2 de varios proveedores con una sola carga (cargar_datos_lote): cada proveedor
+    se planifica sobre su partición de los datos compartidos y obtiene el mismo resultado
+    que ejecutar_pipeline_v2(proveedor).
+
+    Escrituras agrupadas: las tablas de forecast (una por proveedor) se cargan en paralelo
+    y los pedidos de todo el lote en una sola carga de Tbl_Pedidos_Simples_V2, en un único
+    grupo de ESCRITURAS (diferido o no, como en ejecutar_pipeline_v2).
+    Los proveedores sin datos van a "errores" sin impedir planificar el resto.
+    Instrumentado como ejecutar_pipeline_v2 ("timings" de todo el lote).
+    """
+    return _instrumentar(
+        _ejecutar_pipeline_v2_lote, metricas,
+        proveedores, consumo_extra_pct, centro, fecha_corte, modo_planificacion, fuente, escritura_diferida
+    )
+
+
+def _instrumentar(ejecutar, metricas: MetricasEjecucion | None, *args):
+    metricas = metricas or MetricasEjecucion()
+    try:
+        resultado = ejecutar(*args, metricas)
+    except Exception:
+        METRICAS_PROCESO.observar(metricas, estado="error")
+        raise
+
+    METRICAS_PROCESO.observar(metricas, estado="ok")
+    resultado["timings"] = metricas.resumen()
+    return resultado
+
+
+def _ejecutar_pipeline_v2(
+    proveedor_id: int | None,
+    consumo_extra_pct: float,
+    centro: str | None,
+    fecha_corte: str | None,
+    modo_planificacion: str,
+    fuente: FuenteDatos | None,
+    escritura_diferida: bool | None,
+    metricas: MetricasEjecucion
 ):
 
     print("🚀 Ejecutando PIPELINE V2...")
-    client = bigquery.Client()
+    fuente = fuente or fuente_por_defecto()
+    planificar = _modo_planificacion(modo_planificacion)
 
     print(f"📥 Cargando datos reales + parámetros... centro={centro}, fecha_corte={fecha_corte}")
 
-    datos = cargar_datos_reales(
-        proveedor_id=proveedor_id,
-        consumo_extra_pct=consumo_extra_pct,
-        centro=centro,
-        fecha_corte=fecha_corte
-    )
+    with metricas.etapa("carga") as e:
+        datos = cargar_datos_reales(
+            proveedor_id=proveedor_id,
+            consumo_extra_pct=consumo_extra_pct,
+            centro=centro,
+            fecha_corte=fecha_corte,
+            fuente=fuente
+        )
+        e["filas"] = len(datos["stock_inicial_centros"])
+    _registrar_tiempos_carga(metricas, datos)
 
-    stock_centros = datos["stock_inicial_centros"]
-    consumo_diario = datos["consumo_diario"]
-    dias_obj = datos["dias_stock_objetivo"]
-    dias_seg = datos["dias_stock_seguridad"]
-    dias_seg_por_centro = datos["dias_seg_por_centro"]
-    cantidad_min_fabricacion = datos["cantidad_min_fabricacion"]
-    df_minimos = datos["minimos_logisticos"]
-    df_rotacion = datos["rotacion"]
-    cmd_sap_dict = datos["cmd_sap"]
-    df_cm_proveedor = datos["cm_proveedor"]
+    # Día 0 del horizonte fijo para todo el plan: así cada CM depende solo de sus pedidos.
+    # Internamente todas las fechas son días desde fecha_plan.
+    fecha_plan = date.today()
+    horizonte = _horizonte(fecha_plan, centro, fecha_corte, datos["dias_seg_por_centro"])
 
-    print(f"✔ Centros-material: {len(stock_centros)}")
-    print(f"✔ Registros rotación CAP/PAL: {len(df_rotacion)}")
+    df_art = _cargar_articulos(fuente, datos["stock_inicial_centros"]["Material"], metricas)
+
+    salida = _planificar_proveedor(datos, df_art, planificar, modo_planificacion, horizonte, fecha_plan, metricas)
+
+    print(f"\n💾 Guardando resultados en {fuente.id}...")
+
+    escrituras = [
+        _escritura("forecast", salida["forecast"], tabla_forecast(proveedor_id), salida["ambito"], fecha_plan)
+    ]
+    if not salida["pedidos"].empty or PERSISTENCIA == "historico":
+        escrituras.append(_escritura("pedidos", salida["pedidos"], TABLA_PEDIDOS, salida["ambito"], fecha_plan))
+
+    return {
+        **_resultado_proveedor(proveedor_id, centro, fecha_corte, modo_planificacion, horizonte, salida),
+        "escrituras": _persistir(fuente, escrituras, escritura_diferida, metricas),
+    }
+
+
+def _ejecutar_pipeline_v2_lote(
+    proveedores,
+    consumo_extra_pct: float,
+    centro: str | None,
+    fecha_corte: str | None,
+    modo_planificacion: str,
+    fuente: FuenteDatos | None,
+    escritura_diferida: bool | None,
+    metricas: MetricasEjecucion
+):
 
+    print(f"🚀 Ejecutando PIPELINE V2 en lote ({len(proveedores)} proveedores)...")
+    fuente = fuente or fuente_por_defecto()
+    planificar = _modo_planificacion(modo_planificacion)
+
+    with metricas.etapa("carga") as e:
+        datos_por_proveedor, errores = cargar_datos_lote(
+            proveedores,
+            consumo_extra_pct=consumo_extra_pct,
+            centro=centro,
+            fecha_corte=fecha_corte,
+            fuente=fuente
+        )
+        e["filas"] = sum(len(d["stock_inicial_centros"]) for d in datos_por_proveedor.values())
+    for proveedor, motivo in errores.items():
+        print(f"⚠ Proveedor {proveedor} sin planificar: {motivo}")
+    metricas.contar("proveedores_planificados", len(datos_por_proveedor))
+
+    resultados = []
+    info_escrituras = None
+    if datos_por_proveedor:
+        # La carga es compartida: sus tiempos se registran una vez
+        _registrar_tiempos_carga(metricas, next(iter(datos_por_proveedor.values())))
+
+        fecha_plan = date.today()
+        dias_seg_por_centro = next(iter(datos_por_proveedor.values()))["dias_seg_por_centro"]
+        horizonte = _horizonte(fecha_plan, centro, fecha_corte, dias_seg_por_centro)
+
+        materiales = pd.concat([d["stock_inicial_centros"]["Material"] for d in datos_por_proveedor.values()])
+        df_art = _cargar_articulos(fuente, materiales, metricas)
+
+        salidas = {}
+        for proveedor, datos in datos_por_proveedor.items():
+            print(f"\n🏭 Proveedor {proveedor}")
+            salidas[proveedor] = _planificar_proveedor(
+                datos, df_art, planificar, modo_planificacion, horizonte, fecha_plan, metricas
+            )
+
+        print(f"\n💾 Guardando resultados del lote en {fuente.id}...")
+
+        escrituras = [
+            _escritura("forecast", s["forecast"], tabla_forecast(p), s["ambito"], fecha_plan)
+            for p, s in salidas.items()
+        ]
+        pedidos = [s["pedidos"] for s in salidas.values() if not s["pedidos"].empty]
+        if pedidos or PERSISTENCIA == "historico":
+            escrituras.append(_escritura(
+                "pedidos",
+                pd.concat(pedidos, ignore_index=True) if pedidos else pd.DataFrame(),
+                TABLA_PEDIDOS,
+                pd.concat([s["ambito"] for s in salidas.values()], ignore_index=True),
+                fecha_plan
+            ))
+        info_escrituras = _persistir(fuente, escrituras, escritura_diferida, metricas)
+
+        resultados = [
+            _resultado_proveedor(p, centro, fecha_corte, modo_planificacion, horizonte, s)
+            for p, s in salidas.items()
+        ]
+
+    return {
+        "proveedores": list(proveedores),
+        "centro": centro,
+        "fecha_corte": fecha_corte,
+        "modo_planificacion": modo_planificacion,
+        "resultados": resultados,
+        "errores": [{"proveedor": p, "error": motivo} for p, motivo in errores.items()],
+        "escrituras": info_escrituras,
+    }
+
+
+def _escritura(nombre: str, df: pd.DataFrame, tabla: str, ambito: pd.DataFrame, fecha_plan: date) -> tuple:
+    """
+    Escritura de `df` para ESCRITURAS según PERSISTENCIA: "truncate" reemplaza `tabla`;
+    "historico" sube solo los cambios a <tabla>_Hist (ver persistencia.escribir_historico).
+    """
+    if PERSISTENCIA == "truncate":
+        return nombre, df, tabla, "WRITE_TRUNCATE"
+    if PERSISTENCIA == "historico":
+        return nombre, df, tabla_historico(tabla), "MERGE", {"ambito": ambito, "fecha_plan": fecha_plan}
+    raise ValueError(f"Persistencia {PERSISTENCIA!r} no soportada. Opciones: {MODOS_PERSISTENCIA}")
+
+
+def _persistir(fuente: FuenteDatos, escrituras: list, escritura_diferida: bool | None, metricas: MetricasEjecucion) -> dict:
+    """
+    Encola las escrituras [(nombre, df, tabla, modo)] en ESCRITURAS (todas a la vez). Diferida:
+    vuelve al momento; si no, espera a que terminen, registra cada carga como etapa
+    "escritura.<nombre>" y relanza el error si alguna falla tras los reintentos.
+    """
+    diferida = ESCRITURA_DIFERIDA if escritura_diferida is None else escritura_diferida
+    grupo = ESCRITURAS.enviar(fuente, escrituras)
+    if diferida:
+        metricas.contar("escrituras_diferidas", len(grupo.escrituras))
+    else:
+        try:
+            ESCRITURAS.esperar(grupo)
+        finally:
+            for escritura in grupo.escrituras:
+                metricas.registrar(f"escritura.{escritura.nombre}", escritura.segundos, escritura.filas)
+    return {
+        "escrituras_id": grupo.id,
+        "diferida": diferida,
+        # Solo los nombres: el resultado puede quedar en caché y no debe retener los DataFrames
+        "truncadas": [e[2] for e in escrituras if e[3] == "WRITE_TRUNCATE"],
+    }
+
+
+def tablas_reemplazadas(fuente: FuenteDatos, referencia: dict | None) -> list:
+    """
+    Tablas WRITE_TRUNCATE de un resultado (forecast del proveedor, Tbl_Pedidos_Simples_V2)
+    cuyo último escritor ya no es su grupo de escrituras: otra ejecución con otros parámetros
+    las ha reemplazado. Vacía en modo "historico".
+    """
+    if referencia is None:
+        return []
+    return [
+        tabla for tabla in referencia["truncadas"]
+        if ESCRITURAS.ultimo_grupo(fuente, tabla) != referencia["escrituras_id"]
+    ]
+
+
+def tabla_forecast(proveedor_id: int | None) -> str:
+    """Tabla de forecast del proveedor (`ALL` sin proveedor)."""
+    proveedor_suffix = "ALL" if proveedor_id is None else str(proveedor_id)
+    return f"{PROJECT_ID}.{DATASET}.Forecast_StockCentros_Proveedor{proveedor_suffix}_V2"
+
+
+def _modo_planificacion(modo_planificacion: str):
+    if modo_planificacion == "iterativo":
+        return _planificar_iterativo
+    if modo_planificacion == "una_pasada":
+        return _planificar_una_pasada
+    raise ValueError(f"modo_planificacion debe ser 'iterativo' o 'una_pasada', no {modo_planificacion!r}")
+
+
+def _registrar_tiempos_carga(metricas: MetricasEjecucion, datos: dict):
+    # Una etapa por consulta del cargador (las concurrentes se solapan en el tiempo)
+    filas_carga = datos.get("filas_carga", {})
+    for nombre, segundos in datos.get("tiempos_carga", {}).items():
+        if nombre != "total":
+            metricas.registrar(f"carga.{nombre}", segundos, filas_carga.get(nombre))
+
+
+def _horizonte(fecha_plan: date, centro: str | None, fecha_corte: str | None, dias_seg_por_centro: dict) -> dict:
+    """Días de forecast, stock de seguridad y día límite del plan según fecha_corte / centro."""
     if fecha_corte:
-        hoy = date.today()
+        hoy = fecha_plan
         fecha_corte_dt = pd.to_datetime(fecha_corte).date()
         dias_hasta_corte = max((fecha_corte_dt - hoy).days, 0)
 
@@ -66,6 +556,7 @@ def ejecutar_pipeline_v2(
 
         dias_forecast = dias_hasta_corte + stock_seguridad_centro
         fecha_limite_global = fecha_corte_dt + timedelta(days=stock_seguridad_centro)
+        dia_limite = (fecha_limite_global - fecha_plan).days
 
         print(
             f"📅 fecha_corte={fecha_corte_dt} | hoy={hoy} | "
@@ -75,12 +566,19 @@ def ejecutar_pipeline_v2(
             f"fecha_limite_global={fecha_limite_global}"
         )
     else:
-        fecha_corte_dt = None
         stock_seguridad_centro = None
         dias_forecast = 60
-        fecha_limite_global = None
+        dia_limite = None
         print(f"📅 Sin fecha_corte informada. Usando dias_forecast={dias_forecast}")
 
+    return {
+        "stock_seguridad_centro": stock_seguridad_centro,
+        "dias_forecast": dias_forecast,
+        "dia_limite": dia_limite,
+    }
+
+
+def _cargar_articulos(fuente: FuenteDatos, materiales, metricas: MetricasEjecucion) -> pd.DataFrame:
     sql_art = f"""
     SELECT 
       CAST(Material AS INT64) AS Material,
@@ -90,131 +588,74 @@ def ejecutar_pipeline_v2(
     FROM `{PROJECT_ID}.granier_maestros.Master_ArticulosSAP`
     """
 
-    df_art = client.query(sql_art).to_dataframe()
-    df_art["Material"] = pd.to_numeric(df_art["Material"], errors="coerce").astype("Int64")
-
-    MAX_ITERS = 50
+    with metricas.etapa("carga.articulos") as e:
+        df_art = consulta_referencia(
+            fuente,
+            f"{PROJECT_ID}.granier_maestros.Master_ArticulosSAP",
+            sql_art,
+            tipos={"Material": "Int64", "Codigo_Base": "Int64", "Texto_breve": "string", "N_antiguo_material": "string"},
+            materiales=parametro_materiales(materiales)
+        )
+        e["filas"] = len(df_art)
+    return df_art
+
+
+def _planificar_proveedor(
+    datos: dict,
+    df_art: pd.DataFrame,
+    planificar,
+    modo_planificacion: str,
+    horizonte: dict,
+    fecha_plan: date,
+    metricas: MetricasEjecucion
+) -> dict:
+    """
+    Planifica los CM de `datos` y prepara la salida: forecast y pedidos enriquecidos (listos
+    para escribir) y la tabla de pedidos de la respuesta (columnas y orden de Sheets).
+    """
+    stock_centros = datos["stock_inicial_centros"]
+    parametros = datos["parametros_cm"]
+    df_cm_proveedor = datos["cm_proveedor"]
 
-    entregas_totales = pd.DataFrame(columns=["Centro", "Material", "Fecha_Entrega", "Cantidad"])
-    pedidos_total = pd.DataFrame(columns=[
-        "Centro", "Material", "Fecha_Carga", "Fecha_Entrega",
-        "Cantidad", "Fecha_Rotura", "Comentarios"
-    ])
+    print(f"✔ Centros-material: {len(stock_centros)}")
+    print(f"✔ CM con rotación CAP/PAL: {int((~np.isnan(parametros.cajas_pal)).sum())}")
 
     # El resto del motor sigue trabajando a grano Centro-Material
     stock_centros_forecast = stock_centros[["Centro", "Material", "Stock", "Stock_Actual"]].copy()
 
-    for i in range(MAX_ITERS):
-
-        print(f"\n🔁 Iteración {i}")
-
-        forecast = forecast_stock_centros(
-            stock_inicial=stock_centros_forecast,
-            consumo_diario=consumo_diario,
-            entregas_planificadas=entregas_totales,
-            dias_forecast=dias_forecast,
-            clamp_cero=True
-        )
-
-        forecast["Fecha"] = pd.to_datetime(forecast["Fecha"]).dt.date
-
-        if fecha_limite_global is not None:
-            forecast_para_pedidos = forecast[forecast["Fecha"] <= fecha_limite_global].copy()
-            roturas = forecast_para_pedidos[forecast_para_pedidos["Rotura"] == True].copy()
-            print(f"   → Forecast filtrado hasta {fecha_limite_global}: {len(forecast_para_pedidos)} filas")
-        else:
-            forecast_para_pedidos = forecast.copy()
-            roturas = forecast[forecast["Rotura"] == True].copy()
-
-        if roturas.empty:
-            if fecha_limite_global is not None:
-                print(f"✅ SIN ROTURAS hasta fecha límite {fecha_limite_global} → Pipeline estable")
-            else:
-                print("✅ SIN ROTURAS → Pipeline estable")
-            break
-
-        print(f"   → Roturas detectadas: {len(roturas)}")
-
-        nuevos = generar_pedidos_centros_desde_forecastV2(
-            forecast_df=forecast_para_pedidos,
-            consumo_diario=consumo_diario,
-            dias_stock_seguridad=dias_seg,
-            dias_stock_objetivo=dias_obj
+    print(f"🧮 Planificando pedidos (modo={modo_planificacion})...")
+
+    with metricas.etapa("planificacion", filas=len(stock_centros_forecast)):
+        # Repartido entre procesos si PLANIFICADOR_PROCESOS > 1 y el universo lo justifica
+        pedidos_total, forecast_final = planificar_cms(
+            planificar,
+            stock_centros_forecast=stock_centros_forecast,
+            parametros=parametros,
+            dias_forecast=horizonte["dias_forecast"],
+            fecha_plan=fecha_plan,
+            dia_limite=horizonte["dia_limite"],
+            metricas=metricas
         )
+    metricas.contar("pedidos_planificados", len(pedidos_total))
 
-        if nuevos.empty:
-            print("⚠ Roturas detectadas pero NO se generan pedidos. Rompo.")
-            break
-
-        print("   → Nuevos pedidos generados")
-
-        nuevos = ajustar_pedidos_por_restricciones_logisticas_v2(
-            pedidos_df=nuevos,
-            dia_corte=2,
-            consumo_diario=consumo_diario,
-            dias_stock_objetivo=dias_obj
-        )
-
-        nuevos = ajustar_pedidos_a_minimos_logisticos_v2(
-            nuevos,
-            df_minimos=df_minimos,
-            df_rotacion=df_rotacion
-        )
-
-        if "Cantidad_ajustada" in nuevos.columns:
-            nuevos["Cantidad"] = nuevos["Cantidad_ajustada"]
-            nuevos.drop(columns=["Cantidad_ajustada"], inplace=True)
-
-        pedidos_total = pd.concat([pedidos_total, nuevos], ignore_index=True)
-        entregas_totales = pd.concat(
-            [entregas_totales, nuevos[["Centro", "Material", "Fecha_Entrega", "Cantidad"]]],
-            ignore_index=True
-        )
-
-    forecast_final = forecast_stock_centros(
-        stock_inicial=stock_centros_forecast,
-        consumo_diario=consumo_diario,
-        entregas_planificadas=pedidos_total[["Centro", "Material", "Fecha_Entrega", "Cantidad"]],
-        dias_forecast=dias_forecast,
-        clamp_cero=True
-    )
-
-    forecast_aux = forecast_final.copy()
-    forecast_aux["Fecha"] = pd.to_datetime(forecast_aux["Fecha"]).dt.date
-    col_stock_forecast = "Stock_estimado"
-    forecast_aux["key"] = list(zip(forecast_aux["Centro"], forecast_aux["Material"], forecast_aux["Fecha"]))
-
-    stock_llegada_dict = {
-        k: float(stock_value)
-        for k, stock_value in zip(forecast_aux["key"], forecast_aux[col_stock_forecast])
-    }
-
-    print("\n💾 Guardando resultados en BigQuery...")
-
-    out_f = forecast_final.copy()
-    out_f["Fecha_ejecucion"] = pd.Timestamp.now(tz="Europe/Madrid")
-    out_f["Material"] = pd.to_numeric(out_f["Material"], errors="coerce").astype("Int64")
-    out_f = out_f.merge(df_art, on="Material", how="left")
-    out_f = out_f.merge(df_cm_proveedor, on=["Centro", "Material"], how="left")
-
-    proveedor_suffix = "ALL" if proveedor_id is None else str(proveedor_id)
-
-    client.load_table_from_dataframe(
-        out_f,
-        f"{PROJECT_ID}.{DATASET}.Forecast_StockCentros_Proveedor{proveedor_suffix}_V2",
-        job_config=bigquery.LoadJobConfig(write_disposition="WRITE_TRUNCATE")
-    ).result()
+    with metricas.etapa("enriquecimiento.forecast", filas=len(forecast_final)):
+        out_f = columnas_dias_a_fechas(forecast_final, fecha_plan, {"Dia": "Fecha"})
+        out_f["Fecha_ejecucion"] = pd.Timestamp.now(tz="Europe/Madrid")
+        out_f["Material"] = pd.to_numeric(out_f["Material"], errors="coerce").astype("Int64")
+        out_f = out_f.merge(df_art, on="Material", how="left")
+        out_f = out_f.merge(df_cm_proveedor, on=["Centro", "Material"], how="left")
 
     if not pedidos_total.empty:
+        t_enriquecimiento = time.perf_counter()
         out_p = pedidos_total.copy()
         out_p["Fecha_ejecucion"] = pd.Timestamp.now(tz="Europe/Madrid")
 
-        iso = pd.to_datetime(out_p["Fecha_Entrega"]).dt.isocalendar()
-        out_p["Ano"] = iso["year"].astype(int)
-        out_p["Semana_Num"] = iso["week"].astype(int)
+        fechas_entrega = np.datetime64(fecha_plan, "D") + out_p["Dia_Entrega"].to_numpy(dtype=np.int64)
+        iso = pd.DatetimeIndex(fechas_entrega).isocalendar()
+        out_p["Ano"] = iso["year"].astype(int).to_numpy()
+        out_p["Semana_Num"] = iso["week"].astype(int).to_numpy()
         out_p["Semana_ISO"] = out_p["Ano"].astype(str) + "-W" + out_p["Semana_Num"].astype(str).str.zfill(2)
 
-        out_p["Fecha_Entrega"] = pd.to_datetime(out_p["Fecha_Entrega"]).dt.date
         out_p["Material"] = pd.to_numeric(out_p["Material"], errors="coerce").astype("Int64")
 
         out_p = out_p.merge(df_art, on="Material", how="left")
@@ -225,82 +666,54 @@ def ejecutar_pipeline_v2(
 
         out_p = out_p.merge(df_stock_info, on=["Centro", "Material", "Proveedor"], how="left")
 
-        def _cmd_sap(row):
-            return cmd_sap_dict.get((row["Centro"], row["Material"]), None)
-
-        def _cmd_ajustado(row):
-            return consumo_diario.get((row["Centro"], row["Material"]), None)
-
-        out_p["CMD_Sap"] = out_p.apply(_cmd_sap, axis=1)
-        out_p["CMD_Ajustado"] = out_p.apply(_cmd_ajustado, axis=1)
-
-        def _dias_stock_llegada(row):
-            key = (row["Centro"], row["Material"], row["Fecha_Entrega"])
-            stock_llegada = stock_llegada_dict.get(key, None)
-            cmd_adj = row["CMD_Ajustado"]
-            if stock_llegada is None or cmd_adj in (None, 0):
-                return None
-            return stock_llegada / cmd_adj
+        out_p = _enriquecer_pedidos(out_p, forecast_final, parametros)
 
-        out_p["Dias_stock_llegada"] = out_p.apply(_dias_stock_llegada, axis=1)
-
-        client.load_table_from_dataframe(
-            out_p,
-            f"{PROJECT_ID}.{DATASET}.Tbl_Pedidos_Simples_V2",
-            job_config=bigquery.LoadJobConfig(write_disposition="WRITE_TRUNCATE")
-        ).result()
+        # Frontera BigQuery/JSON: días → fechas de calendario
+        out_p = columnas_dias_a_fechas(out_p, fecha_plan, COLUMNAS_DIAS_PEDIDOS)
+        metricas.registrar("enriquecimiento.pedidos", time.perf_counter() - t_enriquecimiento, len(out_p))
     else:
-        out_p = pd.DataFrame(columns=pedidos_total.columns)
+        out_p = columnas_dias_a_fechas(
+            pd.DataFrame(columns=pedidos_total.columns), fecha_plan, COLUMNAS_DIAS_PEDIDOS
+        )
 
     print(">>> OUT_P SHAPE:", out_p.shape)
     print(">>> OUT_P COLUMNS:", out_p.columns.tolist())
     print(out_p.head(5))
 
-    print("📤 Preparando JSON de salida...")
-
-    out_p_json = out_p.copy()
+    print("📤 Preparando pedidos de salida...")
+    t_salida = time.perf_counter()
 
-    if "Fecha_Entrega" in out_p_json.columns:
-        out_p_json["Fecha_Entrega"] = pd.to_datetime(out_p_json["Fecha_Entrega"]).dt.date
-    if "Fecha_Rotura" in out_p_json.columns:
-        out_p_json["Fecha_Rotura"] = pd.to_datetime(out_p_json["Fecha_Rotura"]).dt.date
+    out_p_salida = out_p
 
-    if not out_p_json.empty:
-        out_p_json = out_p_json.sort_values(
+    if not out_p_salida.empty:
+        out_p_salida = out_p_salida.sort_values(
             by=["Ano", "Semana_Num", "Centro", "Codigo_Base"],
             ascending=[True, True, True, True]
         ).reset_index(drop=True)
 
-    columnas_sheets = [
-        "Ano",
-        "Semana_Num",
-        "Semana_ISO",
-        "Centro",
-        "Proveedor",
-        "Codigo_Base",
-        "Material",
-        "Texto_breve",
-        "N_antiguo_material",
-        "Fecha_Rotura",
-        "Fecha_Entrega",
-        "Cantidad",
-        "Stock",
-        "Stock_Actual",
-        "CMD_Sap",
-        "CMD_Ajustado",
-        "Dias_stock_llegada"
-    ]
+    columnas_presentes = [c for c in COLUMNAS_SHEETS if c in out_p_salida.columns]
+    pedidos_salida = out_p_salida[columnas_presentes]
+    metricas.registrar("salida", time.perf_counter() - t_salida, len(pedidos_salida))
+
+    return {
+        "forecast": out_f,
+        "pedidos": out_p,
+        "pedidos_salida": pedidos_salida,
+        # CM planificados: ámbito de las bajas en la persistencia histórica
+        "ambito": stock_centros[["Proveedor", "Centro", "Material"]],
+    }
 
-    columnas_presentes = [c for c in columnas_sheets if c in out_p_json.columns]
-    pedidos_json = out_p_json[columnas_presentes].to_dict(orient="records")
 
+def _resultado_proveedor(proveedor_id, centro, fecha_corte, modo_planificacion, horizonte: dict, salida: dict) -> dict:
+    # "pedidos" es un DataFrame: la API lo codifica según el formato pedido (ver formatos_salida)
     return {
         "proveedor": proveedor_id,
         "centro": centro,
         "fecha_corte": fecha_corte,
-        "stock_seguridad_centro": stock_seguridad_centro,
-        "dias_forecast": dias_forecast,
-        "pedidos_rows": len(out_p),
-        "forecast_rows": len(forecast_aux),
-        "pedidos": pedidos_json
+        "stock_seguridad_centro": horizonte["stock_seguridad_centro"],
+        "dias_forecast": horizonte["dias_forecast"],
+        "modo_planificacion": modo_planificacion,
+        "pedidos_rows": len(salida["pedidos"]),
+        "forecast_rows": len(salida["forecast"]),
+        "pedidos": salida["pedidos_salida"]
     }
@@ -0,0 +1,152 @@
+# ============================================================
+# planificacion_paralela.py – Planificación repartida entre procesos
+# ============================================================
+#
+# Cada Centro-Material se planifica de forma independiente (forecast, pedidos, restricciones
+# y mínimos no cruzan CM), así que el universo se puede repartir en fragmentos —por centro o
+# por hash de Material— que se planifican en un pool de procesos y se juntan al final.
+#
+# Cada fragmento viaja una sola vez a su proceso con solo sus parámetros
+# (ParametrosCM.subconjunto): el volumen enviado es el del universo, no el del universo por
+# proceso. El pool se crea una vez y se reutiliza entre peticiones; con forkserver los
+# procesos nacen de un servidor limpio (sin los hilos del servidor web) con el motor ya
+# importado.
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pandas as pd
+
+from metricas import MetricasEjecucion
+from parametros_cm import ParametrosCM
+
+
+# Procesos de planificación (0 o 1: todo en el proceso de la petición) y criterio de reparto
+PROCESOS_PLANIFICACION = int(os.getenv("PLANIFICADOR_PROCESOS", "0"))
+REPARTO_PLANIFICACION = os.getenv("PLANIFICADOR_REPARTO", "material")
+# Por debajo de estos CM repartir cuesta más (envío de datos y resultados) de lo que ahorra
+MIN_CM_PARALELO = 5000
+
+REPARTOS = ("material", "centro")
+
+_pool = None
+_pool_procesos = 0
+_pool_lock = threading.Lock()
+
+
+def fragmentar(stock_centros: pd.DataFrame, n: int, reparto: str = REPARTO_PLANIFICACION) -> np.ndarray:
+    """
+    Fragmento (0..n-1) de cada fila de `stock_centros`:
+      - "material": hash del Material (estable entre ejecuciones), reparto equilibrado.
+      - "centro": centros enteros, asignados de mayor a menor nº de CM al fragmento con
+        menos CM; como mucho tantos fragmentos útiles como centros.
+    """
+    if reparto == "material":
+        materiales = pd.to_numeric(stock_centros["Material"], errors="coerce").fillna(0).astype("int64")
+        return (pd.util.hash_array(materiales.to_numpy()) % np.uint64(n)).astype(np.int64)
+
+    if reparto == "centro":
+        centros = stock_centros["Centro"].astype(str)
+        carga = np.zeros(n, dtype=np.int64)
+        asignacion = {}
+        for centro, cms in centros.value_counts().items():
+            destino = int(np.argmin(carga))
+            asignacion[centro] = destino
+            carga[destino] += cms
+        return centros.map(asignacion).to_numpy(dtype=np.int64)
+
+    raise ValueError(f"Reparto {reparto!r} no soportado. Opciones: {REPARTOS}")
+
+
+def planificar_cms(
+    planificar,
+    stock_centros_forecast: pd.DataFrame,
+    parametros: ParametrosCM,
+    dias_forecast: int,
+    fecha_plan,
+    dia_limite: int | None,
+    metricas: MetricasEjecucion | None = None,
+    procesos: int | None = None,
+    reparto: str | None = None
+):
+    """
+    Ejecuta el modo `planificar` (pipeline_v2._planificar_iterativo / _planificar_una_pasada)
+    sobre el universo, repartido en `procesos` fragmentos si compensa (ver MIN_CM_PARALELO).
+    Mismo resultado que la llamada directa, (pedidos_total, forecast_final); en paralelo los
+    pedidos salen ordenados por Centro, Material y Dia_Entrega y el forecast por fragmento.
+    Las métricas de los fragmentos se acumulan en `metricas` (MetricasEjecucion.combinar).
+    """
+    metricas = metricas or MetricasEjecucion()
+    procesos = PROCESOS_PLANIFICACION if procesos is None else procesos
+    reparto = reparto or REPARTO_PLANIFICACION
+    argumentos = (dias_forecast, fecha_plan, dia_limite)
+
+    if procesos <= 1 or len(stock_centros_forecast) < MIN_CM_PARALELO:
+        return planificar(stock_centros_forecast, parametros, *argumentos, metricas=metricas)
+
+    fragmento = fragmentar(stock_centros_forecast, procesos, reparto)
+    tareas = []
+    for i in range(procesos):
+        stock_i = stock_centros_forecast[fragmento == i].reset_index(drop=True)
+        if stock_i.empty:
+            continue
+        parametros_i = parametros.subconjunto(parametros.posiciones(stock_i["Centro"], stock_i["Material"]))
+        tareas.append((stock_i, parametros_i))
+
+    print(f"   → Planificando {len(stock_centros_forecast)} CM en {len(tareas)} fragmentos ({reparto})")
+
+    pool = _obtener_pool(procesos)
+    try:
+        futuros = [pool.submit(_planificar_fragmento, planificar, s, p, *argumentos) for s, p in tareas]
+        resultados = [f.result() for f in futuros]
+    except BrokenProcessPool:
+        # Un proceso murió (p. ej. por memoria): el pool no se puede reutilizar
+        _descartar_pool(pool)
+        raise
+
+    metricas.combinar([resumen for _, _, resumen in resultados])
+
+    pedidos_total = pd.concat([p for p, _, _ in resultados], ignore_index=True)
+    if not pedidos_total.empty:
+        pedidos_total = pedidos_total.sort_values(
+            ["Centro", "Material", "Dia_Entrega"], kind="stable"
+        ).reset_index(drop=True)
+    forecast_final = pd.concat([f for _, f, _ in resultados], ignore_index=True)
+    return pedidos_total, forecast_final
+
+
+def _planificar_fragmento(planificar, stock_centros_forecast, parametros, dias_forecast, fecha_plan, dia_limite):
+    # En el proceso del pool: métricas propias, devueltas como resumen (dict serializable)
+    metricas = MetricasEjecucion()
+    pedidos, forecast = planificar(
+        stock_centros_forecast, parametros, dias_forecast, fecha_plan, dia_limite, metricas=metricas
+    )
+    return pedidos, forecast, metricas.resumen()
+
+
+def _obtener_pool(procesos: int) -> ProcessPoolExecutor:
+    global _pool, _pool_procesos
+    with _pool_lock:
+        if _pool is None or _pool_procesos != procesos:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                contexto = multiprocessing.get_context("forkserver")
+                contexto.set_forkserver_preload(["pipeline_v2"])
+            else:
+                contexto = multiprocessing.get_context("spawn")
+            _pool = ProcessPoolExecutor(max_workers=procesos, mp_context=contexto)
+            _pool_procesos = procesos
+        return _pool
+
+
+def _descartar_pool(pool: ProcessPoolExecutor):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
@@ -0,0 +1,139 @@
+# ============================================================
+# trabajos.py – Ejecución en segundo plano de planificaciones largas
+# ============================================================
+#
+# Un POST encola la planificación y devuelve un id al momento; la ejecución ocurre en un
+# pool acotado de hilos, y el cliente consulta estado / etapa en curso y recoge el
+# resultado cuando termina. Los trabajos terminados se conservan un tiempo limitado.
+
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+
+from metricas import MetricasEjecucion
+
+
+# Planificaciones ejecutándose a la vez y trabajos admitidos (en cola + en ejecución)
+MAX_TRABAJOS_CONCURRENTES = int(os.getenv("PLANIFICADOR_MAX_TRABAJOS", "2"))
+MAX_TRABAJOS_ACTIVOS = int(os.getenv("PLANIFICADOR_MAX_TRABAJOS_COLA", "20"))
+# Cuánto se conserva un trabajo terminado (segundos) y cuántos como máximo
+TTL_TRABAJOS_SEG = 60 * 60
+MAX_TRABAJOS_TERMINADOS = 200
+
+ESTADOS_TERMINADOS = ("completado", "error")
+
+
+class ColaLlena(Exception):
+    """No se admiten más trabajos hasta que terminen los activos."""
+
+
+@dataclass
+class Trabajo:
+    id: str
+    parametros: dict
+    estado: str = "pendiente"          # pendiente | ejecutando | completado | error
+    creado: float = field(default_factory=time.time)
+    iniciado: float | None = None
+    terminado: float | None = None
+    metricas: MetricasEjecucion | None = None
+    resultado: object = None
+    error: str | None = None
+
+    def descripcion(self) -> dict:
+        """Estado serializable a JSON (sin el resultado)."""
+        def iso(t):
+            return datetime.fromtimestamp(t, timezone.utc).isoformat(timespec="seconds") if t else None
+
+        datos = {
+            "trabajo_id": self.id,
+            "estado": self.estado,
+            "parametros": self.parametros,
+            "creado": iso(self.creado),
+            "iniciado": iso(self.iniciado),
+            "terminado": iso(self.terminado),
+        }
+        if self.iniciado is not None:
+            datos["segundos"] = round((self.terminado or time.time()) - self.iniciado, 2)
+        if self.metricas is not None and self.estado != "pendiente":
+            datos["progreso"] = self.metricas.progreso()
+        if self.error is not None:
+            datos["error"] = self.error
+        return datos
+
+
+class GestorTrabajos:
+    """
+    Trabajos en memoria del proceso, ejecutados en un ThreadPoolExecutor acotado.
+    `ejecutar(**parametros, metricas=MetricasEjecucion)` es la función de planificación.
+    """
+
+    def __init__(
+        self,
+        ejecutar,
+        max_concurrentes: int = MAX_TRABAJOS_CONCURRENTES,
+        max_activos: int = MAX_TRABAJOS_ACTIVOS,
+        ttl_seg: float = TTL_TRABAJOS_SEG,
+        max_terminados: int = MAX_TRABAJOS_TERMINADOS,
+    ):
+        self._ejecutar = ejecutar
+        self.max_activos = max_activos
+        self.ttl_seg = ttl_seg
+        self.max_terminados = max_terminados
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrentes, thread_name_prefix="trabajo")
+        self._trabajos: dict = {}
+        self._lock = threading.Lock()
+
+    def enviar(self, parametros: dict) -> Trabajo:
+        """Encola una planificación. Lanza ColaLlena si ya hay max_activos sin terminar."""
+        with self._lock:
+            self._purgar()
+            activos = sum(t.estado not in ESTADOS_TERMINADOS for t in self._trabajos.values())
+            if activos >= self.max_activos:
+                raise ColaLlena(f"Hay {activos} trabajos activos (máximo {self.max_activos})")
+            trabajo = Trabajo(id=uuid.uuid4().hex, parametros=dict(parametros))
+            self._trabajos[trabajo.id] = trabajo
+
+        self._pool.submit(self._correr, trabajo)
+        return trabajo
+
+    def obtener(self, trabajo_id: str) -> Trabajo | None:
+        with self._lock:
+            return self._trabajos.get(trabajo_id)
+
+    def listar(self) -> list:
+        with self._lock:
+            self._purgar()
+            return sorted(self._trabajos.values(), key=lambda t: t.creado)
+
+    def _correr(self, trabajo: Trabajo):
+        trabajo.metricas = MetricasEjecucion()
+        trabajo.iniciado = time.time()
+        trabajo.estado = "ejecutando"
+        try:
+            trabajo.resultado = self._ejecutar(**trabajo.parametros, metricas=trabajo.metricas)
+            estado = "completado"
+        except Exception as e:
+            print(f"❌ Trabajo {trabajo.id} fallido: {e}")
+            traceback.print_exc()
+            trabajo.error = f"{type(e).__name__}: {e}"
+            estado = "error"
+        # `terminado` antes que el estado: _purgar ordena los terminados por esa marca
+        trabajo.terminado = time.time()
+        trabajo.estado = estado
+
+    def _purgar(self):
+        # Caducados por TTL y, si aun así sobran, los terminados más antiguos
+        ahora = time.time()
+        terminados = sorted(
+            (t for t in self._trabajos.values() if t.estado in ESTADOS_TERMINADOS),
+            key=lambda t: t.terminado,
+        )
+        sobran = len(terminados) - self.max_terminados
+        for i, t in enumerate(terminados):
+            if i < sobran or ahora - t.terminado > self.ttl_seg:
+                del self._trabajos[t.id]